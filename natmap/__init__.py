@@ -22,35 +22,139 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
-from natmap.util import DeferredSingleton, InstanceFactory
-from natmap.upnp import discoverMapper as discoverUPnPMapper
-from natmap.mapper import MapperReactor 
-from natmap.internal import discoverInternalHost
+# Nothing is set up at import time.  The mapper reactor, and with it
+# the mapping backends and the Twisted reactor, is built on first use,
+# so that importing natmap is cheap and has no side effects.
 
-from twisted.internet import defer
+import sys
+import types
+import warnings
 
+_mapperReactor = None
 
-class MapperInstanceFactory:
+
+def getMapperReactor(stun=None):
+    """
+    Return the L{MapperReactor} used by the functions of this
+    package, building it on first use.  If C{NATMAP_PREWARM} is set
+    in the environment, it starts prewarming as soon as the reactor
+    runs.
+
+    @param stun: whether public STUN servers are asked for the
+        external address, at the same time as the mapping device.
+        C{None} leaves it to the C{NATMAP_STUN} environment variable;
+        STUN is off unless that is set.  Only the first call, which
+        builds the reactor, takes it into account.  Behind a carrier
+        grade NAT the address answered by STUN is the one of the
+        carrier, not the external address of the mapping device that
+        the mappings are made on, so STUN should only be enabled
+        where the mapping device has a public address.
+    """
+    global _mapperReactor
+    if _mapperReactor is None:
+        from natmap.mapper import MapperReactor, MapperInstanceFactory
+        from natmap.stun import DEFAULT_SERVERS
+        import os
+        if stun is None:
+            stun = bool(os.environ.get('NATMAP_STUN'))
+        _mapperReactor = MapperReactor(
+            MapperInstanceFactory(),
+            stunServers=stun and DEFAULT_SERVERS or (),
+            autoPrewarm=bool(os.environ.get('NATMAP_PREWARM')))
+    return _mapperReactor
+
+
+def prewarm():
+    """
+    See L{MapperReactor.prewarm}.
+    """
+    return getMapperReactor().prewarm()
+
+
+def mapAddress(address):
+    """
+    See L{MapperReactor.mapAddress}.
+    """
+    return getMapperReactor().mapAddress(address)
+
+
+def mapListeningPort(listeningPort):
+    """
+    See L{MapperReactor.mapListeningPort}.
+    """
+    return getMapperReactor().mapListeningPort(listeningPort)
+
+
+def unmapListeningPort(listeningPort):
+    """
+    See L{MapperReactor.unmapListeningPort}.
+    """
+    return getMapperReactor().unmapListeningPort(listeningPort)
+
+
+def discoverExternalHost():
+    """
+    See L{MapperReactor.discoverExternalHost}.
+    """
+    return getMapperReactor().discoverExternalHost()
+
+
+def addMappingObserver(observer):
+    """
+    See L{MapperReactor.addObserver}.
+    """
+    getMapperReactor().addObserver(observer)
+
+
+def removeMappingObserver(observer):
     """
-    Instance factory for building something that provides IMapper.
+    See L{MapperReactor.removeObserver}.
     """
+    getMapperReactor().removeObserver(observer)
 
-    @defer.inlineCallbacks
-    def buildInstance(self):
-        for discover in (discoverUPnPMapper,):
-            try:
-                mapper = yield discover()
-                defer.returnValue(mapper)
-            except Exception:
-                continue
-        raise RuntimeError("no mapper available")
 
+def discoverInternalHost():
+    """
+    See L{natmap.internal.discoverInternalHost}.
+    """
+    from natmap.internal import discoverInternalHost
+    return discoverInternalHost()
 
-mapperReactor = MapperReactor(MapperInstanceFactory())
-mapAddress = mapperReactor.mapAddress
-mapListeningPort = mapperReactor.mapListeningPort
-unmapListeningPort = mapperReactor.unmapListeningPort
-discoverExternalHost = mapperReactor.discoverExternalHost
 
 __all__ = ['mapAddress', 'mapListeningPort', 'unmapListeningPort',
-           'discoverInternalHost', 'discoverExternalHost']
+           'discoverInternalHost', 'discoverExternalHost',
+           'getMapperReactor', 'prewarm', 'addMappingObserver',
+           'removeMappingObserver']
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Stands in for this module in C{sys.modules} to provide, on first
+    use, the attributes that used to be set up at import time:
+    C{MapperInstanceFactory} and the deprecated C{mapperReactor}.
+    Once provided they are kept, so the deprecation is only warned
+    about once.
+    """
+
+    def __init__(self, module):
+        types.ModuleType.__init__(self, module.__name__)
+        self.__dict__.update(module.__dict__)
+        # Python 2 clears the globals of a module once it is
+        # collected, and the functions above still use them.
+        self._module = module
+
+    def __getattr__(self, name):
+        if name == 'mapperReactor':
+            warnings.warn("natmap.mapperReactor is deprecated, use "
+                          "natmap.getMapperReactor() instead",
+                          DeprecationWarning, stacklevel=2)
+            value = getMapperReactor()
+        elif name == 'MapperInstanceFactory':
+            from natmap.mapper import MapperInstanceFactory as value
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+
+sys.modules[__name__] = _LazyModule(sys.modules[__name__])
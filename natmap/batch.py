@@ -0,0 +1,299 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Batched gateway operations, run from the command line with
+#
+#   python -m natmap list map 192.168.1.10:8080/TCP unmap-owner myapp
+#
+# The gateway is discovered once and its mapping table walked once;
+# the operations then work on that copy of the table.  The results
+# are written as JSON, with the time taken by every operation.  If
+# the gateway cannot be discovered, the JSON document holds the error
+# instead and the exit status is 1.
+
+from natmap.inatmap import NoSuchMappingError
+from natmap.protocol import Mapping, formatDescription, parseOwner
+
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.python import usage
+
+import json
+import sys
+import time
+
+
+# Operations and whether they take arguments.
+OPERATIONS = {'list': False, 'external-ip': False, 'map': True,
+              'unmap': True, 'unmap-owner': True}
+
+
+def parseAddress(value):
+    """
+    Parse an internal address written as C{HOST:PORT[/TYPE]}.  The
+    type defaults to TCP.
+
+    @rtype: L{IPv4Address}
+    """
+    address, _, type = value.partition('/')
+    host, _, port = address.rpartition(':')
+    type = (type or 'TCP').upper()
+    if not host or type not in ('TCP', 'UDP'):
+        raise ValueError("bad address %r" % (value,))
+    return IPv4Address(type, host, int(port))
+
+
+def parseOperations(words):
+    """
+    Parse a sequence of words into operations.  An operation that
+    takes arguments applies to all the words up to the next
+    operation, so C{map A B} maps both C{A} and C{B}.
+
+    @return: a list of C{(operation, argument)} tuples, where
+        C{argument} is C{None} for operations without arguments.
+    @raise ValueError: on an unknown operation or a missing argument.
+    """
+    operations = list()
+    current = None
+    pending = False
+    for word in words:
+        if word in OPERATIONS:
+            if pending:
+                raise ValueError("%s needs an argument" % (current,))
+            current = word
+            pending = OPERATIONS[word]
+            if not pending:
+                operations.append((word, None))
+        elif current is not None and OPERATIONS[current]:
+            if current in ('map', 'unmap'):
+                parseAddress(word)
+            operations.append((current, word))
+            pending = False
+        else:
+            raise ValueError("unknown operation %r" % (word,))
+    if pending:
+        raise ValueError("%s needs an argument" % (current,))
+    return operations
+
+
+def readOperations(f):
+    """
+    Read the words of operations from the file C{f}.  Everything
+    after a C{#} on a line is ignored.
+    """
+    words = list()
+    for line in f:
+        words.extend(line.split('#', 1)[0].split())
+    return words
+
+
+def _error(e):
+    return '%s: %s' % (e.__class__.__name__, e)
+
+
+def _describe(mapping):
+    owner = parseOwner(mapping.description)
+    return {'type': mapping.type, 'internalHost': mapping.internalHost,
+            'internalPort': mapping.internalPort,
+            'externalPort': mapping.externalPort,
+            'description': mapping.description,
+            'owner': owner and owner[0]}
+
+
+class Batch:
+    """
+    Runs operations against one L{UPnPMapper}, sharing one walk of
+    its mapping table.
+
+    @ivar mappings: the mapping table as known to the batch, or
+        C{None} before it has been walked.
+    """
+
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self.mappings = None
+
+    def getMappings(self):
+        """
+        Return a deferred called with the mapping table, walking it
+        on first use.
+        """
+        if self.mappings is not None:
+            return defer.succeed(self.mappings)
+        def cb(mappings):
+            self.mappings = list(mappings)
+            return self.mappings
+        return self.mapper.getMappings().addCallback(cb)
+
+    def do_list(self, argument):
+        def cb(mappings):
+            return [_describe(mapping) for mapping in mappings]
+        return self.getMappings().addCallback(cb)
+
+    def do_external_ip(self, argument):
+        return self.mapper.discoverExternalHost()
+
+    @defer.inlineCallbacks
+    def do_map(self, argument):
+        address = parseAddress(argument)
+        mappings = yield self.getMappings()
+        existing = [mapping for mapping in mappings
+                    if mapping.matches(address)]
+        if existing:
+            externalPort = existing[0].externalPort
+        else:
+            used = set((mapping.type, mapping.externalPort)
+                       for mapping in mappings)
+            externalPort = self.mapper.pickExternalPort(
+                address.type, address.port, used)
+        external = yield self.mapper.mapTo(address, externalPort)
+        if not existing:
+            mappings.append(Mapping(
+                address.type, address.host, address.port, externalPort,
+                formatDescription(address.host, address.port, address.type,
+                                  self.mapper.owner, self.mapper.instance)))
+        defer.returnValue('%s:%d' % (external.host, external.port))
+
+    @defer.inlineCallbacks
+    def do_unmap(self, argument):
+        address = parseAddress(argument)
+        mappings = yield self.getMappings()
+        for mapping in mappings:
+            if mapping.matches(address):
+                break
+        else:
+            raise NoSuchMappingError(argument)
+        yield self.mapper.deleteMapping(mapping)
+        mappings.remove(mapping)
+
+    @defer.inlineCallbacks
+    def do_unmap_owner(self, argument):
+        mappings = yield self.getMappings()
+        deleted = 0
+        for mapping in list(mappings):
+            owner = parseOwner(mapping.description)
+            if owner is None or owner[0] != argument:
+                continue
+            yield self.mapper.deleteMapping(mapping)
+            mappings.remove(mapping)
+            deleted += 1
+        defer.returnValue(deleted)
+
+    @defer.inlineCallbacks
+    def run(self, operations):
+        """
+        Run C{operations}, one after the other.  A failed operation
+        does not stop the others.
+
+        @return: a deferred called with a list of result dictionaries.
+        """
+        results = list()
+        for operation, argument in operations:
+            method = getattr(self, 'do_' + operation.replace('-', '_'))
+            result = {'operation': operation, 'argument': argument}
+            started = time.time()
+            try:
+                result['result'] = yield method(argument)
+            except Exception, e:
+                result['error'] = _error(e)
+            result['seconds'] = time.time() - started
+            results.append(result)
+        defer.returnValue(results)
+
+
+class Options(usage.Options):
+    synopsis = ("Usage: python -m natmap [options] "
+                "operation [argument...] ...")
+    longdesc = ("Operations: list, external-ip, map HOST:PORT[/TYPE]..., "
+                "unmap HOST:PORT[/TYPE]..., unmap-owner OWNER...")
+    optParameters = [
+        ['file', 'f', None, "Read operations from a file, - for stdin."],
+        ['timeout', 't', 5, "Seconds to wait for the gateway.", float],
+        ['owner', None, 'natmap', "Owner to tag new mappings with."],
+        ['search-address', None, None, "HOST:PORT to send the search to "
+         "instead of the SSDP multicast group."],
+        ]
+
+    def parseArgs(self, *words):
+        words = list(words)
+        if self['file'] == '-':
+            words.extend(readOperations(sys.stdin))
+        elif self['file'] is not None:
+            f = open(self['file'])
+            try:
+                words.extend(readOperations(f))
+            finally:
+                f.close()
+        try:
+            self['operations'] = parseOperations(words)
+        except ValueError, e:
+            raise usage.UsageError(str(e))
+        if not self['operations']:
+            raise usage.UsageError("no operations given")
+
+    def postOptions(self):
+        address = self['search-address']
+        if address is not None:
+            host, _, port = address.rpartition(':')
+            self['search-address'] = (host, int(port))
+
+
+@defer.inlineCallbacks
+def runBatch(config):
+    """
+    Discover the gateway and run the operations of C{config}.
+
+    @return: a deferred called with the JSON document, which holds an
+        C{error} instead of the results if the gateway could not be
+        discovered.
+    """
+    from natmap.upnp import discoverMapper
+    started = time.time()
+    try:
+        mapper = yield discoverMapper(timeout=config['timeout'],
+                                      searchAddress=config['search-address'],
+                                      owner=config['owner'])
+    except Exception, e:
+        defer.returnValue({'discovery': time.time() - started,
+                           'error': _error(e)})
+    discovery = time.time() - started
+    results = yield Batch(mapper).run(config['operations'])
+    defer.returnValue({'gateway': mapper.proxy.url, 'discovery': discovery,
+                       'operations': results})
+
+
+def main(reactor, *argv):
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError, e:
+        sys.stderr.write('%s\n%s\n' % (config, e))
+        raise SystemExit(2)
+
+    def cb(document):
+        sys.stdout.write(json.dumps(document, indent=2, sort_keys=True)
+                         + '\n')
+        if 'error' in document:
+            raise SystemExit(1)
+    return runBatch(config).addCallback(cb)
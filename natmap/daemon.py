@@ -0,0 +1,247 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# A host-wide mapping daemon.  The daemon owns the connection to the
+# mapping device and serves map, unmap and external address requests
+# to the processes on the host over a UNIX socket, so discovery and
+# table walks happen once per host and port allocations do not race.
+# Mappings made through a connection are removed when it is lost.
+# The daemon is started with "twistd natmapd".
+
+from natmap.inatmap import IMapper, NoSuchMappingError
+
+from zope.interface import implements
+
+from twisted.application import internet
+from twisted.internet import defer, reactor, protocol
+from twisted.internet.address import IPv4Address
+from twisted.protocols import amp
+from twisted.python import log, usage
+
+import os
+
+
+DEFAULT_SOCKET = os.environ.get('NATMAP_SOCKET', '/var/run/natmapd.sock')
+
+
+class MapAddress(amp.Command):
+    arguments = [('type', amp.String()),
+                 ('host', amp.String()),
+                 ('port', amp.Integer())]
+    response = [('host', amp.String()),
+                ('port', amp.Integer())]
+
+
+class UnmapAddress(amp.Command):
+    arguments = [('type', amp.String()),
+                 ('host', amp.String()),
+                 ('port', amp.Integer())]
+    response = []
+    errors = {NoSuchMappingError: 'NO_SUCH_MAPPING'}
+
+
+class DiscoverExternalHost(amp.Command):
+    arguments = []
+    response = [('host', amp.String())]
+
+
+class MapperServerProtocol(amp.AMP):
+    """
+    Serves the requests of one client process.
+
+    @ivar mapped: the internal addresses mapped through this
+        connection, keyed by C{(type, host, port)}.
+    """
+
+    def __init__(self, mapperReactor, lock):
+        amp.AMP.__init__(self)
+        self.mapperReactor = mapperReactor
+        self.lock = lock
+        self.mapped = {}
+
+    @MapAddress.responder
+    def mapAddress(self, type, host, port):
+        address = IPv4Address(type, host, port)
+        def cb(externalAddress):
+            self.mapped[(type, host, port)] = address
+            return {'host': externalAddress.host,
+                    'port': externalAddress.port}
+        # Allocating a port walks the table and then adds a mapping;
+        # two allocations running side by side could pick the same
+        # port.
+        return self.lock.run(self.mapperReactor.mapAddress,
+                             address).addCallback(cb)
+
+    @UnmapAddress.responder
+    def unmapAddress(self, type, host, port):
+        address = IPv4Address(type, host, port)
+        def cb(result):
+            self.mapped.pop((type, host, port), None)
+            return {}
+        return self.lock.run(self.mapperReactor.unmapAddress,
+                             address).addCallback(cb)
+
+    @DiscoverExternalHost.responder
+    def discoverExternalHost(self):
+        def cb(host):
+            return {'host': host}
+        return self.mapperReactor.discoverExternalHost().addCallback(cb)
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        mapped, self.mapped = self.mapped, {}
+        for address in mapped.itervalues():
+            self.lock.run(self.mapperReactor.unmapAddress,
+                          address).addErrback(log.err)
+
+
+class MapperServerFactory(protocol.ServerFactory):
+    """
+    Factory for the daemon side of the UNIX socket.
+
+    @ivar mapperReactor: the L{MapperReactor} that talks to the
+        mapping device.
+    """
+
+    def __init__(self, mapperReactor):
+        self.mapperReactor = mapperReactor
+        self.lock = defer.DeferredLock()
+
+    def buildProtocol(self, addr):
+        p = MapperServerProtocol(self.mapperReactor, self.lock)
+        p.factory = self
+        return p
+
+
+class MapperClientProtocol(amp.AMP):
+    """
+    The client side of a connection to the mapping daemon, that tells
+    when the connection is lost.
+    """
+
+    def __init__(self):
+        amp.AMP.__init__(self)
+        self.lostWaiters = list()
+
+    def whenLost(self):
+        """
+        @return: a deferred called when the connection is lost.
+        """
+        d = defer.Deferred()
+        self.lostWaiters.append(d)
+        return d
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        waiters, self.lostWaiters = self.lostWaiters, list()
+        for waiter in waiters:
+            waiter.callback(None)
+
+
+class DaemonMapper:
+    """
+    Mapper that forwards everything to the mapping daemon.
+
+    @ivar connection: the L{MapperClientProtocol} connected to the
+        daemon.
+    """
+    implements(IMapper)
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def whenLost(self):
+        """
+        @return: a deferred called when the connection to the daemon
+            is lost, after which the mapper can no longer be used.
+            The mappings made through it are gone with the daemon.
+        """
+        return self.connection.whenLost()
+
+    def discoverExternalHost(self):
+        """
+        See L{IMapper.discoverExternalHost}.
+        """
+        def cb(response):
+            return response['host']
+        return self.connection.callRemote(DiscoverExternalHost).addCallback(cb)
+
+    def map(self, address, trace=None):
+        """
+        See L{IMapper.map}.
+
+        The phases of the operation run in the daemon and are not
+        reported to C{trace}.
+        """
+        def cb(response):
+            return IPv4Address(address.type, response['host'],
+                               response['port'])
+        return self.connection.callRemote(
+            MapAddress, type=address.type, host=address.host,
+            port=address.port).addCallback(cb)
+
+    def unmap(self, address):
+        """
+        See L{IMapper.unmap}.
+        """
+        return self.connection.callRemote(
+            UnmapAddress, type=address.type, host=address.host,
+            port=address.port)
+
+
+def discoverMapper(path=DEFAULT_SOCKET, reactor=reactor):
+    """
+    Connect to the mapping daemon listening on C{path}.
+
+    @return: a deferred called with a L{DaemonMapper}, or errbacked
+        if no daemon is running.
+    """
+    def cb(connection):
+        return DaemonMapper(connection)
+    creator = protocol.ClientCreator(reactor, MapperClientProtocol)
+    return creator.connectUNIX(path, timeout=5).addCallback(cb)
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['socket', 's', DEFAULT_SOCKET, "UNIX socket to listen on."],
+        ['timeout', 't', None, "Deadline, in seconds, of an operation.",
+         float],
+        ]
+
+
+def makeService(options):
+    """
+    Build the service of the mapping daemon.
+    """
+    from natmap.mapper import (
+        MapperReactor, MapperInstanceFactory, discoverGatewayMapper)
+
+    # The daemon must not discover itself.
+    mapperReactor = MapperReactor(
+        MapperInstanceFactory((discoverGatewayMapper,)),
+        timeout=options['timeout'])
+    return internet.UNIXServer(options['socket'],
+                               MapperServerFactory(mapperReactor),
+                               wantPID=True)
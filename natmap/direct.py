@@ -0,0 +1,158 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Mapping for hosts that are not behind a NAT.  If the host has a
+# globally routable address, or the mapping device reports our own
+# address as its external address, every address is already
+# reachable from the outside and mapping is the identity.
+
+from natmap.inatmap import IMapper
+from natmap.internal import discoverInternalHost
+
+from zope.interface import implements
+
+from twisted.internet import defer, reactor
+from twisted.internet.address import IPv4Address
+
+import socket
+import struct
+
+
+# Networks that are not globally routable, as (network, prefix
+# length) tuples.
+_NON_PUBLIC = [
+    ('0.0.0.0', 8),
+    ('10.0.0.0', 8),
+    ('100.64.0.0', 10),
+    ('127.0.0.0', 8),
+    ('169.254.0.0', 16),
+    ('172.16.0.0', 12),
+    ('192.0.0.0', 24),
+    ('192.0.2.0', 24),
+    ('192.168.0.0', 16),
+    ('198.18.0.0', 15),
+    ('198.51.100.0', 24),
+    ('203.0.113.0', 24),
+    ('224.0.0.0', 3),
+    ]
+
+
+def _toInt(host):
+    return struct.unpack('!L', socket.inet_aton(host))[0]
+
+
+def isPublicAddress(host):
+    """
+    Return true if the IPv4 address C{host} is globally routable.
+    """
+    try:
+        address = _toInt(host)
+    except socket.error:
+        return False
+    for network, length in _NON_PUBLIC:
+        mask = (0xffffffffL << (32 - length)) & 0xffffffffL
+        if address & mask == _toInt(network):
+            return False
+    return True
+
+
+class NotPublicError(Exception):
+    """
+    The host does not have a public address.
+    """
+
+
+class DirectMapper:
+    """
+    Mapper for a host with the public address C{host}.  Addresses are
+    mapped to themselves, without any traffic.
+    """
+    implements(IMapper)
+
+    def __init__(self, host):
+        self.host = host
+
+    def discoverExternalHost(self):
+        """
+        See L{IMapper.discoverExternalHost}.
+        """
+        return defer.succeed(self.host)
+
+    def map(self, address, trace=None):
+        """
+        See L{IMapper.map}.
+        """
+        return defer.succeed(IPv4Address(address.type, self.host,
+                                         address.port))
+
+    def unmap(self, address):
+        """
+        See L{IMapper.unmap}.
+        """
+        return defer.succeed(None)
+
+
+def _lookupInternalHost(reactor, lookupInternalHost):
+    if lookupInternalHost is None:
+        return discoverInternalHost(reactor)
+    return lookupInternalHost()
+
+
+def discoverMapper(reactor=reactor, lookupInternalHost=None):
+    """
+    Discover whether the host has a public address.
+
+    @param lookupInternalHost: called without arguments for a
+        deferred internal address, such as one already looked up, or
+        C{None} to look it up with L{discoverInternalHost}.
+    @return: a deferred called with a L{DirectMapper}, or errbacked
+        with L{NotPublicError} if the internal address is not public.
+    """
+    def cb(host):
+        if not isPublicAddress(host):
+            raise NotPublicError(host)
+        return DirectMapper(host)
+    return _lookupInternalHost(reactor, lookupInternalHost).addCallback(cb)
+
+
+def checkTranslation(mapper, reactor=reactor, lookupInternalHost=None):
+    """
+    Check whether C{mapper} translates addresses at all.  Some
+    devices, such as routers of hosts with a public address, answer
+    our own address as their external address.
+
+    @param lookupInternalHost: see L{discoverMapper}.
+    @return: a deferred called with a L{DirectMapper} if the device
+        does not translate, and with C{mapper} otherwise.
+    """
+    def cb(results):
+        (externalFound, externalHost), (internalFound, internalHost) = results
+        if externalFound and internalFound and externalHost == internalHost:
+            return DirectMapper(externalHost)
+        return mapper
+    d = defer.DeferredList([mapper.discoverExternalHost(),
+                            _lookupInternalHost(reactor,
+                                                lookupInternalHost)],
+                           consumeErrors=True)
+    return d.addCallback(cb)
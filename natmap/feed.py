@@ -0,0 +1,84 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Delivery of the changes of the managed mappings to the observers
+# of the application.
+
+from twisted.python import log
+
+
+class MappingFeed:
+    """
+    Passes the changes of the managed mappings on to a set of
+    L{IMappingObserver} providers.  Observers need only implement the
+    methods of the events they care about.
+
+    @ivar observers: the registered observers.
+    @ivar externalHost: the external IP address last seen, or C{None}.
+    """
+
+    def __init__(self):
+        self.observers = list()
+        self.externalHost = None
+
+    def addObserver(self, observer):
+        """
+        Register an L{IMappingObserver} provider.
+        """
+        self.observers.append(observer)
+
+    def removeObserver(self, observer):
+        """
+        Unregister an L{IMappingObserver} provider.
+        """
+        self.observers.remove(observer)
+
+    def _notify(self, name, *args):
+        for observer in list(self.observers):
+            method = getattr(observer, name, None)
+            if method is None:
+                continue
+            try:
+                method(*args)
+            except:
+                log.err(None, "mapping observer failed")
+
+    def mappingAdded(self, internalAddress, externalAddress):
+        self._notify('mappingAdded', internalAddress, externalAddress)
+
+    def mappingLost(self, internalAddress, externalAddress):
+        self._notify('mappingLost', internalAddress, externalAddress)
+
+    def mappingRestored(self, internalAddress, externalAddress):
+        self._notify('mappingRestored', internalAddress, externalAddress)
+
+    def externalHostSeen(self, externalHost):
+        """
+        Report the external IP address as seen by a lookup.  The
+        observers are told if it differs from the one seen before.
+        """
+        previousHost, self.externalHost = self.externalHost, externalHost
+        if previousHost is not None and previousHost != externalHost:
+            self._notify('externalAddressChanged', previousHost,
+                         externalHost)
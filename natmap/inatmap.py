@@ -46,12 +46,15 @@ class IMapper(Interface):
             IP address.
         """
 
-    def map(address):
+    def map(address, trace=None):
         """
         Map internal address.
 
         @param address: internal address.
         @type address: L{twisted.internet.address.IPv4Address}
+        @param trace: a L{natmap.trace.Trace} to report the phases of
+            the operation to.  Optional; providers default to
+            L{natmap.trace.NULL}.
 
         @return: A L{Deferred} that will be called with the external
             address of the mapped port.
@@ -67,3 +70,67 @@ class IMapper(Interface):
         @return: A L{Deferred} that will be called when the mapping
             has been revoked.
         """
+
+
+class IMetricsObserver(Interface):
+    """
+    Receives timings of the traffic exchanged with mapping devices.
+    """
+
+    def callCompleted(gateway, action, latency, reason):
+        """
+        A remote call to a mapping device completed.
+
+        @param gateway: the URL of the control endpoint of the device.
+        @param action: the name of the action, such as
+            C{'AddPortMapping'}.
+        @param latency: the time the call took, in seconds.
+        @param reason: C{None} if the call succeeded, otherwise a
+            L{twisted.python.failure.Failure}.
+        """
+
+    def discoveryPhaseCompleted(phase, latency, reason):
+        """
+        A phase of mapping device discovery completed.
+
+        @param phase: the name of the phase: C{'search'} for the time
+            until a device answered, C{'description'} for fetching the
+            device description, and C{'total'} for all of discovery.
+        @param latency: the time the phase took, in seconds.
+        @param reason: C{None} if the phase succeeded, otherwise a
+            L{twisted.python.failure.Failure}.
+        """
+
+
+class IMappingObserver(Interface):
+    """
+    Receives the changes of the mappings managed by a
+    L{natmap.mapper.MapperReactor}.  Addresses are
+    L{twisted.internet.address.IPv4Address} instances.
+    """
+
+    def mappingAdded(internalAddress, externalAddress):
+        """
+        Internal address C{internalAddress} has been mapped to
+        C{externalAddress}.
+        """
+
+    def mappingLost(internalAddress, externalAddress):
+        """
+        The mapping of C{internalAddress} to C{externalAddress} has
+        disappeared from the mapping device, for example because it
+        rebooted.
+        """
+
+    def mappingRestored(internalAddress, externalAddress):
+        """
+        A lost mapping of C{internalAddress} has been put back, and is
+        now mapped to C{externalAddress}.
+        """
+
+    def externalAddressChanged(previousHost, externalHost):
+        """
+        The external IP address has changed from C{previousHost} to
+        C{externalHost}.  All mappings are reached through the new
+        address.
+        """
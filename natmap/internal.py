@@ -25,14 +25,14 @@
 # Functionality for discovering the "internal" address (it may turn
 # out to be a "real" address).
 
-from twisted.internet import defer, reactor
+from natmap.protocol import SSDP_MCAST
+from natmap.ssdp import acquireSearchPort
+
+from twisted.internet import defer, error, reactor
 from twisted.internet.protocol import DatagramProtocol
-import random
+import os
 import socket
-
-
-def iterrandrange(n, start, stop):
-    return (random.randint(start, stop) for i in range(n))
+import struct
 
 
 class DiscoverError(Exception):
@@ -41,7 +41,96 @@ class DiscoverError(Exception):
     """
 
 
-def connectedSocketDiscover():
+def defaultRoutes(path='/proc/net/route'):
+    """
+    Find the default routes in the routing table of the host.
+
+    @param path: the routing table, in the format of Linux'
+        C{/proc/net/route}.
+    @return: a list of C{(interface, gateway)} tuples of the names of
+        the interfaces with a default route and the IP addresses of
+        their gateways, empty if the routing table cannot be read.
+    """
+    try:
+        routes = open(path)
+    except IOError:
+        return []
+    found = list()
+    try:
+        for line in routes:
+            fields = line.split()
+            try:
+                name, destination, gateway, flags = fields[:4]
+                if destination != '00000000' or not int(flags, 16) & 0x2:
+                    continue
+                gateway = socket.inet_ntoa(struct.pack('<L',
+                                                       int(gateway, 16)))
+            except (IndexError, ValueError):
+                continue
+            if name not in [interface for interface, _ in found]:
+                found.append((name, gateway))
+    finally:
+        routes.close()
+    return found
+
+
+def defaultGateway(path='/proc/net/route'):
+    """
+    Find the default gateway in the routing table of the host.
+
+    @param path: the routing table, in the format of Linux'
+        C{/proc/net/route}.
+    @return: the IP address of the gateway, or C{None} if there is
+        none or the routing table cannot be read.
+    """
+    for name, gateway in defaultRoutes(path):
+        return gateway
+    return None
+
+
+SIOCGIFADDR = 0x8915
+
+
+def interfaceAddress(name):
+    """
+    Return the IPv4 address of the interface called C{name}, or
+    C{None} if it has none or it cannot be told.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        try:
+            request = fcntl.ioctl(s.fileno(), SIOCGIFADDR,
+                                  struct.pack('256s', name[:15]))
+        except IOError:
+            return None
+    finally:
+        s.close()
+    return socket.inet_ntoa(request[20:24])
+
+
+def discoverUplinks(path='/proc/net/route'):
+    """
+    Find the interfaces of the host that lead to a gateway.  A host
+    with more than one is multi-homed, and every uplink may have a
+    mapping device of its own.
+
+    @return: a list of C{(interface, address, gateway)} tuples of the
+        name and address of each interface with a default route and
+        the IP address of its gateway.
+    """
+    uplinks = list()
+    for name, gateway in defaultRoutes(path):
+        address = interfaceAddress(name)
+        if address is not None:
+            uplinks.append((name, address, gateway))
+    return uplinks
+
+
+def connectedSocketDiscover(reactor=reactor):
     """
     Try to discover the internal address by using a connected UDP
     socket.
@@ -51,62 +140,73 @@ def connectedSocketDiscover():
     def cb(address):
         protocol = DatagramProtocol()
         listeningPort = reactor.listenUDP(0, protocol)
-        protocol.transport.connect(address, 7)
-        internal = protocol.transport.getHost().host
-        listeningPort.stopListening()
-        return internal
+        try:
+            protocol.transport.connect(address, 7)
+            return protocol.transport.getHost().host
+        finally:
+            listeningPort.stopListening()
     return reactor.resolve('A.ROOT-SERVERS.NET').addCallback(cb)
 
 
-class MulticastDiscoverProtocol(DatagramProtocol):
+class MulticastDiscoverProtocol:
+    """
+    Discovers the internal address by sending a datagram to the SSDP
+    multicast group from the shared L{SearchPort} and looking at the
+    source address of the copy that is looped back.
+    """
 
-    def __init__(self):
-        self.deferred = defer.Deferred()
+    def __init__(self, reactor=reactor):
+        self.reactor = reactor
+        self.deferred = None
+        self.searchPort = None
+        self.timeout = None
+        self.token = 'natmap-ping ' + os.urandom(8).encode('hex')
 
     def datagramReceived(self, datagram, address):
-        deferred, self.deferred = self.deferred, None
-        if deferred is not None and datagram == 'ping':
-            deferred.callbackk(address[0])
-            self.timeout.cancel()
-             
-    def discover(self):
-        for port in iterrandrange(5, 1024, 65535):
-            try:
-                self.listeningPort = reactor.listenMulticast(port, self)
-            except error.CannotListenError:
-                continue
-            break
-        else:
-            raise
-
-        self.listningPort.joinGroup('239.255.255.250', socket.INADDR_ANY)
-        dst = ('239.255.255.250', self.listeningPort.getHost().port)
-        self.transport.write('ping', dst)
-        self.transport.write('ping', dst)
-        self.transport.write('ping', dst)
+        if datagram == self.token and self.deferred is not None:
+            self._finish().callback(address[0])
+
+    def discover(self, timeout=5):
+        self.deferred = defer.Deferred(self._cancel)
+        self.searchPort = acquireSearchPort(self, self.reactor)
+        self.searchPort.joinGroup()
+        dst = (SSDP_MCAST, self.searchPort.getHost().port)
+        for i in range(3):
+            self.searchPort.write(self.token, dst)
+        self.timeout = self.reactor.callLater(timeout, self.cancel)
+        return self.deferred
 
-        self.timeout = reactor.callLater(5, self.cancel)
+    def _finish(self):
+        deferred, self.deferred = self.deferred, None
+        searchPort, self.searchPort = self.searchPort, None
+        if searchPort is not None:
+            searchPort.release(self)
+        timeout, self.timeout = self.timeout, None
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        return deferred
 
-        return self.deferred
+    def _cancel(self, deferred):
+        self._finish()
 
     def cancel(self):
-        deferred, self.deferred = self.deferred, None
+        deferred = self._finish()
         if deferred is not None:
             deferred.errback(error.TimeoutError())
 
 
-def localNetworkMulticastDiscover():
+def localNetworkMulticastDiscover(reactor=reactor):
     """
     Try to discover the internal address by sending out a multicast
     message and inspect the response.
     
     @return: a L{Deferred} called with the internal address.
     """
-    return MulticastDiscoverProtocol().discover()
+    return MulticastDiscoverProtocol(reactor).discover()
 
 
 @defer.inlineCallbacks
-def discoverInternalHost():
+def discoverInternalHost(reactor=reactor):
     """
     Discover internal (aka local) IP address.
     
@@ -115,9 +215,8 @@ def discoverInternalHost():
     """
     for discover in (connectedSocketDiscover, localNetworkMulticastDiscover):
         try:
-            value = yield discover()
+            value = yield discover(reactor)
             defer.returnValue(value)
         except Exception:
-            print "CAUGHT"
             continue
     raise DiscoverError()
@@ -24,34 +24,297 @@
 
 from natmap.inatmap import IMapper
 
-from natmap.util import DeferredSingleton, InstanceFactory
-from natmap.upnp import discoverMapper as discoverUPnPMapper
-from natmap.internal import discoverInternalHost
+from natmap.util import (
+    DeferredSingleton, InstanceFactory, timeoutDeferred, race)
+from natmap.daemon import discoverMapper as discoverDaemonMapper
+from natmap.direct import discoverMapper as discoverDirectMapper
+from natmap.direct import checkTranslation, isPublicAddress, DirectMapper
+from natmap.internal import discoverInternalHost, discoverUplinks
+from natmap.reconcile import Reconciler, addressKey
+from natmap.feed import MappingFeed
+from natmap.sweep import sweepStaleMappings, getDefaultJournal
+from natmap.notify import NotifyListener, gatewayHost
+from natmap import trace as tracing
+from natmap import stun
 
 from twisted.internet import defer, reactor, error
 from twisted.internet.address import IPv4Address
+from twisted.python import failure, log
+
+import inspect
+
+
+def discoverGatewayMapper(reactor=reactor, journal=None,
+                          lookupInternalHost=None):
+    """
+    Discover a UPnP mapper, unless the device does not translate
+    addresses, in which case a L{DirectMapper} is used.
+
+    @param journal: the L{natmap.sweep.Journal} that the UPnP mapper
+        records its mappings in, so that
+        L{MapperReactor.sweepStaleMappings} can find them, by default
+        the one at L{natmap.sweep.DEFAULT_JOURNAL}.
+    @param lookupInternalHost: see L{checkTranslation}.
+    """
+    # The UPnP stack pulls in twisted.web and ElementTree, so it is
+    # only loaded when needed.
+    from natmap.upnp import discoverMapper
+    if journal is None:
+        journal = getDefaultJournal()
+    return discoverMapper(reactor=reactor, journal=journal).addCallback(
+        checkTranslation, reactor, lookupInternalHost)
+
+
+def _takes(function, argument):
+    """
+    Return true if C{function} takes an argument named C{argument}.
+    """
+    try:
+        return argument in inspect.getargspec(function)[0]
+    except TypeError:
+        return False
 
 
 class MapperInstanceFactory:
     """
     Instance factory for building something that provides IMapper.
+
+    @ivar discoverers: the functions tried, in order, to find a
+        mapper.  A host with a public address needs no mapping at all,
+        so that is checked first.  Then the mapping daemon is tried,
+        so that processes on a host running one share its connection
+        to the device.
+    @ivar reactor: the reactor passed on to the discoverers, or
+        C{None} to let them use the global one.
+    @ivar lookupInternalHost: passed on to the discoverers that take
+        it, or C{None} to let them look the internal address up on
+        their own.  A L{MapperReactor} sets it to its own
+        L{MapperReactor.discoverInternalHost}, so that the address is
+        looked up only once.
     """
 
+    def __init__(self, discoverers=(discoverDirectMapper,
+                                    discoverDaemonMapper,
+                                    discoverGatewayMapper), reactor=None,
+                 lookupInternalHost=None):
+        self.discoverers = discoverers
+        self.reactor = reactor
+        self.lookupInternalHost = lookupInternalHost
+
     @defer.inlineCallbacks
     def buildInstance(self):
-        for discover in (discoverUPnPMapper,):
+        for discover in self.discoverers:
+            options = {}
+            if self.reactor is not None:
+                options['reactor'] = self.reactor
+            if (self.lookupInternalHost is not None
+                    and _takes(discover, 'lookupInternalHost')):
+                options['lookupInternalHost'] = self.lookupInternalHost
             try:
-                mapper = yield discover()
+                mapper = yield discover(**options)
                 defer.returnValue(mapper)
             except Exception:
                 continue
         raise RuntimeError("no mapper available")
 
 
+class WatchedMapperFactory:
+    """
+    Instance factory that builds mappers with C{factory}, and calls
+    C{lost} with a mapper that has a C{whenLost} method, such as a
+    L{DaemonMapper}, once that tells that it can no longer be used.
+    """
+
+    def __init__(self, factory, lost):
+        self.factory = factory
+        self.lost = lost
+
+    def buildInstance(self):
+        def cb(mapper):
+            if hasattr(mapper, 'whenLost'):
+                mapper.whenLost().addCallback(
+                    lambda result: self.lost(mapper)).addErrback(log.err)
+            return mapper
+        return defer.maybeDeferred(self.factory.buildInstance).addCallback(cb)
+
+
+class UplinkMapperFactory:
+    """
+    Instance factory for the mapper of one uplink of a multi-homed
+    host: the interface with address C{address}, whose gateway is
+    C{gateway}.  The mapping device is searched for on that interface
+    only.
+    """
+
+    def __init__(self, address, gateway, reactor=reactor):
+        self.address = address
+        self.gateway = gateway
+        self.reactor = reactor
+
+    def buildInstance(self):
+        if isPublicAddress(self.address):
+            return defer.succeed(DirectMapper(self.address))
+        from natmap.upnp import discoverMapper
+        return discoverMapper(interface=self.address, gateway=self.gateway,
+                              reactor=self.reactor)
+
+
 class MapperReactor:
+    """
+    Front end for mapping addresses through whatever L{IMapper}
+    provider the factory builds.
+
+    @ivar reconciler: a L{Reconciler} that keeps the registered
+        mappings in place on the mapping device.
+    @ivar timeout: the deadline, in seconds, of every operation, or
+        C{None} for no deadline.  An operation that misses its
+        deadline is cancelled and fails with L{error.TimeoutError}.
+    @ivar listener: the L{NotifyListener} watching the mapping device
+        for reboots, or C{None}.
+    @ivar stunServers: a list of C{(host, port)} tuples of STUN
+        servers asked for the external address at the same time as
+        the mapping device.  Behind a carrier grade NAT they answer
+        the address of the carrier, not the one of the device.
+    @ivar cacheTime: seconds the external address is remembered.
+    @ivar internalHost: the internal address of the host, once
+        discovered.
+    @ivar reactor: the reactor used for timeouts, timers and the
+        traffic of the reactor itself.  The mapper is built by the
+        factory, which must be given the same reactor.
+    @ivar uplinks: a list of C{(interface, address, gateway)} tuples
+        of the uplinks of the host, as returned by
+        L{discoverUplinks}, or C{None} until they are looked up.
+    @ivar uplinkFactory: called with the address and gateway of an
+        uplink and the reactor to build the instance factory of the
+        mapper of the uplink.
+    @ivar uplinkMappers: a dictionary mapping the addresses of the
+        uplinks to the L{DeferredSingleton} of their mappers.
+    @ivar feed: the L{MappingFeed} that the changes of the managed
+        mappings are reported to; see L{addObserver}.
+    @ivar mapped: a dictionary mapping the keys of the internal
+        addresses mapped with L{mapAddress} to tuples of the internal
+        and external address.
+    """
+
+    def __init__(self, factory, timeout=None, stunServers=(), cacheTime=300,
+                 autoPrewarm=False, reactor=reactor, uplinks=None,
+                 uplinkFactory=UplinkMapperFactory):
+        self.reactor = reactor
+        self.uplinks = uplinks
+        self.uplinkFactory = uplinkFactory
+        self.uplinkMappers = {}
+        self.singleton = DeferredSingleton(
+            WatchedMapperFactory(factory, self.mapperLost))
+        self.feed = MappingFeed()
+        self.mapped = {}
+        self.reconciler = Reconciler(self.singleton, feed=self.feed)
+        self.timeout = timeout
+        self.listener = None
+        self.stunServers = stunServers
+        self.cacheTime = cacheTime
+        self.externalHost = None
+        self.externalHostExpires = None
+        self.internalHost = None
+        self.internalHostWaiters = list()
+        if (isinstance(factory, MapperInstanceFactory)
+                and factory.lookupInternalHost is None):
+            factory.lookupInternalHost = self.discoverInternalHost
+        if autoPrewarm:
+            self.reactor.callWhenRunning(self.prewarm)
+
+    def addObserver(self, observer):
+        """
+        Register an L{IMappingObserver} provider to be told when the
+        managed mappings are added, lost or restored, or the external
+        address changes.  The mappings made with L{mapAddress} and
+        L{mapListeningPort} are reported as added, and as lost and
+        restored when the mapping device reboots.  The mappings
+        registered with L{registerMapping} are reported as restored
+        once the reconciler has put them back.
+        """
+        self.feed.addObserver(observer)
+
+    def removeObserver(self, observer):
+        """
+        Unregister an L{IMappingObserver} provider.
+        """
+        self.feed.removeObserver(observer)
+
+    def prewarm(self):
+        """
+        Discover the mapper, the internal address and the external
+        address in the background, all at once, so that they are
+        ready when the first port is mapped.
+
+        @return: a deferred called when all are done, whether they
+            succeeded or not.
+        """
+        def eb(reason, what):
+            log.msg("prewarming %s failed: %s" % (
+                what, reason.getErrorMessage()))
+        d = defer.DeferredList([
+            self.singleton.get().addErrback(eb, 'mapper'),
+            self.discoverInternalHost().addErrback(eb, 'internal address'),
+            self.discoverExternalHost().addErrback(eb, 'external address')])
+        return d.addCallback(lambda result: None)
+
+    def discoverInternalHost(self):
+        """
+        Discover the internal address of the host.  It is remembered
+        once found, and callers that ask while it is being looked up
+        share the lookup.
+
+        @return: a deferred called with the internal address.
+        """
+        if self.internalHost is not None:
+            return defer.succeed(self.internalHost)
+        d = defer.Deferred()
+        self.internalHostWaiters.append(d)
+        if len(self.internalHostWaiters) == 1:
+            discoverInternalHost(self.reactor).addBoth(self._cbInternalHost)
+        return d
+
+    def _cbInternalHost(self, result):
+        if not isinstance(result, failure.Failure):
+            self.internalHost = result
+        waiters, self.internalHostWaiters = self.internalHostWaiters, list()
+        for waiter in waiters:
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    def getUplinks(self):
+        """
+        Return the uplinks of the host, looking them up the first time.
+        """
+        if self.uplinks is None:
+            self.uplinks = discoverUplinks()
+        return self.uplinks
+
+    def mapperFor(self, host):
+        """
+        Return the L{DeferredSingleton} of the mapper that serves the
+        internal address C{host}.
+
+        On a multi-homed host an address of an uplink is mapped by the
+        mapping device behind that uplink, which is discovered on its
+        interface.  Every other address, and every address on a host
+        with a single uplink, is mapped by the mapper of the factory.
+        """
+        uplinks = self.getUplinks()
+        if len(uplinks) < 2:
+            return self.singleton
+        for name, address, gateway in uplinks:
+            if address == host:
+                singleton = self.uplinkMappers.get(address)
+                if singleton is None:
+                    singleton = DeferredSingleton(self.uplinkFactory(
+                        address, gateway, self.reactor))
+                    self.uplinkMappers[address] = singleton
+                return singleton
+        return self.singleton
 
-    def __init__(self, factory):
-        self.singleton = DeferredSingleton(factory)
     def ensureInternalAddress(self, address):
         """
         Ensure that address is a valid internal address and if not
@@ -64,48 +327,100 @@ class MapperReactor:
                 return IPv4Address(
                     address.type, internalHost, address.port
                     )
-            return discoverInternalHost().addCallback(cb)
+            return self.discoverInternalHost().addCallback(cb)
 
         return defer.succeed(address)
 
     def discoverExternalHost(self):
         """
+        Discover the external IP address.
+
+        The mapping device and the STUN servers are asked at the
+        same time, and the first answer is used and remembered for
+        L{cacheTime} seconds.
+
+        @return: a deferred called with the external address.
         """
-        def cb(mapper):
+        if (self.externalHost is not None
+                and self.reactor.seconds() < self.externalHostExpires):
+            return defer.succeed(self.externalHost)
+
+        def cbMapper(mapper):
             return mapper.discoverExternalHost()
-        return self.singleton.get().addCallback(cb)
+        attempts = [self.singleton.get().addCallback(cbMapper)]
+        if self.stunServers:
+            attempts.append(stun.discoverExternalHost(
+                self.stunServers, reactor=self.reactor))
+
+        def cb(externalHost):
+            self.externalHost = externalHost
+            self.externalHostExpires = self.reactor.seconds() + self.cacheTime
+            self.feed.externalHostSeen(externalHost)
+            return externalHost
+        return timeoutDeferred(race(attempts).addCallback(cb), self.timeout,
+                               self.reactor)
 
-    def mapAddress(self, address):
+    def mapAddress(self, address, trace=tracing.NULL):
         """
         Map internal address C{address} to an external address.
 
         @type address: L{IPv4Address}
+        @param trace: a L{natmap.trace.Trace} for the operation.
         @return: a deferred called with the external address.
         """
         def cb(mapper):
-            return mapper.map(address)
-        return self.singleton.get().addCallback(cb)
+            # Only pass the trace on when tracing, so that mappers
+            # that do not take one keep working.
+            if trace is tracing.NULL:
+                return mapper.map(address)
+            return mapper.map(address, trace=trace)
+        def cbMapped(externalAddress):
+            self.mapped[addressKey(address)] = (address, externalAddress)
+            self.feed.mappingAdded(address, externalAddress)
+            return externalAddress
+        d = trace.span('getMapper', self.mapperFor(
+            address.host).get()).addCallback(cb).addCallback(cbMapped)
+        return timeoutDeferred(d, self.timeout, self.reactor)
 
     def unmapAddress(self, address):
         """
         Unmap internal address C{address}.
 
+        The external port of a mapping made with L{mapAddress} is
+        known, so the mapper is asked to delete it directly, if it
+        can, rather than to look it up in the table.
+
         @type address: L{IPv4Address}
         """
+        entry = self.mapped.get(addressKey(address))
         def cb(mapper):
+            if entry is not None and hasattr(mapper, 'unmapFrom'):
+                internalAddress, externalAddress = entry
+                return mapper.unmapFrom(address, externalAddress.port)
             return mapper.unmap(address)
-        return self.singleton.get().addCallback(cb)
+        def cbUnmapped(result):
+            self.mapped.pop(addressKey(address), None)
+            return result
+        return timeoutDeferred(self.mapperFor(address.host).get(
+            ).addCallback(cb).addCallback(cbUnmapped), self.timeout,
+            self.reactor)
 
     def mapListeningPort(self, listeningPort):
         """
         Map listening port.
 
+        If a tracer is installed with L{natmap.trace.setTracer} a span
+        is reported for every phase of the operation.
+
         @type listeningPort: L{IListeningPort} provider.
         """
+        trace = tracing.start('mapListeningPort')
+
         def cb(address):
-            return self.mapAddress(address)
-        return self.ensureInternalAddress(
-            listeningPort.getHost()).addCallback(cb)
+            return self.mapAddress(address, trace)
+        d = trace.span('ensureInternalAddress', self.ensureInternalAddress(
+            listeningPort.getHost())).addCallback(cb)
+        return trace.finish(timeoutDeferred(d, self.timeout, self.reactor))
     
     def unmapListeningPort(self, listeningPort):
         """
@@ -115,5 +430,223 @@ class MapperReactor:
         """
         def cb(address):
             return self.unmapAddress(address)
-        return self.ensureInternalAddress(
-            listeningPort.getHost()).addCallback(cb)
+        return timeoutDeferred(self.ensureInternalAddress(
+            listeningPort.getHost()).addCallback(cb), self.timeout,
+            self.reactor)
+
+    def _uplinkAddresses(self, listeningPort):
+        address = listeningPort.getHost()
+        uplinks = self.getUplinks()
+        if len(uplinks) < 2 or address.host not in ('0.0.0.0', ''):
+            return self.ensureInternalAddress(address).addCallback(
+                lambda address: [address])
+        return defer.succeed([IPv4Address(address.type, uplink, address.port)
+                              for name, uplink, gateway in uplinks])
+
+    def _onUplinks(self, listeningPort, operation, what):
+        def cbResults(results, addresses):
+            done = {}
+            for address, (success, result) in zip(addresses, results):
+                if success:
+                    done[address.host] = result
+                else:
+                    log.msg("%s %s failed: %s" % (
+                        what, address.host, result.getErrorMessage()))
+            return done
+        def cb(addresses):
+            d = defer.DeferredList([operation(address)
+                                    for address in addresses],
+                                   consumeErrors=True)
+            return d.addCallback(cbResults, addresses)
+        return self._uplinkAddresses(listeningPort).addCallback(cb)
+
+    def mapListeningPortOnAllUplinks(self, listeningPort):
+        """
+        Map a listening port on every uplink of a multi-homed host at
+        once, if it is bound to the wildcard address.  A port bound to
+        one address, or on a host with a single uplink, is mapped
+        like L{mapListeningPort}.
+
+        @type listeningPort: L{IListeningPort} provider.
+        @return: a deferred called with a dictionary mapping the
+            internal addresses the port was mapped for to the external
+            addresses.  Uplinks on which the mapping failed are left
+            out.
+        """
+        return self._onUplinks(listeningPort, self.mapAddress, "mapping on")
+
+    def unmapListeningPortOnAllUplinks(self, listeningPort):
+        """
+        Unmap a listening port mapped with
+        L{mapListeningPortOnAllUplinks}.
+
+        @type listeningPort: L{IListeningPort} provider.
+        """
+        d = self._onUplinks(listeningPort, self.unmapAddress, "unmapping on")
+        return d.addCallback(lambda result: None)
+
+    def registerMapping(self, address):
+        """
+        Register C{address} as a mapping that should be kept in place.
+        Unlike L{mapAddress} the mapping is restored if it is lost,
+        for example when the mapping device reboots, as long as
+        L{startReconciling} has been called.
+
+        @type address: L{IPv4Address}
+        @return: a deferred called with the external address.
+        """
+        def cb(address):
+            return self.reconciler.register(address)
+        return self.ensureInternalAddress(address).addCallback(cb)
+
+    def unregisterMapping(self, address):
+        """
+        Unregister C{address} and remove its mapping.
+
+        @type address: L{IPv4Address}
+        """
+        def cb(address):
+            return self.reconciler.unregister(address)
+        return self.ensureInternalAddress(address).addCallback(cb)
+
+    def startReconciling(self, interval=None):
+        """
+        Start checking the mapping device periodically and reconcile
+        it against the registered mappings when it has changed.
+
+        @param interval: seconds between checks.
+        """
+        if interval is not None:
+            self.reconciler.interval = interval
+        self.reconciler.start(self.reactor)
+
+    def stopReconciling(self):
+        """
+        Stop checking the mapping device.
+        """
+        self.reconciler.stop()
+
+    def startWatching(self, interface=''):
+        """
+        Listen for the SSDP notifications of the mapping device.  When
+        it reboots, the mapper is discovered anew and the registered
+        mappings are restored right away, instead of at the next
+        check of the reconciler.
+        """
+        if self.listener is None:
+            self.listener = NotifyListener(self.gatewayRebooted,
+                                           reactor=self.reactor)
+            self.listener.listen(interface)
+            self._watchMapper()
+
+    def stopWatching(self):
+        """
+        Stop listening for the notifications of the mapping device.
+        """
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            return listener.stopListening()
+
+    def _watchMapper(self):
+        def cb(mapper):
+            if self.listener is not None:
+                self.listener.watch(gatewayHost(mapper))
+        self.singleton.get().addCallbacks(cb, log.err)
+
+    def gatewayRebooted(self):
+        """
+        Called when the mapping device has rebooted.  Forget the
+        mapper, which may no longer be valid, and restore both the
+        registered mappings and those made with L{mapAddress}.
+
+        @return: a deferred called when the mappings are restored, or
+            have failed to be.
+        """
+        self.singleton.reset()
+        for singleton in self.uplinkMappers.values():
+            singleton.reset()
+        self.externalHost = None
+        self.internalHost = None
+        d = self.restoreMappings()
+        # The listener keeps watching the device it was watching,
+        # unless restoring the mappings has discovered the mapper.
+        if self.singleton.building or self.singleton.instance is not None:
+            self._watchMapper()
+        return d
+
+    def mapperLost(self, mapper):
+        """
+        Called when C{mapper} can no longer be used, such as when the
+        connection to the mapping daemon is lost.  Forget it, so that
+        a mapper is discovered anew, and restore both the registered
+        mappings and those made with L{mapAddress} through the new
+        one.
+
+        @return: a deferred called when the mappings are restored, or
+            have failed to be.
+        """
+        if self.singleton.instance is not mapper:
+            return defer.succeed(None)
+        log.msg("lost the mapper, discovering it anew")
+        self.singleton.reset()
+        return self.restoreMappings()
+
+    def restoreMappings(self):
+        """
+        Restore the mappings after they have been lost with the
+        mapper.  The registered mappings are reconciled, and the
+        addresses mapped with L{mapAddress} mapped again; those are
+        reported as lost, and as restored once mapped again.  The
+        previous external port is asked for first, if the mapper
+        allows it.  Those that cannot be mapped again are forgotten.
+        Nothing is done, and no mapper discovered, if there are no
+        mappings to restore.
+
+        @return: a deferred called when done.
+        """
+        mapped, self.mapped = self.mapped, {}
+        calls = list()
+        if self.reconciler.desired or self.reconciler.unwanted:
+            calls.append(self.reconciler.reconcile().addErrback(log.err))
+        if not calls and not mapped:
+            return defer.succeed(None)
+        for internalAddress, externalAddress in mapped.values():
+            self.feed.mappingLost(internalAddress, externalAddress)
+            calls.append(self._restore(internalAddress,
+                                       externalAddress.port))
+        return defer.DeferredList(calls).addCallback(lambda result: None)
+
+    def _restore(self, address, externalPort):
+        def cb(mapper):
+            if not hasattr(mapper, 'mapTo'):
+                return mapper.map(address)
+            return mapper.mapTo(address, externalPort).addErrback(
+                lambda reason: mapper.map(address))
+        def cbMapped(externalAddress):
+            self.mapped[addressKey(address)] = (address, externalAddress)
+            self.feed.mappingRestored(address, externalAddress)
+        def eb(reason):
+            log.err(reason, "failed to restore the mapping of %s:%d" % (
+                address.host, address.port))
+        d = self.mapperFor(address.host).get().addCallback(cb)
+        return timeoutDeferred(d, self.timeout, self.reactor).addCallbacks(
+            cbMapped, eb)
+
+    def sweepStaleMappings(self):
+        """
+        Delete mappings left behind by dead processes, as recorded in
+        the journal of the mapper.  Meant to be called at startup.
+        The UPnP mappers discovered by default all record to the
+        journal at L{natmap.sweep.DEFAULT_JOURNAL}, which the
+        C{NATMAP_JOURNAL} environment variable overrides.  A mapper
+        without a journal is not swept.
+
+        @return: a deferred called with the number of deleted
+            mappings.
+        """
+        def cb(mapper):
+            journal = getattr(mapper, 'journal', None)
+            if journal is None:
+                return 0
+            return sweepStaleMappings(mapper, journal)
+        return self.singleton.get().addCallback(cb)
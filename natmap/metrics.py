@@ -0,0 +1,237 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Collection of call counts, latencies and fault rates for the
+# traffic exchanged with mapping devices.
+
+from zope.interface import implements
+
+from twisted.python import log
+
+from natmap.inatmap import IMetricsObserver
+
+import time
+
+
+# Upper bounds, in seconds, of the latency histogram buckets.  The
+# last bucket catches everything slower.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0)
+
+
+observers = list()
+
+
+def addObserver(observer):
+    """
+    Register an L{IMetricsObserver} provider.
+    """
+    observers.append(observer)
+
+
+def removeObserver(observer):
+    """
+    Unregister an L{IMetricsObserver} provider.
+    """
+    observers.remove(observer)
+
+
+def _notify(name, *args):
+    for observer in list(observers):
+        try:
+            getattr(observer, name)(*args)
+        except:
+            log.err(None, "metrics observer failed")
+
+
+def timeCall(gateway, action, deferred):
+    """
+    Report the completion of the remote call behind C{deferred} to
+    the registered observers.
+
+    @return: C{deferred}
+    """
+    if not observers:
+        return deferred
+    started = time.time()
+
+    def cb(result):
+        _notify('callCompleted', gateway, action, time.time() - started,
+                None)
+        return result
+
+    def eb(reason):
+        _notify('callCompleted', gateway, action, time.time() - started,
+                reason)
+        return reason
+    return deferred.addCallbacks(cb, eb)
+
+
+def discoveryPhaseCompleted(phase, started, reason=None):
+    """
+    Report that discovery phase C{phase}, started at time C{started},
+    has completed.
+    """
+    if observers:
+        _notify('discoveryPhaseCompleted', phase, time.time() - started,
+                reason)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+
+    @ivar counts: the number of samples per bucket in L{BUCKETS}, plus
+        one for samples slower than the last bucket.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        for index, bound in enumerate(BUCKETS):
+            if latency <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, fraction):
+        """
+        Return the upper bound of the bucket holding the given
+        percentile, or C{None} if there are no samples.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index < len(BUCKETS):
+                    return BUCKETS[index]
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': (self.total / self.count) if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': zip(BUCKETS + (None,), self.counts),
+            }
+
+
+class CallStats:
+    """
+    Counters and latency histogram of one action on one gateway.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.faults = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def add(self, latency, reason):
+        from natmap.soap import SOAPFault
+        self.calls += 1
+        if reason is not None:
+            if reason.check(SOAPFault):
+                self.faults += 1
+            else:
+                self.errors += 1
+        self.latency.add(latency)
+
+    def snapshot(self):
+        return {'calls': self.calls, 'faults': self.faults,
+                'errors': self.errors, 'latency': self.latency.snapshot()}
+
+
+class Metrics:
+    """
+    L{IMetricsObserver} that keeps counters and latency histograms per
+    gateway and action, and per discovery phase.
+
+    @ivar calls: a dictionary mapping C{(gateway, action)} tuples to
+        L{CallStats}.
+    @ivar discovery: a dictionary mapping phase names to
+        L{CallStats}.
+    """
+    implements(IMetricsObserver)
+
+    def __init__(self):
+        self.calls = {}
+        self.discovery = {}
+
+    def callCompleted(self, gateway, action, latency, reason):
+        stats = self.calls.get((gateway, action))
+        if stats is None:
+            stats = self.calls[(gateway, action)] = CallStats()
+        stats.add(latency, reason)
+
+    def discoveryPhaseCompleted(self, phase, latency, reason):
+        stats = self.discovery.get(phase)
+        if stats is None:
+            stats = self.discovery[phase] = CallStats()
+        stats.add(latency, reason)
+
+    def snapshot(self):
+        """
+        Return the collected metrics as a dictionary of plain values:
+        C{'gateways'} maps each gateway to a dictionary of action
+        statistics, and C{'discovery'} maps each discovery phase to
+        its statistics.
+        """
+        gateways = {}
+        for (gateway, action), stats in self.calls.iteritems():
+            gateways.setdefault(gateway, {})[action] = stats.snapshot()
+        return {
+            'gateways': gateways,
+            'discovery': dict((phase, stats.snapshot()) for phase, stats
+                              in self.discovery.iteritems()),
+            }
+
+    def reset(self):
+        self.calls.clear()
+        self.discovery.clear()
+
+
+def collect():
+    """
+    Create a L{Metrics} collector and register it.
+
+    @return: the L{Metrics} instance.
+    """
+    metrics = Metrics()
+    addObserver(metrics)
+    return metrics
@@ -0,0 +1,139 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Passive detection of mapping device reboots.  A device announces
+# itself on the SSDP multicast group with ssdp:alive notifications,
+# and says goodbye with ssdp:byebye.  UPnP 1.1 devices also send a
+# BOOTID that is increased on every boot.  A device that comes back
+# after a goodbye, or with a new BOOTID, has been rebooted and has
+# lost its mappings.
+
+from natmap.protocol import (
+    SSDP_MCAST, SSDP_PORT, BadResponseError, parseNotify, deviceOfUSN)
+
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+
+import socket
+import urlparse
+
+
+def gatewayHost(mapper):
+    """
+    Return the IP address of the device behind C{mapper}, or C{None}
+    if it cannot be told.
+    """
+    url = getattr(getattr(mapper, 'proxy', None), 'url', None)
+    if url is None:
+        return None
+    return urlparse.urlparse(url).hostname
+
+
+class NotifyListener(DatagramProtocol):
+    """
+    Listens for SSDP notifications and calls C{rebooted} when the
+    device at C{gatewayHost} has been rebooted.
+
+    @ivar gatewayHost: the IP address of the watched device.  Only
+        the notifications of devices announced from this address are
+        considered.
+    @ivar bootIDs: a dictionary mapping the unique device names of the
+        watched device to their last seen BOOTID, or C{None} for
+        devices that do not send one.
+    @ivar departed: the unique device names of the watched device that
+        have said goodbye.
+    """
+
+    def __init__(self, rebooted, gatewayHost=None, reactor=reactor):
+        self.rebooted = rebooted
+        self.reactor = reactor
+        self.gatewayHost = gatewayHost
+        self.bootIDs = {}
+        self.departed = set()
+        self.listeningPort = None
+
+    def watch(self, gatewayHost):
+        """
+        Watch the device at C{gatewayHost} instead.
+        """
+        if gatewayHost != self.gatewayHost:
+            self.gatewayHost = gatewayHost
+            self.bootIDs.clear()
+            self.departed.clear()
+
+    def listen(self, interface=''):
+        """
+        Start listening for notifications.
+        """
+        self.listeningPort = self.reactor.listenMulticast(
+            SSDP_PORT, self, interface=interface, listenMultiple=True)
+        self.listeningPort.joinGroup(SSDP_MCAST,
+                                     interface or socket.INADDR_ANY)
+        return self.listeningPort
+
+    def stopListening(self):
+        """
+        Stop listening for notifications.
+        """
+        listeningPort, self.listeningPort = self.listeningPort, None
+        if listeningPort is not None:
+            return listeningPort.stopListening()
+
+    def datagramReceived(self, data, address):
+        """
+        Process a notification.
+        """
+        try:
+            headers = parseNotify(data)
+        except BadResponseError:
+            return
+        usn = headers.get('usn')
+        if usn is None:
+            return
+        device = deviceOfUSN(usn)
+        kind = headers.get('nts')
+
+        if kind == 'ssdp:byebye':
+            if device in self.bootIDs:
+                self.departed.add(device)
+            return
+        if kind != 'ssdp:alive':
+            return
+
+        location = headers.get('location')
+        if location is None or self.gatewayHost is None:
+            return
+        if urlparse.urlparse(location).hostname != self.gatewayHost:
+            return
+
+        bootID = headers.get('bootid.upnp.org')
+        if device not in self.bootIDs:
+            self.bootIDs[device] = bootID
+            return
+
+        previous = self.bootIDs[device]
+        self.bootIDs[device] = bootID
+        if device in self.departed or previous != bootID:
+            self.departed.discard(device)
+            self.rebooted()
@@ -0,0 +1,356 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# The UPnP IGD protocol logic that does not depend on any event
+# loop: building and parsing SSDP messages, device descriptions and
+# SOAP envelopes, and port mapping bookkeeping.  natmap.upnp and
+# natmap.soap drive it with Twisted; other front ends can reuse it
+# with their own I/O.
+
+from xml.etree.ElementTree import tostring, fromstring
+
+from natmap.xmlbuilder import Namespace, LocalNamespace
+
+import random
+import re
+import urlparse
+
+
+ENV = Namespace("http://schemas.xmlsoap.org/soap/envelope/", "s")
+
+# UPNP multicast address, port and request string
+SSDP_MCAST = '239.255.255.250'
+SSDP_PORT = 1900
+
+
+def searchRequest(host=SSDP_MCAST, port=SSDP_PORT):
+    """
+    Build an M-SEARCH request for Internet gateway devices.
+
+    @param host: the address the request is sent to.  A request that
+        is not sent to the multicast group is a unicast search, which
+        carries no C{MX} header.
+    """
+    lines = ['M-SEARCH * HTTP/1.1',
+             'Host:%s:%s' % (host, port),
+             'ST:urn:schemas-upnp-org:device:InternetGatewayDevice:1',
+             'Man:"ssdp:discover"']
+    if host == SSDP_MCAST:
+        lines.append('MX:3')
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+SEARCH_REQUEST = searchRequest()
+
+WAN_SERVICES = ['urn:schemas-upnp-org:service:WANIPConnection:1',
+                'urn:schemas-upnp-org:service:WANPPPConnection:1']
+
+DEVICE_NS = '{urn:schemas-upnp-org:device-1-0}'
+
+
+class BadResponseError(Exception):
+    pass
+
+
+class SOAPFault(Exception):
+    """
+    Representation of a fault raised by the remote host.
+
+    """
+
+    def __init__(self, faultString, faultDetail):
+        self.faultString = faultString
+        self.faultDetail = faultDetail
+
+
+def iterrandrange(n, start, stop):
+    return (random.randint(start, stop) for i in range(n))
+
+
+def parseSearchResponse(data):
+    """
+    Parse HTTP response.
+    
+    Return a tuple of response code, dictionary of headers and the
+    response content body.
+    """
+    firstline = True
+    headers = {}
+
+    try:
+        while data:
+            line, data = data.split('\r\n', 1)
+            if firstline:
+                version, code, status = line.split(' ', 2)
+                if version != 'HTTP/1.1' and version != 'HTTP/1.0':
+                    raise BadResponseError("bad http version")
+
+                if code != '200':
+                    raise BadResponseError("bad response code")
+
+                firstline = False
+            elif not line:
+                break
+            else:
+                key, value = line.split(':', 1)
+                headers[key.lower()] = value.strip()
+    except ValueError:
+        raise BadResponseError("malformed response")
+
+    if firstline is True:
+        raise BadResponseError("no response line")
+
+    return code, headers, data
+
+
+def parseNotify(data):
+    """
+    Parse an SSDP C{NOTIFY} message.
+
+    @return: a dictionary of the headers, with lower case keys.
+    @raise BadResponseError: if C{data} is not a C{NOTIFY} message.
+    """
+    lines = data.split('\r\n')
+    if not lines[0].startswith('NOTIFY '):
+        raise BadResponseError("not a notification")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            break
+        try:
+            key, value = line.split(':', 1)
+        except ValueError:
+            raise BadResponseError("malformed header")
+        headers[key.strip().lower()] = value.strip()
+    return headers
+
+
+def deviceOfUSN(usn):
+    """
+    Return the unique device name that the unique service name
+    C{usn} belongs to.
+    """
+    return usn.split('::', 1)[0]
+
+
+def parseDescription(data, location):
+    """
+    Find the WAN connection service in a device description.
+
+    @param location: the URL the description was fetched from, used
+        when the description has no C{URLBase}.
+    @return: a tuple of the control URL and the service type.
+    @raise BadResponseError: if the device has no WAN connection
+        service.
+    """
+    document = fromstring(data)
+
+    # iterate through all provided services and try to find the
+    # control URL.
+    for serviceElement in document.findall('.//%sservice' % DEVICE_NS):
+        serviceType = serviceElement.findtext(DEVICE_NS + 'serviceType')
+        if serviceType in WAN_SERVICES:
+            controlURL = serviceElement.findtext(DEVICE_NS + 'controlURL')
+            if controlURL is not None:
+                break
+    else:
+        raise BadResponseError("no WAN connection service")
+
+    baseURL = document.findtext(DEVICE_NS + 'URLBase') or location
+    return urlparse.urljoin(baseURL, controlURL), serviceType
+
+
+def buildEnvelope(element):
+    """
+    Build a SOAP envelope around C{element}.
+    """
+    element = ENV['Envelope'](ENV['Body'](element))
+    element.set(ENV['encodingStyle'],
+                "http://schemas.xmlsoap.org/soap/encoding/")
+    return element
+
+
+def buildRequest(namespace, method, arguments):
+    """
+    Build the request for a call to C{method} of the service
+    C{namespace}.
+
+    @return: a tuple of the body and a dictionary of HTTP headers.
+    """
+    methodElement = namespace[method]()
+    for name, value in arguments.iteritems():
+        methodElement.append(
+            LocalNamespace[name](str(value))
+            )
+
+    headers = {
+        'Content-Type': 'text/xml',
+        'SOAPAction': '%s#%s' % (namespace.uri, method)
+        }
+
+    envelope = buildEnvelope(methodElement)
+    return '<?xml version="1.0"?>' + tostring(envelope), headers
+
+
+def parseResponse(data):
+    """
+    Parse the response to a call.
+
+    @return: a dictionary of the returned arguments.
+    """
+    document = fromstring(data)
+    try:
+        responseElement = document[0][0]
+    except IndexError:
+        raise BadResponseError("no response element")
+    result = {}
+    for childElement in responseElement:
+        result[childElement.tag] = childElement.text
+    return result
+
+
+def parseFault(data):
+    """
+    Parse a fault answered by the remote device.
+
+    @return: a L{SOAPFault}.
+    """
+    try:
+        document = fromstring(data)
+    except Exception, e:
+        # Some devices give bad faults.
+        # Dlink DIR-665 gives a faulty prefix.
+        return SOAPFault('', None)
+
+    faultElement = document.find('.//' + ENV['Fault'])
+    if faultElement is None:
+        return SOAPFault('', None)
+
+    # SOAP 1.1 says the fault children are unqualified, but some
+    # devices qualify them anyway.
+    faultString = faultElement.findtext('faultstring')
+    if faultString is None:
+        faultString = faultElement.findtext(ENV['faultstring'])
+    faultDetail = faultElement.find('detail')
+    if faultDetail is None:
+        faultDetail = faultElement.find(ENV['detail'])
+    return SOAPFault(faultString, faultDetail)
+
+
+_OWNER_TAG = re.compile(r'\[natmap:([^:\]]*):(\d+)\]$')
+
+
+def formatDescription(internalHost, internalPort, type, owner, instance):
+    """
+    Build the description of a port mapping, tagged with the owner
+    and the instance (process ID) that created it.
+    """
+    return "%s:%d (%s) [natmap:%s:%d]" % (internalHost, internalPort, type,
+                                          owner, instance)
+
+
+def parseOwner(description):
+    """
+    Parse the owner tag out of a port mapping description.
+
+    @return: a tuple of the owner and the instance, or C{None} if the
+        description carries no tag.
+    """
+    match = _OWNER_TAG.search(description or '')
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+class Mapping(object):
+    """
+    Object representing a mapping between an internal address and an
+    external address.
+
+    @ivar internalHost: A string containing the internal IP address.
+    @ivar internalPort: An integer representing the internal port
+        number.
+    @ivar externalPort: An integer representing the external port
+        number.
+    @ivar type: A string representing the type of transport, either
+        'TCP' or 'UDP'
+    @ivar description: The description of the mapping, or C{None}.
+    """
+    __slots__ = ('type', 'internalHost', 'internalPort', 'externalPort',
+                 'description')
+
+    def __init__(self, type, internalHost, internalPort,
+                 externalPort, description=None):
+        self.type = type
+        self.internalHost = internalHost
+        self.internalPort = internalPort
+        self.externalPort = externalPort
+        self.description = description
+
+    def matches(self, internalAddress):
+        """
+        Return C{True} if this mapping is directed at the given
+        internal address.
+
+        @param internalAddress: an object with C{type}, C{host} and
+            C{port} attributes, such as L{IPv4Address}.
+        """
+        return (self.type == internalAddress.type
+                and self.internalHost == internalAddress.host
+                and self.internalPort == internalAddress.port)
+
+
+def mappingFromEntry(entry):
+    """
+    Build a L{Mapping} from the arguments returned by
+    C{GetGenericPortMappingEntry}.
+    """
+    return Mapping(entry['NewProtocol'],
+                   entry['NewInternalClient'],
+                   int(entry['NewInternalPort']),
+                   int(entry['NewExternalPort']),
+                   entry.get('NewPortMappingDescription'))
+
+
+def addPortMappingArguments(internalHost, type, internalPort, externalPort,
+                            description, leaseDuration=0):
+    """
+    Build the arguments of an C{AddPortMapping} call.
+    """
+    return dict(
+        NewRemoteHost=" ", NewExternalPort=externalPort, NewProtocol=type,
+        NewInternalPort=internalPort, NewInternalClient=internalHost,
+        NewEnabled=1, NewPortMappingDescription=description,
+        NewLeaseDuration=leaseDuration)
+
+
+def pickExternalPort(type, internalPort, used):
+    """
+    Pick an external port that is not in C{used}, a set of
+    C{(type, externalPort)} tuples.
+    """
+    for port in iterrandrange(20, 1025, 65535):
+        if not (type, port) in used:
+            return port
+    return internalPort
@@ -0,0 +1,400 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Keeps the mapping device in line with a registry of desired
+# mappings.
+
+from natmap.inatmap import NoSuchMappingError
+
+from twisted.internet import defer, task
+from twisted.internet.address import IPv4Address
+from twisted.python import failure, log
+
+
+def addressKey(address):
+    """
+    Return a hashable key for the internal address C{address}.
+    """
+    return (address.type, address.host, address.port)
+
+
+def mappingKey(mapping):
+    """
+    Return the key of the internal address a L{Mapping} is directed
+    at.
+    """
+    return (mapping.type, mapping.internalHost, mapping.internalPort)
+
+
+def hasTable(mapper):
+    """
+    Return true if C{mapper} keeps a mapping table that can be walked,
+    as L{natmap.upnp.UPnPMapper} does.
+    """
+    return hasattr(mapper, 'getMappings')
+
+
+class Reconciler:
+    """
+    Reconcile the mappings of a mapping device with a set of desired
+    mappings.
+
+    Every C{interval} seconds a cheap check is made whether anything
+    has changed on the device, by probing the number of entries in the
+    mapping table and fetching the external address.  Only if the
+    device has changed, or the set of desired mappings has, is the
+    table walked and the missing mappings added and the unwanted
+    mappings deleted.
+
+    Only mappings that have been registered are ever deleted; the
+    reconciler does not touch mappings it does not know about.
+
+    Mappers without a table, such as L{natmap.direct.DirectMapper}
+    and L{natmap.daemon.DaemonMapper}, are trusted to keep a mapping
+    once made.  Only new mappings are made through them, and all are
+    made again when the mapper is replaced by a new one.
+
+    @ivar desired: a dictionary mapping address keys to the internal
+        L{IPv4Address} that should be mapped.
+    @ivar established: a dictionary mapping address keys to the
+        external port last seen for the mapping.  Used to restore a
+        lost mapping on the same external port.
+    @ivar unwanted: a dictionary mapping address keys of mappings
+        that have been unregistered and that should be deleted.
+    @ivar externalHost: the external IP address of the device as
+        seen by the last reconciliation, or C{None}.
+    @ivar fingerprint: a tuple of the number of entries in the table
+        and the external address at the end of the last
+        reconciliation, or C{None}.
+    @ivar feed: a L{MappingFeed} told when a mapping is added, lost
+        or restored, and of the external address, or C{None}.
+    @ivar lost: the address keys of the mappings that have been found
+        missing and are not yet restored.
+    @ivar mapper: the mapper without a table last reconciled, or
+        C{None}.
+    @ivar mapped: the address keys of the mappings made through
+        L{mapper}.
+    """
+
+    def __init__(self, singleton, interval=60, concurrency=4, feed=None):
+        self.singleton = singleton
+        self.interval = interval
+        self.concurrency = concurrency
+        self.feed = feed
+        self.desired = {}
+        self.established = {}
+        self.lost = set()
+        self.mapper = None
+        self.mapped = set()
+        self.unwanted = {}
+        self.externalHost = None
+        self.fingerprint = None
+        self.dirty = False
+        self.running = False
+        self.waiters = list()
+        self.loop = None
+
+    def register(self, address):
+        """
+        Register internal address C{address} as desired.
+
+        @return: a deferred called with the external address when the
+            device has been reconciled, or C{None} if the mapping
+            could not be established.
+        """
+        key = addressKey(address)
+        self.unwanted.pop(key, None)
+        self.desired[key] = address
+
+        def cb(result):
+            externalPort = self.established.get(key)
+            if externalPort is None or self.externalHost is None:
+                return None
+            return IPv4Address(address.type, self.externalHost,
+                               externalPort)
+        return self.reconcile().addCallback(cb)
+
+    def unregister(self, address):
+        """
+        Unregister internal address C{address}.  The mapping is
+        deleted from the device.
+
+        @return: a deferred called when the device has been
+            reconciled.
+        """
+        key = addressKey(address)
+        if self.desired.pop(key, None) is not None:
+            self.unwanted[key] = address
+            self.established.pop(key, None)
+            self.lost.discard(key)
+        return self.reconcile()
+
+    def externalPort(self, address):
+        """
+        Return the external port last established for the internal
+        address C{address}, or C{None}.
+        """
+        return self.established.get(addressKey(address))
+
+    def start(self, clock=None):
+        """
+        Start checking the device periodically.
+        """
+        if self.loop is None:
+            self.loop = task.LoopingCall(self._tick)
+            if clock is not None:
+                self.loop.clock = clock
+            self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        """
+        Stop checking the device.
+        """
+        loop, self.loop = self.loop, None
+        if loop is not None and loop.running:
+            loop.stop()
+
+    def _tick(self):
+        return self.check().addErrback(log.err)
+
+    def check(self):
+        """
+        Check whether the device has changed and reconcile if so.
+
+        @return: a deferred called when done.
+        """
+        if self.running:
+            return defer.succeed(None)
+        if self.dirty or self.fingerprint is None:
+            return self.reconcile()
+
+        count, externalHost = self.fingerprint
+
+        def cbCount(unchanged, mapper):
+            if not unchanged:
+                return self.reconcile()
+            return mapper.discoverExternalHost().addCallback(cbHost)
+
+        def cbHost(host):
+            if host != externalHost:
+                return self.reconcile()
+
+        def cbMapper(mapper):
+            if not hasTable(mapper):
+                if mapper is not self.mapper:
+                    return self.reconcile()
+                return mapper.discoverExternalHost().addCallback(cbHost)
+            return mapper.hasMappingCount(count).addCallback(
+                cbCount, mapper)
+
+        return self.singleton.get().addCallback(cbMapper)
+
+    def reconcile(self):
+        """
+        Walk the mapping table and bring it in line with the desired
+        mappings.
+
+        @return: a deferred called when done.
+        """
+        d = defer.Deferred()
+        self.waiters.append(d)
+        self.dirty = True
+        if not self.running:
+            self._run()
+        return d
+
+    def _run(self):
+        self.running = True
+        self.dirty = False
+        d = self.singleton.get().addCallback(self._reconcile)
+        d.addBoth(self._done)
+
+    def _done(self, result):
+        if self.dirty:
+            return self._run()
+        self.running = False
+        waiters, self.waiters = self.waiters, list()
+        for waiter in waiters:
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(None)
+
+    @defer.inlineCallbacks
+    def _reconcile(self, mapper):
+        """
+        Diff the mapping table against the desired mappings and issue
+        the calls needed to bring them in line.
+        """
+        if not hasTable(mapper):
+            yield self._reconcileWithoutTable(mapper)
+            return
+        mappings = yield mapper.getMappings()
+        externalHost = yield mapper.discoverExternalHost()
+        previousHost, self.externalHost = self.externalHost, externalHost
+        if self.feed is not None:
+            self.feed.externalHostSeen(externalHost)
+
+        present = {}
+        used = set()
+        for mapping in mappings:
+            present[mappingKey(mapping)] = mapping
+            used.add((mapping.type, mapping.externalPort))
+
+        calls = list()
+        for key, address in self.desired.items():
+            mapping = present.get(key)
+            if mapping is not None:
+                if key not in self.established:
+                    self._changed('mappingAdded', address,
+                                  mapping.externalPort)
+                elif key in self.lost:
+                    self.lost.discard(key)
+                    self._changed('mappingRestored', address,
+                                  mapping.externalPort)
+                self.established[key] = mapping.externalPort
+                continue
+            externalPort = self.established.get(key)
+            if externalPort is not None and key not in self.lost:
+                self.lost.add(key)
+                self._changed('mappingLost', address, externalPort,
+                              previousHost)
+            if (externalPort is None
+                    or (address.type, externalPort) in used):
+                externalPort = mapper.pickExternalPort(
+                    address.type, address.port, used)
+            used.add((address.type, externalPort))
+            calls.append((self._add, mapper, key, address, externalPort))
+
+        for key in self.unwanted.keys():
+            mapping = present.get(key)
+            if mapping is None:
+                del self.unwanted[key]
+                continue
+            calls.append((self._delete, mapper, key, mapping))
+
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        results = yield defer.DeferredList(
+            [semaphore.run(*call) for call in calls])
+
+        # A failed call leaves the fingerprint unset, so that the
+        # next check walks the table again.
+        count = len(mappings)
+        for success, delta in results:
+            if delta is None:
+                count = None
+                break
+            count += delta
+        if count is None:
+            self.fingerprint = None
+        else:
+            self.fingerprint = (count, externalHost)
+
+    @defer.inlineCallbacks
+    def _reconcileWithoutTable(self, mapper):
+        """
+        Make the desired mappings that have not been made through
+        C{mapper}, and remove the unwanted ones.
+        """
+        externalHost = yield mapper.discoverExternalHost()
+        self.externalHost = externalHost
+        if self.feed is not None:
+            self.feed.externalHostSeen(externalHost)
+        if mapper is not self.mapper:
+            self.mapper = mapper
+            self.mapped = set()
+
+        calls = list()
+        for key, address in self.desired.items():
+            if key not in self.mapped:
+                calls.append(self._map(mapper, key, address))
+        for key, address in self.unwanted.items():
+            calls.append(self._unmap(mapper, key, address))
+        results = yield defer.DeferredList(calls)
+
+        if [delta for success, delta in results if delta is None]:
+            self.fingerprint = None
+        else:
+            self.fingerprint = (None, externalHost)
+
+    def _map(self, mapper, key, address):
+        def cb(externalAddress):
+            restored = key in self.established
+            self.established[key] = externalAddress.port
+            self.mapped.add(key)
+            self.lost.discard(key)
+            if restored:
+                self._changed('mappingRestored', address,
+                              externalAddress.port, externalAddress.host)
+            else:
+                self._changed('mappingAdded', address,
+                              externalAddress.port, externalAddress.host)
+            return 1
+        def eb(reason):
+            log.err(reason, "failed to map %s:%d" % (address.host,
+                                                      address.port))
+        return mapper.map(address).addCallbacks(cb, eb)
+
+    def _unmap(self, mapper, key, address):
+        def cb(result):
+            self.unwanted.pop(key, None)
+            self.mapped.discard(key)
+            return -1
+        def eb(reason):
+            if reason.check(NoSuchMappingError):
+                return cb(None)
+            log.err(reason, "failed to unmap %s:%d" % (address.host,
+                                                        address.port))
+        return mapper.unmap(address).addCallbacks(cb, eb)
+
+    def _changed(self, event, address, externalPort, externalHost=None):
+        if self.feed is None:
+            return
+        if externalHost is None:
+            externalHost = self.externalHost
+        getattr(self.feed, event)(address, IPv4Address(
+            address.type, externalHost, externalPort))
+
+    def _add(self, mapper, key, address, externalPort):
+        def cb(externalAddress):
+            self.established[key] = externalPort
+            if key in self.lost:
+                self.lost.discard(key)
+                self._changed('mappingRestored', address, externalPort)
+            else:
+                self._changed('mappingAdded', address, externalPort)
+            return 1
+        def eb(reason):
+            log.err(reason, "failed to map %s:%d" % (address.host,
+                                                      address.port))
+        return mapper.mapTo(address, externalPort).addCallbacks(cb, eb)
+
+    def _delete(self, mapper, key, mapping):
+        def cb(result):
+            self.unwanted.pop(key, None)
+            return -1
+        def eb(reason):
+            log.err(reason, "failed to unmap %s:%d" % (mapping.internalHost,
+                                                        mapping.internalPort))
+        return mapper.deleteMapping(mapping).addCallbacks(cb, eb)
@@ -0,0 +1,263 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Recording and replay of the traffic exchanged with a mapping
+# device.  A Recorder writes every SSDP answer and HTTP exchange,
+# with its timing, as a line of JSON; a Replayer answers the same
+# requests from such a file, without any network traffic, at the
+# recorded speed or a multiple of it.  This makes it possible to
+# benchmark and regression test against captures of real routers.
+# Bodies and datagrams are bytes that need not be valid UTF-8, so they
+# are stored as Latin-1 text, which maps every byte to a character.
+
+from natmap.soap import getPage
+from natmap import upnp
+
+from twisted.internet import defer, error, reactor
+from twisted.python import log
+from twisted.web import error as weberror
+
+import json
+import time
+
+
+# The fields of a record that hold bytes.
+_BYTES_FIELDS = ('data', 'postdata', 'response')
+
+
+def _encode(record):
+    """
+    Return C{record} with its bytes fields turned into text.
+    """
+    record = dict(record)
+    for field in _BYTES_FIELDS:
+        if record.get(field) is not None:
+            record[field] = record[field].decode('latin-1')
+    return record
+
+
+def _decode(record):
+    """
+    Turn the bytes fields of C{record}, as read from a recording, back
+    into bytes.
+    """
+    for field in _BYTES_FIELDS:
+        if record.get(field) is not None:
+            record[field] = record[field].encode('latin-1')
+    return record
+
+
+def _action(headers):
+    """
+    Return the SOAP action of a request with C{headers}, or C{None}.
+    """
+    soapAction = (headers or {}).get('SOAPAction')
+    if soapAction is None:
+        return None
+    return soapAction.rsplit('#', 1)[-1].strip('"')
+
+
+class Recorder:
+    """
+    Records traffic to the file at C{path}.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(_encode(record), sort_keys=True) + '\n')
+        self.file.flush()
+
+    def _write(self, record):
+        """
+        Write C{record}, logging a failure instead of passing it on to
+        the recorded operation.
+        """
+        try:
+            self.write(record)
+        except Exception:
+            log.err(None, "failed to record an exchange")
+
+    def close(self):
+        self.file.close()
+
+    def recordDatagram(self, data, latency):
+        """
+        Record the answer C{data} to an SSDP search, received
+        C{latency} seconds after the search was sent.
+        """
+        self._write({'kind': 'ssdp', 'data': data, 'latency': latency})
+
+    def wrap(self, pageGetter=getPage):
+        """
+        Return a function like C{pageGetter} that records every
+        exchange.
+        """
+        def recordingGetPage(url, postdata=None, headers=None, **kwargs):
+            record = {'kind': 'http', 'url': url, 'postdata': postdata,
+                      'action': _action(headers)}
+            started = time.time()
+            def cb(data):
+                record['latency'] = time.time() - started
+                record['response'] = data
+                self._write(record)
+                return data
+            def eb(reason):
+                record['latency'] = time.time() - started
+                if reason.check(weberror.Error):
+                    record['status'] = reason.value.status
+                    record['response'] = reason.value.response
+                elif reason.check(error.TimeoutError,
+                                  defer.CancelledError):
+                    record['error'] = 'timeout'
+                else:
+                    record['error'] = reason.getErrorMessage()
+                self._write(record)
+                return reason
+            return pageGetter(url, postdata=postdata, headers=headers,
+                              **kwargs).addCallbacks(cb, eb)
+        return recordingGetPage
+
+    def discoverMapper(self, **options):
+        """
+        Discover a UPnP mapper like L{upnp.discoverMapper} and record
+        all its traffic.
+        """
+        return upnp.discoverMapper(pageGetter=self.wrap(), recorder=self,
+                                   **options)
+
+
+class Replayer:
+    """
+    Answers requests from the recording at C{path}.
+
+    A request is answered by the next unused exchange with the same
+    URL and body, or failing that with the same SOAP action, since
+    some bodies, such as those of C{AddPortMapping}, differ between
+    runs.  When all matching exchanges have been used, the last one
+    is used again.
+
+    @ivar scale: the recorded latencies are multiplied by this.  Use
+        C{0} to answer as fast as possible.
+    """
+
+    def __init__(self, path, scale=1.0, clock=reactor):
+        self.scale = scale
+        self.clock = clock
+        self.datagrams = list()
+        self.exchanges = list()
+        f = open(path)
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = _decode(json.loads(line))
+                if record['kind'] == 'ssdp':
+                    self.datagrams.append(record)
+                else:
+                    self.exchanges.append(record)
+        finally:
+            f.close()
+        self.used = set()
+
+    def find(self, url, postdata, action):
+        """
+        Return the recorded exchange that answers a request.
+        """
+        for matches in (
+                lambda r: r['url'] == url and r['postdata'] == postdata,
+                lambda r: r['action'] is not None and r['action'] == action):
+            candidates = [i for i, record in enumerate(self.exchanges)
+                          if matches(record)]
+            if not candidates:
+                continue
+            for i in candidates:
+                if i not in self.used:
+                    self.used.add(i)
+                    return self.exchanges[i]
+            return self.exchanges[candidates[-1]]
+        return None
+
+    def later(self, latency, f, *args):
+        """
+        Call C{f} after the scaled C{latency}.
+
+        @return: a cancellable deferred called with the result.
+        """
+        def cancel(d):
+            if call.active():
+                call.cancel()
+        d = defer.Deferred(cancel)
+        def fire():
+            try:
+                d.callback(f(*args))
+            except Exception:
+                d.errback()
+        call = self.clock.callLater(latency * self.scale, fire)
+        return d
+
+    def getPage(self, url, postdata=None, headers=None, **kwargs):
+        """
+        Answer a request like L{getPage}, from the recording.
+        """
+        record = self.find(url, postdata, _action(headers))
+        if record is None:
+            return defer.fail(error.ConnectError(
+                string="no recorded answer for %s" % (url,)))
+        def answer():
+            if 'status' in record:
+                raise weberror.Error(record['status'], None,
+                                     record.get('response'))
+            if record.get('error') == 'timeout':
+                raise error.TimeoutError()
+            if 'error' in record:
+                raise error.ConnectError(string=record['error'])
+            return record.get('response') or ''
+        return self.later(record['latency'], answer)
+
+    def discoverMapper(self, **options):
+        """
+        Discover the recorded mapper.
+
+        @param options: keyword arguments passed on to
+            L{upnp.DiscoverProtocol}.
+        @return: a deferred called with a L{upnp.UPnPMapper} that
+            talks to the recording.
+        """
+        if not self.datagrams:
+            return defer.fail(error.TimeoutError())
+        record = self.datagrams[0]
+        discovery = upnp.DiscoverProtocol(pageGetter=self.getPage,
+                                          **options)
+        discovery.started = time.time()
+        d = discovery.deferred
+        def answer():
+            discovery.datagramReceived(record['data'], None)
+            if discovery.location is None:
+                discovery.errback(upnp.BadResponseError(
+                    "no location in the recorded answer"))
+        self.later(record['latency'], answer)
+        return d
@@ -0,0 +1,162 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# A service that maps the listening ports of its children together.
+
+from natmap.inatmap import NoSuchMappingError
+from natmap.util import timeoutDeferred
+
+from twisted.application import service
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+
+def listeningPort(child):
+    """
+    Return the listening port of the server service C{child}, such as
+    a L{twisted.application.internet.TCPServer}, or C{None}.
+
+    The servers of L{twisted.application.internet} keep the port they
+    listen on in C{_port} once started, and have no public way to get
+    it.
+    """
+    return getattr(child, '_port', None)
+
+
+class MappedService(service.MultiService):
+    """
+    Service that owns a set of TCP and UDP server services and maps
+    their listening ports through one mapper.
+
+    When started, the ports of all children are mapped together, at
+    most C{concurrency} at a time, and L{whenMapped} fires once all
+    of them are done.  When stopped, they are unmapped together, and
+    the children are stopped once that is done or after C{stopTimeout}
+    seconds, whichever comes first.
+
+    @ivar mapperReactor: the L{MapperReactor} used, by default the
+        one of the C{natmap} package.
+    @ivar externalAddresses: a dictionary mapping the children that
+        have been mapped to their external addresses.
+    @ivar ports: a dictionary mapping the children to the listening
+        ports they had when the service was started.
+    @ivar pending: a dictionary mapping the children whose port is
+        being mapped to that port.
+    @ivar clock: the clock that the stop timeout runs on.
+    """
+
+    def __init__(self, mapperReactor=None, concurrency=4, stopTimeout=10,
+                 clock=reactor):
+        service.MultiService.__init__(self)
+        if mapperReactor is None:
+            from natmap import getMapperReactor
+            mapperReactor = getMapperReactor()
+        self.mapperReactor = mapperReactor
+        self.concurrency = concurrency
+        self.stopTimeout = stopTimeout
+        self.clock = clock
+        self.externalAddresses = {}
+        self.ports = {}
+        self.pending = {}
+        self.calls = list()
+        self.mapped = False
+        self.waiters = list()
+
+    def startService(self):
+        service.MultiService.startService(self)
+        self.mapped = False
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        for child in self:
+            port = listeningPort(child)
+            if port is None:
+                log.msg("not mapping %r, which has no listening port" % (
+                    child,))
+                continue
+            self.ports[child] = port
+            self.calls.append(semaphore.run(self._map, child, port))
+        d = defer.DeferredList(self.calls, consumeErrors=True)
+        d.addCallback(self._cbMapped)
+
+    def _map(self, child, port):
+        self.pending[child] = port
+        def cb(externalAddress):
+            self.externalAddresses[child] = externalAddress
+        def eb(reason):
+            if not reason.check(defer.CancelledError):
+                log.err(reason, "failed to map %s" % (port.getHost(),))
+        def done(result):
+            del self.pending[child]
+        d = self.mapperReactor.mapListeningPort(port)
+        return d.addCallbacks(cb, eb).addCallback(done)
+
+    def _cbMapped(self, result):
+        self.calls = list()
+        self.mapped = True
+        waiters, self.waiters = self.waiters, list()
+        for waiter in waiters:
+            waiter.callback(dict(self.externalAddresses))
+
+    def whenMapped(self):
+        """
+        Wait for the ports of the children to be mapped.
+
+        @return: a deferred called with a dictionary mapping the
+            children to their external addresses.  Children that
+            could not be mapped are left out.
+        """
+        if self.mapped:
+            return defer.succeed(dict(self.externalAddresses))
+        d = defer.Deferred()
+        self.waiters.append(d)
+        return d
+
+    def stopService(self):
+        # Do not wait for mappings that are still being made, but
+        # unmap them too: the device may have added them already.
+        cancelled = dict(self.pending)
+        for call in list(self.calls):
+            call.cancel()
+        calls = list()
+        for child in list(self.externalAddresses):
+            del self.externalAddresses[child]
+            calls.append(self._unmap(self.ports[child]))
+        for child, port in cancelled.items():
+            calls.append(self._unmap(port, missing=True))
+        self.ports.clear()
+        d = timeoutDeferred(defer.DeferredList(calls), self.stopTimeout,
+                            self.clock)
+        d.addErrback(log.err, "unmapping timed out")
+        def cb(result):
+            return service.MultiService.stopService(self)
+        return d.addCallback(cb)
+
+    def _unmap(self, port, missing=False):
+        """
+        Unmap C{port}.  If C{missing} is set, it may never have been
+        mapped, and not finding the mapping is no error.
+        """
+        def eb(reason):
+            if not (missing and reason.check(NoSuchMappingError)):
+                log.err(reason, "failed to unmap %s" % (port.getHost(),))
+        return self.mapperReactor.unmapListeningPort(port).addErrback(eb)
@@ -22,23 +22,25 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
-from natmap.xmlbuilder import Namespace, LocalNamespace
+from natmap.protocol import ENV, SOAPFault
+from natmap.util import timeoutDeferred, retry, hedge
+from natmap import metrics, protocol
 
-from xml.etree.ElementTree import tostring, fromstring
-
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.python import failure
-from twisted.web import client
-
+from twisted.web import client, error
 
-ENV = Namespace("http://schemas.xmlsoap.org/soap/envelope/", "s")
 
-
-def getPage(url, contextFactory=None, *args, **kwargs):
+def getPage(url, contextFactory=None, timeout=None, reactor=reactor,
+            *args, **kwargs):
     """Download a web page as a string.
 
     Download a page. Return a deferred, which will callback with a
     page (as a string) or errback with a description of the error.
+    Cancelling the deferred drops the connection.  If C{timeout} is
+    given the deferred is cancelled after that many seconds and fails
+    with L{TimeoutError}.  The connection is made, and the timeout
+    kept, with C{reactor}.
     
     See HTTPClientFactory to see what extra args can be passed.
     """
@@ -49,83 +51,112 @@ def getPage(url, contextFactory=None, *args, **kwargs):
         from twisted.internet import ssl
         if contextFactory is None:
             contextFactory = ssl.ClientContextFactory()
-        reactor.connectSSL(host, port, factory, contextFactory)
+        connector = reactor.connectSSL(host, port, factory, contextFactory)
     else:
-        reactor.connectTCP(host, port, factory)
-    return factory.deferred
+        connector = reactor.connectTCP(host, port, factory)
 
+    def cancel(deferred):
+        connector.disconnect()
 
-class SOAPFault(Exception):
-    """
-    Representation of a fault raised by the remote host.
+    def done(result):
+        if deferred.called:
+            return
+        if isinstance(result, failure.Failure):
+            deferred.errback(result)
+        else:
+            deferred.callback(result)
 
-    """
+    # The factory fires its own deferred once the dropped connection
+    # is noticed, which may be after the cancelled deferred has fired.
+    deferred = defer.Deferred(cancel)
+    factory.deferred.addBoth(done)
+    return timeoutDeferred(deferred, timeout, reactor)
+
+
+# Actions that only read state and that are therefore safe to retry
+# or to send twice.
+IDEMPOTENT_ACTIONS = frozenset([
+    'GetExternalIPAddress', 'GetGenericPortMappingEntry',
+    'GetSpecificPortMappingEntry', 'GetStatusInfo',
+    'GetConnectionTypeInfo', 'GetNATRSIPStatus',
+    ])
 
-    def __init__(self, faultString, faultDetail):
-        self.faultString = faultString
-        self.faultDetail = faultDetail
+
+def _retryable(reason):
+    """
+    Return C{True} if a call that failed with C{reason} may be
+    retried.  A fault is an answer from the device and is not retried.
+    """
+    return not reason.check(SOAPFault, defer.CancelledError)
 
 
 class Proxy:
+    """
+    SOAP client for a UPnP service.
+
+    @ivar timeout: seconds to wait for the answer to one request before
+        giving up on it, or C{None} to wait forever.
+    @ivar retries: how many times a request for an idempotent action
+        is retried when it fails without a fault.
+    @ivar backoff: the base delay, in seconds, before a retry.
+    @ivar hedgeDelay: if not C{None}, a second request for an
+        idempotent action is sent if the first has not been answered
+        within this many seconds.
+    @ivar pageGetter: the function used to send requests, with the
+        signature of L{getPage}.
+    @ivar reactor: the reactor used for connections, timeouts and
+        retries.
+    """
 
-    def __init__(self, url, namespace):
+    def __init__(self, url, namespace, timeout=30, retries=2, backoff=0.5,
+                 hedgeDelay=None, pageGetter=getPage, reactor=reactor):
         self.url = url
         self.namespace = namespace
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedgeDelay = hedgeDelay
+        self.pageGetter = pageGetter
+        self.reactor = reactor
 
     def buildEnvelope(self, element):
         """
         Build a SOAP envelope around C{element}.
         """
-        element = ENV['Envelope'](ENV['Body'](element))
-        element.set(ENV['encodingStyle'],
-                    "http://schemas.xmlsoap.org/soap/encoding/")
-        return element
+        return protocol.buildEnvelope(element)
         
     def parseResponse(self, data):
-        document = fromstring(data)
-        try:
-            responseElement = document[0][0]
-        except IndexError:
-            raise RuntimeError("BAD")
-        result = {}
-        for childElement in responseElement:
-            result[childElement.tag] = childElement.text
-        return result
+        return protocol.parseResponse(data)
 
     def parseFault(self, reason):
         """
         Parse fault from remote device.
         """
-        try:
-            document = fromstring(reason.value.response)
-        except Exception, e:
-            # Some devices give bad faults.
-            # Dlink DIR-665 gives a faulty prefix.
-            return failure.Failure(SOAPFault('', None))
-        
-        faultElement = document.find('.//' + ENV['Fault'])
-        return failure.Failure(
-            SOAPFault(faultElement.findtext(ENV['faultstring']),
-                      faultElement.find(ENV['detail']))
-            )
+        reason.trap(error.Error)
+        return failure.Failure(protocol.parseFault(reason.value.response))
     
     def callRemote(self, method, **kw):
         """
         Call remote function.
         """
-        methodElement = self.namespace[method]()
-        for name, value in kw.iteritems():
-            methodElement.append(
-                LocalNamespace[name](str(value))
-                )
-
-        headers = {
-            'Content-Type': 'text/xml',
-            'SOAPAction': '%s#%s' % (self.namespace.uri,
-                                     method)
-            }
-        
-        envelope = self.buildEnvelope(methodElement)
-        postdata = '<?xml version="1.0"?>' + tostring(envelope)
-        d = getPage(self.url, postdata=postdata, method="POST", headers=headers)
-        return d.addCallbacks(self.parseResponse, self.parseFault)
+        postdata, headers = protocol.buildRequest(self.namespace, method, kw)
+
+        def attempt():
+            d = self.pageGetter(self.url, timeout=self.timeout,
+                                reactor=self.reactor, postdata=postdata,
+                                method="POST", headers=headers)
+            return d.addCallbacks(self.parseResponse, self.parseFault)
+
+        def hedged():
+            return hedge(attempt, self.hedgeDelay, self.reactor)
+
+        if method in IDEMPOTENT_ACTIONS:
+            if self.hedgeDelay is not None:
+                d = retry(hedged, self.retries, self.backoff, _retryable,
+                          self.reactor)
+            else:
+                d = retry(attempt, self.retries, self.backoff, _retryable,
+                          self.reactor)
+        else:
+            d = attempt()
+        return metrics.timeCall(self.url, method, d)
@@ -0,0 +1,125 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# The UDP port that SSDP searches are sent from and answered on.  One
+# port per interface is shared by all searches that run at the same
+# time; it is opened by the first and closed by the last.
+
+from natmap.protocol import SSDP_MCAST, iterrandrange
+
+from twisted.internet import error, reactor
+from twisted.internet.protocol import DatagramProtocol
+
+import socket
+
+
+class SearchPort(DatagramProtocol):
+    """
+    A multicast port on C{interface} shared by a set of searches.
+
+    @ivar searches: the searches holding the port.  Every datagram
+        received is passed to the C{datagramReceived} method of each
+        of them.  The port is closed when the last one releases it.
+    @ivar listeningPort: the port, or C{None} once closed.
+    """
+
+    def __init__(self, reactor, interface=''):
+        self.reactor = reactor
+        self.interface = interface
+        self.searches = list()
+        self.listeningPort = None
+        self.joined = False
+
+    def listen(self):
+        """
+        Open the port, preferably one close to the SSDP port, which
+        some devices expect answers to go to.
+
+        @raise error.CannotListenError: if no port could be opened.
+        """
+        for port in list(iterrandrange(5, 1900, 2500)) + [0]:
+            try:
+                self.listeningPort = self.reactor.listenMulticast(
+                    port, self, interface=self.interface)
+            except error.CannotListenError:
+                continue
+            break
+        else:
+            raise error.CannotListenError(None, None, "no free port")
+        if self.interface:
+            self.listeningPort.setOutgoingInterface(self.interface)
+
+    def joinGroup(self):
+        """
+        Join the SSDP multicast group, unless already done.
+        """
+        if not self.joined:
+            self.joined = True
+            self.listeningPort.joinGroup(SSDP_MCAST,
+                                         self.interface or socket.INADDR_ANY)
+
+    def getHost(self):
+        return self.listeningPort.getHost()
+
+    def write(self, data, address):
+        self.transport.write(data, address)
+
+    def datagramReceived(self, data, address):
+        for search in list(self.searches):
+            search.datagramReceived(data, address)
+
+    def release(self, search):
+        """
+        Let go of the port on behalf of C{search}.  The port is closed
+        when no search holds it anymore.
+        """
+        if search in self.searches:
+            self.searches.remove(search)
+        if not self.searches and self.listeningPort is not None:
+            if _searchPorts.get((self.reactor, self.interface)) is self:
+                del _searchPorts[(self.reactor, self.interface)]
+            listeningPort, self.listeningPort = self.listeningPort, None
+            listeningPort.stopListening()
+
+
+# The open search ports, by reactor and interface.
+_searchPorts = {}
+
+
+def acquireSearchPort(search, reactor=reactor, interface=''):
+    """
+    Get the search port of C{interface} on behalf of C{search}, and
+    open it if no other search holds it.  The search must call
+    L{SearchPort.release} when done.
+
+    @return: a L{SearchPort}.
+    @raise error.CannotListenError: if the port could not be opened.
+    """
+    searchPort = _searchPorts.get((reactor, interface))
+    if searchPort is None:
+        searchPort = SearchPort(reactor, interface)
+        searchPort.listen()
+        _searchPorts[(reactor, interface)] = searchPort
+    searchPort.searches.append(search)
+    return searchPort
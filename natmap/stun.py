@@ -0,0 +1,206 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# A STUN (RFC 5389) binding client, used to learn the external
+# address of the host from a server on the outside.  Unlike asking
+# the mapping device, this works on networks without one and sees
+# through several levels of NAT.
+
+from twisted.internet import defer, error, reactor
+from twisted.internet.protocol import DatagramProtocol
+
+import os
+import socket
+import struct
+
+
+DEFAULT_SERVERS = [('stun.l.google.com', 19302),
+                   ('stun1.l.google.com', 19302)]
+
+MAGIC_COOKIE = 0x2112A442
+
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+BINDING_ERROR = 0x0111
+
+MAPPED_ADDRESS = 0x0001
+XOR_MAPPED_ADDRESS = 0x0020
+
+
+class StunError(Exception):
+    """
+    Bad or unsuccessful response from a STUN server.
+    """
+
+
+def bindingRequest(transactionID):
+    """
+    Build a binding request with the 12 byte C{transactionID}.
+    """
+    return struct.pack('!HHL', BINDING_REQUEST, 0,
+                       MAGIC_COOKIE) + transactionID
+
+
+def parseBindingResponse(data, transactionID):
+    """
+    Parse the response to the binding request C{transactionID}.
+
+    @return: a tuple of the host and port the server saw the request
+        come from.
+    @raise StunError: if the response is not a successful answer to
+        the request.
+    """
+    if len(data) < 20:
+        raise StunError("short message")
+    type, length, cookie = struct.unpack('!HHL', data[:8])
+    if cookie != MAGIC_COOKIE or data[8:20] != transactionID:
+        raise StunError("not a response to our request")
+    if type == BINDING_ERROR:
+        raise StunError("binding request failed")
+    if type != BINDING_SUCCESS:
+        raise StunError("unexpected message type 0x%04x" % (type,))
+
+    mapped = None
+    attributes = data[20:20 + length]
+    while len(attributes) >= 4:
+        attributeType, attributeLength = struct.unpack('!HH', attributes[:4])
+        value = attributes[4:4 + attributeLength]
+        # Attributes are padded to a multiple of four bytes.
+        attributes = attributes[4 + ((attributeLength + 3) & ~3):]
+        if attributeType == XOR_MAPPED_ADDRESS:
+            return _parseAddress(value, MAGIC_COOKIE)
+        elif attributeType == MAPPED_ADDRESS:
+            mapped = _parseAddress(value, 0)
+    if mapped is None:
+        raise StunError("no mapped address")
+    return mapped
+
+
+def _parseAddress(value, mask):
+    if len(value) < 8:
+        raise StunError("short address")
+    family, port, address = struct.unpack('!xBHL', value[:8])
+    if family != 0x01:
+        raise StunError("not an IPv4 address")
+    port ^= mask >> 16
+    address ^= mask
+    return socket.inet_ntoa(struct.pack('!L', address)), port
+
+
+class BindingProtocol(DatagramProtocol):
+    """
+    Sends a binding request to a set of servers and waits for the
+    first answer.  The request is retransmitted with a doubling
+    interval, starting at C{rto} seconds, until C{timeout} seconds
+    have passed.  The socket is opened, and the servers resolved,
+    with C{reactor}, and the timers run on C{clock}, which defaults
+    to it.
+    """
+
+    def __init__(self, servers, timeout=3, rto=0.5, clock=None,
+                 reactor=reactor):
+        self.servers = servers
+        self.timeout = timeout
+        self.rto = rto
+        self.reactor = reactor
+        self.clock = clock if clock is not None else reactor
+        self.transactionID = os.urandom(12)
+        self.request = bindingRequest(self.transactionID)
+        self.addresses = list()
+        self.deferred = None
+        self.listeningPort = None
+        self.retransmitCall = None
+        self.timeoutCall = None
+
+    def query(self):
+        """
+        Send the binding request.
+
+        @return: a deferred called with a tuple of the external host
+            and port.
+        """
+        self.deferred = defer.Deferred(self._cancel)
+        self.listeningPort = self.reactor.listenUDP(0, self)
+        for host, port in self.servers:
+            self.reactor.resolve(host).addCallbacks(
+                self._resolved, lambda reason: None, callbackArgs=(port,))
+        self.retransmitCall = self.clock.callLater(self.rto, self._retransmit,
+                                                   self.rto * 2)
+        self.timeoutCall = self.clock.callLater(self.timeout, self._expire)
+        return self.deferred
+
+    def _resolved(self, host, port):
+        if self.deferred is None:
+            return
+        self.addresses.append((host, port))
+        self.transport.write(self.request, (host, port))
+
+    def _retransmit(self, rto):
+        for address in self.addresses:
+            self.transport.write(self.request, address)
+        self.retransmitCall = self.clock.callLater(rto, self._retransmit,
+                                                   rto * 2)
+
+    def _expire(self):
+        self.timeoutCall = None
+        self._finish().errback(error.TimeoutError())
+
+    def _cancel(self, deferred):
+        self._finish()
+
+    def _finish(self):
+        deferred, self.deferred = self.deferred, None
+        for name in ('retransmitCall', 'timeoutCall'):
+            call = getattr(self, name)
+            setattr(self, name, None)
+            if call is not None and call.active():
+                call.cancel()
+        listeningPort, self.listeningPort = self.listeningPort, None
+        if listeningPort is not None:
+            listeningPort.stopListening()
+        return deferred
+
+    def datagramReceived(self, data, address):
+        if self.deferred is None or address not in self.addresses:
+            return
+        try:
+            mapped = parseBindingResponse(data, self.transactionID)
+        except StunError:
+            return
+        self._finish().callback(mapped)
+
+
+def discoverExternalHost(servers=DEFAULT_SERVERS, timeout=3,
+                         reactor=reactor):
+    """
+    Discover the external IP address with STUN.
+
+    @param servers: a list of C{(host, port)} tuples of STUN servers.
+        All are asked at once and the first answer is used.
+    @return: a deferred called with the external IP address.
+    """
+    def cb((host, port)):
+        return host
+    return BindingProtocol(servers, timeout,
+                           reactor=reactor).query().addCallback(cb)
@@ -0,0 +1,289 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Removal of mappings left behind by processes that have died.
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from natmap.protocol import parseOwner
+
+import errno
+import fcntl
+import os
+import tempfile
+
+
+# The journal shared by the processes of a user, unless told
+# otherwise.
+DEFAULT_JOURNAL = os.environ.get('NATMAP_JOURNAL', os.path.join(
+    tempfile.gettempdir(), 'natmap-%d.journal' % (os.getuid(),)))
+
+_defaultJournal = None
+
+
+def isAlive(pid):
+    """
+    Return C{True} if the process with the given ID is running on
+    this host.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Journal:
+    """
+    Small on-disk record of the mappings created by processes on this
+    host.
+
+    Each line of the file either records a mapping, with the instance
+    (process ID) that created it followed by the type, external port,
+    internal host and internal port of the mapping, or forgets one,
+    with C{-} followed by its type and external port.  Changes are
+    appended to the file, which is only rewritten by L{update}.
+
+    The file is shared by the processes on the host.  Appending takes
+    a shared lock on C{path + '.lock'} and rewriting an exclusive one,
+    so that nothing is appended to a file that is being replaced.  The
+    reactor never waits for a lock: while one is held elsewhere, the
+    attempt is made again after L{retryDelay} seconds.
+
+    @ivar path: the path of the journal file.
+    @ivar records: a dictionary mapping C{(type, externalPort)} to a
+        tuple of the instance, internal host and internal port.
+    @ivar clock: the clock that attempts are retried on.
+    """
+
+    retryDelay = 0.05
+
+    def __init__(self, path, clock=reactor):
+        self.path = path
+        self.clock = clock
+        self.records = {}
+        self.load()
+
+    def load(self):
+        """
+        Read the journal from disk.
+        """
+        self.records.clear()
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        try:
+            for line in f:
+                try:
+                    fields = line.split()
+                    if fields[0] == '-':
+                        type, externalPort = fields[1:]
+                        self.records.pop((type, int(externalPort)), None)
+                        continue
+                    instance, type, externalPort, host, port = fields
+                    self.records[(type, int(externalPort))] = (
+                        int(instance), host, int(port))
+                except (ValueError, IndexError):
+                    continue
+        finally:
+            f.close()
+
+    def save(self):
+        """
+        Write the journal to disk.  The file is replaced atomically.
+        """
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            for (type, externalPort), (instance, host, port) in sorted(
+                    self.records.items()):
+                f.write("%d %s %d %s %d\n" % (instance, type, externalPort,
+                                              host, port))
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+    def _append(self, line):
+        f = open(self.path, 'a')
+        try:
+            f.write(line)
+        finally:
+            f.close()
+
+    def _tryLocked(self, mode, f, args):
+        """
+        Call C{f} with C{args} if a lock of C{mode} can be taken at
+        once.
+
+        @return: a tuple of whether the lock was taken and the result.
+        """
+        lock = open(self.path + '.lock', 'a')
+        try:
+            try:
+                fcntl.flock(lock.fileno(), mode | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False, None
+            return True, f(*args)
+        finally:
+            # Closing the file releases the lock.
+            lock.close()
+
+    def _locked(self, mode, f, *args):
+        """
+        Call C{f} with C{args} holding a lock of C{mode}, as soon as
+        it can be taken.
+
+        @return: a deferred called with the result of C{f}.
+        """
+        d = defer.Deferred()
+        def attempt():
+            try:
+                locked, result = self._tryLocked(mode, f, args)
+            except Exception:
+                d.errback()
+                return
+            if locked:
+                d.callback(result)
+            else:
+                self.clock.callLater(self.retryDelay, attempt)
+        attempt()
+        return d
+
+    def update(self, change):
+        """
+        Reload the journal, call C{change} with the records and write
+        them back, holding the exclusive lock all along so that the
+        changes made by other processes in the meantime are kept.
+        This also compacts the file.
+
+        @return: a deferred called when done.
+        """
+        def rewrite():
+            self.load()
+            change(self.records)
+            self.save()
+        return self._locked(fcntl.LOCK_EX, rewrite)
+
+    def record(self, instance, mapping):
+        """
+        Record that C{instance} created the L{Mapping} C{mapping}.
+
+        @return: a deferred called when the record is on disk.
+        """
+        self.records[(mapping.type, mapping.externalPort)] = (
+            instance, mapping.internalHost, mapping.internalPort)
+        return self._locked(fcntl.LOCK_SH, self._append, "%d %s %d %s %d\n" % (
+            instance, mapping.type, mapping.externalPort,
+            mapping.internalHost, mapping.internalPort))
+
+    def forget(self, mapping):
+        """
+        Forget about the L{Mapping} C{mapping}.
+
+        @return: a deferred called when the change is on disk.
+        """
+        self.records.pop((mapping.type, mapping.externalPort), None)
+        return self._locked(fcntl.LOCK_SH, self._append, "- %s %d\n" % (
+            mapping.type, mapping.externalPort))
+
+    def deadInstances(self, current):
+        """
+        Return the set of recorded instances, other than C{current},
+        whose process is no longer running.
+        """
+        return set(instance for instance, host, port
+                   in self.records.itervalues()
+                   if instance != current and not isAlive(instance))
+
+
+def getDefaultJournal():
+    """
+    Return the L{Journal} at L{DEFAULT_JOURNAL}, opening it on first
+    use.
+    """
+    global _defaultJournal
+    if _defaultJournal is None:
+        _defaultJournal = Journal(DEFAULT_JOURNAL)
+    return _defaultJournal
+
+
+@defer.inlineCallbacks
+def sweepStaleMappings(mapper, journal, concurrency=4):
+    """
+    Delete the mappings that dead processes recorded in C{journal}
+    left behind on the mapping device.
+
+    An entry is only deleted if it matches the journal record and its
+    description carries the owner tag of C{mapper} and the instance
+    of the dead process, so mappings created by anyone else are left
+    alone.  The table is walked once, and not at all if the journal
+    holds no dead instances.  The journal is compacted either way.
+
+    @type mapper: L{natmap.upnp.UPnPMapper}
+    @type journal: L{Journal}
+    @return: a deferred called with the number of deleted mappings.
+    """
+    # Other processes may have changed the journal since it was read.
+    journal.load()
+    dead = journal.deadInstances(mapper.instance)
+    if not dead:
+        yield journal.update(lambda records: None)
+        defer.returnValue(0)
+
+    stale = list()
+    mappings = yield mapper.getMappings()
+    for mapping in mappings:
+        record = journal.records.get((mapping.type, mapping.externalPort))
+        if record is None or record[0] not in dead:
+            continue
+        instance, host, port = record
+        if (mapping.internalHost, mapping.internalPort) != (host, port):
+            continue
+        if parseOwner(mapping.description) != (mapper.owner, instance):
+            continue
+        stale.append(mapping)
+
+    semaphore = defer.DeferredSemaphore(concurrency)
+    results = yield defer.DeferredList(
+        [semaphore.run(mapper.deleteMapping, mapping) for mapping in stale],
+        consumeErrors=True)
+
+    # Keep the records of mappings that could not be deleted so that
+    # the next sweep tries again.
+    failed = set()
+    for mapping, (success, result) in zip(stale, results):
+        if not success:
+            log.err(result, "failed to delete stale mapping")
+            failed.add((mapping.type, mapping.externalPort))
+
+    def change(records):
+        for key, (instance, host, port) in records.items():
+            if instance in dead and key not in failed:
+                del records[key]
+    yield journal.update(change)
+    defer.returnValue(len(stale) - len(failed))
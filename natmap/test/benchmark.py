@@ -0,0 +1,299 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# End-to-end benchmarks of discovery and mapping against the fake
+# gateway in natmap.test.fakeigd.  Run with
+#
+#   python -m natmap.test.benchmark --table-sizes=0,100 --latencies=0,0.01
+#
+# The results are written as JSON so that runs can be compared
+# across commits.  The time it takes to import natmap is measured
+# too, and checked against a budget.
+
+from twisted.internet import defer, task
+from twisted.internet.address import IPv4Address
+from twisted.python import usage
+
+from natmap import upnp
+from natmap.mapper import MapperReactor
+from natmap.test.fakeigd import FakeGateway, FakeGatewayService
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import natmap
+
+
+class FakeListeningPort:
+    """
+    Stand-in for an L{IListeningPort} bound to an internal address.
+    """
+
+    def __init__(self, host, port, type='TCP'):
+        self.address = IPv4Address(type, host, port)
+
+    def getHost(self):
+        return self.address
+
+
+class GatewayFactory:
+    """
+    Instance factory that discovers the fake gateway.
+    """
+
+    def __init__(self, service, fetchWindow):
+        self.service = service
+        self.fetchWindow = fetchWindow
+
+    def buildInstance(self):
+        return upnp.discoverMapper(
+            searchAddress=self.service.searchAddress(),
+            fetchWindow=self.fetchWindow)
+
+
+def percentile(samples, fraction):
+    """
+    Return the nearest-rank percentile of C{samples}.
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class Measurement:
+    """
+    Latencies and SOAP call counts of one kind of operation.
+    """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.samples = list()
+        self.errors = 0
+        self.calls = 0
+        self.elapsed = 0.0
+
+    def soapCalls(self):
+        return sum(self.gateway.calls.itervalues())
+
+    @defer.inlineCallbacks
+    def run(self, operation, count, concurrency):
+        """
+        Run C{operation} C{count} times with at most C{concurrency}
+        operations outstanding.  C{operation} is called with the
+        sequence number of the operation and returns a deferred.
+        """
+        semaphore = defer.DeferredSemaphore(concurrency)
+
+        def timed(n):
+            started = time.time()
+            def cb(result):
+                self.samples.append(time.time() - started)
+            def eb(reason):
+                self.errors += 1
+            return operation(n).addCallbacks(cb, eb)
+
+        calls = self.soapCalls()
+        started = time.time()
+        yield defer.DeferredList(
+            [semaphore.run(timed, n) for n in range(count)])
+        self.elapsed += time.time() - started
+        self.calls += self.soapCalls() - calls
+
+    def report(self):
+        count = len(self.samples)
+        total = count + self.errors
+        return {
+            'count': count,
+            'errors': self.errors,
+            'p50': percentile(self.samples, 0.5),
+            'p99': percentile(self.samples, 0.99),
+            'opsPerSecond': (count / self.elapsed) if self.elapsed else None,
+            'soapCallsPerOperation': (float(self.calls) / total
+                                      if total else None),
+            }
+
+
+@defer.inlineCallbacks
+def runScenario(tableSize, latency, concurrency, operations, fetchWindow=1):
+    """
+    Run every benchmark against a fresh fake gateway.
+
+    @return: a deferred called with a dictionary describing the
+        scenario and its results.
+    """
+    gateway = FakeGateway(tableSize=tableSize, latency=latency)
+    service = FakeGatewayService(gateway, ssdpPort=0)
+    service.startService()
+    try:
+        searchAddress = service.searchAddress()
+        results = {}
+
+        discover = Measurement(gateway)
+        def discoverOnce(n):
+            return upnp.discoverMapper(searchAddress=searchAddress)
+        yield discover.run(discoverOnce, operations, concurrency)
+        results['discoverMapper'] = discover.report()
+
+        mapperReactor = MapperReactor(GatewayFactory(service, fetchWindow))
+        ports = [FakeListeningPort('192.168.1.2', 20000 + n)
+                 for n in range(operations)]
+
+        mapping = Measurement(gateway)
+        def mapOnce(n):
+            return mapperReactor.mapListeningPort(ports[n])
+        yield mapping.run(mapOnce, operations, concurrency)
+        results['mapListeningPort'] = mapping.report()
+
+        external = Measurement(gateway)
+        def externalOnce(n):
+            return mapperReactor.discoverExternalHost()
+        yield external.run(externalOnce, operations, concurrency)
+        results['discoverExternalHost'] = external.report()
+
+        unmapping = Measurement(gateway)
+        def unmapOnce(n):
+            return mapperReactor.unmapListeningPort(ports[n])
+        yield unmapping.run(unmapOnce, operations, concurrency)
+        results['unmapListeningPort'] = unmapping.report()
+    finally:
+        yield service.stopService()
+
+    defer.returnValue({
+        'tableSize': tableSize, 'latency': latency,
+        'concurrency': concurrency, 'fetchWindow': fetchWindow,
+        'operations': operations, 'results': results,
+        })
+
+
+# Modules that importing natmap must not load; they belong to the
+# backends and are loaded on first use.
+HEAVY_MODULES = ['twisted.internet.reactor', 'twisted.web.client',
+                 'twisted.plugin', 'xml.etree.ElementTree', 'natmap.mapper',
+                 'natmap.upnp', 'natmap.soap']
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+started = time.time()
+import %s
+elapsed = time.time() - started
+json.dump({'seconds': elapsed, 'modules': sorted(sys.modules)}, sys.stdout)
+"""
+
+
+def measureImport(module='natmap', runs=5):
+    """
+    Measure the time it takes to import C{module} in a fresh
+    interpreter.
+
+    @return: a dictionary with the median and maximum time, the
+        number of modules loaded and the heavy modules among them.
+    """
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(
+        natmap.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path] + filter(None, [env.get('PYTHONPATH')]))
+    samples = list()
+    for i in range(runs):
+        output = subprocess.Popen(
+            [sys.executable, '-c', _IMPORT_SCRIPT % (module,)],
+            stdout=subprocess.PIPE, env=env).communicate()[0]
+        result = json.loads(output)
+        samples.append(result['seconds'])
+    return {'module': module, 'runs': runs,
+            'median': percentile(samples, 0.5), 'max': max(samples),
+            'modules': len(result['modules']),
+            'heavy': [name for name in HEAVY_MODULES
+                      if name in result['modules']]}
+
+
+def _numbers(convert):
+    def parse(value):
+        return [convert(item) for item in value.split(',') if item]
+    return parse
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['table-sizes', None, [0, 100], "Comma separated table sizes.",
+         _numbers(int)],
+        ['latencies', None, [0.0, 0.005], "Comma separated router "
+         "latencies in seconds.", _numbers(float)],
+        ['concurrency', None, [1, 8], "Comma separated numbers of "
+         "concurrent operations.", _numbers(int)],
+        ['operations', None, 20, "Operations per benchmark.", int],
+        ['fetch-window', None, 1, "Window of the table walk.", int],
+        ['import-budget', None, 0.05, "Seconds importing natmap may "
+         "take.", float],
+        ['output', 'o', None, "File to write the JSON results to."],
+        ]
+
+
+@defer.inlineCallbacks
+def runBenchmarks(config):
+    """
+    Run all scenarios described by C{config}.
+
+    @return: a deferred called with the JSON document.
+    """
+    imports = measureImport()
+    imports['budget'] = config['import-budget']
+    imports['withinBudget'] = (not imports['heavy'] and
+                               imports['median'] <= config['import-budget'])
+    scenarios = list()
+    for tableSize in config['table-sizes']:
+        for latency in config['latencies']:
+            for concurrency in config['concurrency']:
+                scenario = yield runScenario(
+                    tableSize, latency, concurrency, config['operations'],
+                    config['fetch-window'])
+                scenarios.append(scenario)
+    defer.returnValue({'benchmark': 'natmap', 'time': time.time(),
+                       'import': imports, 'scenarios': scenarios})
+
+
+def main(reactor, *argv):
+    config = Options()
+    config.parseOptions(argv)
+
+    def cb(document):
+        output = json.dumps(document, indent=2, sort_keys=True)
+        if config['output'] is None:
+            sys.stdout.write(output + '\n')
+        else:
+            f = open(config['output'], 'w')
+            try:
+                f.write(output + '\n')
+            finally:
+                f.close()
+    return runBenchmarks(config).addCallback(cb)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,379 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# A fake UPnP Internet Gateway Device that answers SSDP searches,
+# serves a device description and implements the WANIPConnection
+# actions over HTTP.  Used to exercise the real network code paths
+# without a router; see fake-igd.tac for running it under twistd.
+
+from xml.etree.ElementTree import fromstring, tostring
+
+from twisted.application import service
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+from twisted.web import resource, server
+
+from natmap.soap import ENV
+from natmap.xmlbuilder import Namespace, LocalNamespace
+
+import random
+
+
+SERVICE_TYPE = 'urn:schemas-upnp-org:service:WANIPConnection:1'
+DEVICE_TYPE = 'urn:schemas-upnp-org:device:InternetGatewayDevice:1'
+CONTROL = Namespace('urn:schemas-upnp-org:control-1-0')
+
+DESCRIPTION = """<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+<specVersion><major>1</major><minor>0</minor></specVersion>
+<URLBase>%(base)s</URLBase>
+<device>
+<deviceType>%(deviceType)s</deviceType>
+<friendlyName>natmap fake IGD</friendlyName>
+<UDN>%(udn)s</UDN>
+<deviceList><device>
+<deviceType>urn:schemas-upnp-org:device:WANDevice:1</deviceType>
+<deviceList><device>
+<deviceType>urn:schemas-upnp-org:device:WANConnectionDevice:1</deviceType>
+<serviceList><service>
+<serviceType>%(serviceType)s</serviceType>
+<serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>
+<controlURL>/control</controlURL>
+<eventSubURL>/event</eventSubURL>
+<SCPDURL>/scpd.xml</SCPDURL>
+</service></serviceList>
+</device></deviceList>
+</device></deviceList>
+</device>
+</root>
+"""
+
+SEARCH_RESPONSE = """HTTP/1.1 200 OK\r
+CACHE-CONTROL: max-age=1800\r
+EXT:\r
+LOCATION: %(location)s\r
+SERVER: natmap/0.1 UPnP/1.0 fakeigd/0.1\r
+ST: %(deviceType)s\r
+USN: %(udn)s::%(deviceType)s\r
+\r
+"""
+
+
+class UPnPError(Exception):
+    """
+    Error answered to a control request as a SOAP fault.
+    """
+
+    def __init__(self, code, description):
+        Exception.__init__(self, code, description)
+        self.code = code
+        self.description = description
+
+
+class FakeGateway:
+    """
+    The state of a fake Internet Gateway Device.
+
+    @ivar mappings: the port mapping table, a list of dictionaries
+        holding the C{New*} arguments of C{AddPortMapping}.
+    @ivar latency: seconds to wait before answering a control request.
+    @ivar faultRate: probability that a control request is answered
+        with a fault no matter what.
+    @ivar dropRate: probability that the connection of a control
+        request is dropped without an answer.
+    @ivar maxEntries: the largest number of mappings the table holds,
+        or C{None} for no limit.
+    @ivar calls: a dictionary mapping action names to the number of
+        times they have been invoked.
+    """
+
+    def __init__(self, externalHost='1.1.1.1', tableSize=0, latency=0,
+                 faultRate=0, dropRate=0, maxEntries=None,
+                 udn='uuid:natmap-fake-igd'):
+        self.externalHost = externalHost
+        self.latency = latency
+        self.faultRate = faultRate
+        self.dropRate = dropRate
+        self.maxEntries = maxEntries
+        self.udn = udn
+        self.mappings = list()
+        self.calls = {}
+        self.random = random.Random(0)
+        for index in range(tableSize):
+            self.mappings.append({
+                'NewRemoteHost': '', 'NewProtocol': 'TCP',
+                'NewExternalPort': str(10000 + index),
+                'NewInternalClient': '10.0.%d.%d' % (index // 250,
+                                                     index % 250 + 2),
+                'NewInternalPort': str(10000 + index), 'NewEnabled': '1',
+                'NewPortMappingDescription': 'filler %d' % index,
+                'NewLeaseDuration': '0'})
+
+    def findMapping(self, externalPort, protocol):
+        for index, mapping in enumerate(self.mappings):
+            if (mapping['NewExternalPort'] == str(externalPort)
+                    and mapping['NewProtocol'] == protocol):
+                return index
+        return None
+
+    def dispatch(self, action, arguments):
+        """
+        Invoke C{action} with C{arguments}.
+
+        @return: a list of C{(name, value)} tuples for the response.
+        @raise UPnPError: on failure.
+        """
+        self.calls[action] = self.calls.get(action, 0) + 1
+        method = getattr(self, 'action_' + action, None)
+        if method is None:
+            raise UPnPError(401, 'Invalid Action')
+        if self.faultRate and self.random.random() < self.faultRate:
+            raise UPnPError(501, 'Action Failed')
+        return method(**arguments)
+
+    def action_GetExternalIPAddress(self):
+        return [('NewExternalIPAddress', self.externalHost)]
+
+    def action_GetGenericPortMappingEntry(self, NewPortMappingIndex):
+        index = int(NewPortMappingIndex)
+        if index >= len(self.mappings):
+            raise UPnPError(713, 'SpecifiedArrayIndexInvalid')
+        return self._entry(self.mappings[index])
+
+    def action_GetSpecificPortMappingEntry(self, NewRemoteHost,
+                                           NewExternalPort, NewProtocol):
+        index = self.findMapping(NewExternalPort, NewProtocol)
+        if index is None:
+            raise UPnPError(714, 'NoSuchEntryInArray')
+        return [(name, value) for name, value
+                in self._entry(self.mappings[index])
+                if name not in ('NewRemoteHost', 'NewExternalPort',
+                                'NewProtocol')]
+
+    def _entry(self, mapping):
+        return [(name, mapping[name]) for name in (
+            'NewRemoteHost', 'NewExternalPort', 'NewProtocol',
+            'NewInternalPort', 'NewInternalClient', 'NewEnabled',
+            'NewPortMappingDescription', 'NewLeaseDuration')]
+
+    def action_AddPortMapping(self, **arguments):
+        mapping = dict((name, (value or '').strip())
+                       for name, value in arguments.iteritems())
+        index = self.findMapping(mapping['NewExternalPort'],
+                                 mapping['NewProtocol'])
+        if index is not None:
+            if (self.mappings[index]['NewInternalClient']
+                    != mapping['NewInternalClient']):
+                raise UPnPError(718, 'ConflictInMappingEntry')
+            self.mappings[index] = mapping
+        elif (self.maxEntries is not None
+                and len(self.mappings) >= self.maxEntries):
+            raise UPnPError(728, 'NoPortMapsAvailable')
+        else:
+            self.mappings.append(mapping)
+        return []
+
+    def action_DeletePortMapping(self, NewRemoteHost, NewExternalPort,
+                                 NewProtocol):
+        index = self.findMapping(NewExternalPort, NewProtocol)
+        if index is None:
+            raise UPnPError(714, 'NoSuchEntryInArray')
+        del self.mappings[index]
+        return []
+
+
+class ControlResource(resource.Resource):
+    """
+    SOAP control endpoint of the WANIPConnection service.
+    """
+    isLeaf = True
+
+    def __init__(self, gateway):
+        resource.Resource.__init__(self)
+        self.gateway = gateway
+
+    def render_POST(self, request):
+        gateway = self.gateway
+        if gateway.dropRate and gateway.random.random() < gateway.dropRate:
+            request.transport.loseConnection()
+            return server.NOT_DONE_YET
+
+        document = fromstring(request.content.read())
+        actionElement = document.find(ENV['Body'])[0]
+        action = actionElement.tag.split('}', 1)[-1]
+        arguments = dict((child.tag, child.text) for child in actionElement)
+
+        try:
+            result = gateway.dispatch(action, arguments)
+        except UPnPError, e:
+            request.setResponseCode(500)
+            body = self.buildFault(e)
+        else:
+            body = self.buildResponse(action, result)
+
+        request.setHeader('content-type', 'text/xml; charset="utf-8"')
+        if not gateway.latency:
+            return body
+
+        def finish():
+            request.write(body)
+            request.finish()
+
+        def lost(reason):
+            if call.active():
+                call.cancel()
+
+        call = reactor.callLater(gateway.latency, finish)
+        request.notifyFinish().addErrback(lost)
+        return server.NOT_DONE_YET
+
+    def buildEnvelope(self, element):
+        envelope = ENV['Envelope'](ENV['Body'](element))
+        envelope.set(ENV['encodingStyle'],
+                     'http://schemas.xmlsoap.org/soap/encoding/')
+        return '<?xml version="1.0"?>' + tostring(envelope)
+
+    def buildResponse(self, action, result):
+        responseElement = Namespace(SERVICE_TYPE)[action + 'Response']()
+        for name, value in result:
+            responseElement.append(LocalNamespace[name](value or ''))
+        return self.buildEnvelope(responseElement)
+
+    def buildFault(self, e):
+        return self.buildEnvelope(ENV['Fault'](
+            LocalNamespace['faultcode']('s:Client'),
+            LocalNamespace['faultstring']('UPnPError'),
+            LocalNamespace['detail'](CONTROL['UPnPError'](
+                CONTROL['errorCode'](str(e.code)),
+                CONTROL['errorDescription'](e.description)))))
+
+
+class DescriptionResource(resource.Resource):
+    """
+    Device description of the gateway.
+    """
+    isLeaf = True
+
+    def __init__(self, gateway):
+        resource.Resource.__init__(self)
+        self.gateway = gateway
+
+    def render_GET(self, request):
+        host = request.getHost()
+        request.setHeader('content-type', 'text/xml; charset="utf-8"')
+        return DESCRIPTION % {
+            'base': 'http://%s:%d/' % (host.host, host.port),
+            'deviceType': DEVICE_TYPE, 'serviceType': SERVICE_TYPE,
+            'udn': self.gateway.udn}
+
+
+def makeSite(gateway):
+    """
+    Build the web site of the gateway.
+    """
+    root = resource.Resource()
+    root.putChild('description.xml', DescriptionResource(gateway))
+    root.putChild('control', ControlResource(gateway))
+    site = server.Site(root)
+    site.noisy = False
+    return site
+
+
+class SSDPResponder(DatagramProtocol):
+    """
+    Answers SSDP M-SEARCH requests for an Internet Gateway Device.
+
+    @ivar location: the URL of the device description.
+    """
+
+    def __init__(self, gateway, location):
+        self.gateway = gateway
+        self.location = location
+
+    def datagramReceived(self, data, address):
+        lines = data.split('\r\n')
+        if not lines[0].startswith('M-SEARCH'):
+            return
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        if headers.get('st') not in (DEVICE_TYPE, 'ssdp:all',
+                                     'upnp:rootdevice'):
+            return
+        self.transport.write(SEARCH_RESPONSE % {
+            'location': self.location, 'deviceType': DEVICE_TYPE,
+            'udn': self.gateway.udn}, address)
+
+
+class FakeGatewayService(service.MultiService):
+    """
+    Service running a fake IGD on C{interface}: an HTTP server on
+    C{httpPort} and an SSDP responder on C{ssdpPort}.  If C{multicast}
+    is true the responder joins the SSDP multicast group.
+    """
+
+    def __init__(self, gateway, interface='127.0.0.1', httpPort=0,
+                 ssdpPort=1900, multicast=False):
+        service.MultiService.__init__(self)
+        self.gateway = gateway
+        self.interface = interface
+        self.httpPort = httpPort
+        self.ssdpPort = ssdpPort
+        self.multicast = multicast
+        self.webPort = None
+        self.udpPort = None
+
+    def startService(self):
+        service.MultiService.startService(self)
+        self.webPort = reactor.listenTCP(self.httpPort,
+                                         makeSite(self.gateway),
+                                         interface=self.interface)
+        location = 'http://%s:%d/description.xml' % (
+            self.interface, self.webPort.getHost().port)
+        responder = SSDPResponder(self.gateway, location)
+        if self.multicast:
+            self.udpPort = reactor.listenMulticast(self.ssdpPort, responder,
+                                                   listenMultiple=True)
+            self.udpPort.joinGroup('239.255.255.250')
+        else:
+            self.udpPort = reactor.listenUDP(self.ssdpPort, responder,
+                                             interface=self.interface)
+
+    def stopService(self):
+        service.MultiService.stopService(self)
+        webPort, self.webPort = self.webPort, None
+        udpPort, self.udpPort = self.udpPort, None
+        if udpPort is not None:
+            udpPort.stopListening()
+        if webPort is not None:
+            return webPort.stopListening()
+
+    def searchAddress(self):
+        """
+        Return the C{(host, port)} tuple that search requests should
+        be sent to.
+        """
+        return (self.interface, self.udpPort.getHost().port)
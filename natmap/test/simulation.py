@@ -0,0 +1,539 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Runs natmap against a simulated network and gateway on a simulated
+# clock, so that hours of reconciliation, discovery timeouts and
+# storms of rediscovery after reboots take seconds.  Run with
+#
+#   python -m natmap.test.simulation --mappings=1000 --hours=24
+#
+# The results are written as JSON, like those of natmap.test.benchmark.
+# Time is simulated for everything that runs on the reactor; the
+# latencies recorded by natmap.metrics are still wall time.
+
+from xml.etree.ElementTree import fromstring
+
+from twisted.internet import defer, error, task
+from twisted.internet.address import IPv4Address
+from twisted.python import usage
+from twisted.web import error as weberror
+
+from natmap import upnp
+from natmap.mapper import MapperReactor
+from natmap.protocol import ENV, SSDP_MCAST, SSDP_PORT
+from natmap.util import timeoutDeferred
+from natmap.test.benchmark import percentile
+from natmap.test.fakeigd import (
+    FakeGateway, ControlResource, SSDPResponder, UPnPError, DESCRIPTION,
+    DEVICE_TYPE, SERVICE_TYPE)
+
+import json
+import sys
+import time
+import urlparse
+
+
+class SimulatedPort:
+    """
+    A UDP port of the simulated network.
+    """
+
+    def __init__(self, reactor, protocol, host, port, listenMultiple):
+        self.reactor = reactor
+        self.protocol = protocol
+        self.host = host
+        self.port = port
+        self.listenMultiple = listenMultiple
+        self.groups = set()
+        self.listening = True
+
+    def getHost(self):
+        return IPv4Address('UDP', self.host, self.port)
+
+    def write(self, data, address):
+        self.reactor.send(data, (self.host, self.port), address)
+
+    def connect(self, host, port):
+        pass
+
+    def joinGroup(self, address, interface=''):
+        self.groups.add(address)
+        return defer.succeed(None)
+
+    def setOutgoingInterface(self, address):
+        return defer.succeed(None)
+
+    def leaveGroup(self, address, interface=''):
+        self.groups.discard(address)
+        return defer.succeed(None)
+
+    def stopListening(self):
+        if self.listening:
+            self.listening = False
+            self.reactor.unbind(self)
+            self.protocol.doStop()
+        return defer.succeed(None)
+
+
+class SimulatedReactor(task.Clock):
+    """
+    A clock that is also a network of UDP ports.  Datagrams take
+    C{latency} seconds to arrive.  Ports bound to C{''} are bound to
+    C{host}, the address of the simulated host.
+
+    @ivar hosts: a dictionary mapping names to the addresses that
+        L{resolve} answers.
+    @ivar datagrams: the number of datagrams sent.
+    """
+
+    def __init__(self, host='192.168.1.2', latency=0.001):
+        task.Clock.__init__(self)
+        self.host = host
+        self.latency = latency
+        self.hosts = {}
+        self.ports = {}
+        self.nextPort = 40000
+        self.datagrams = 0
+
+    def bind(self, host, port, protocol, listenMultiple=False):
+        """
+        Bind C{protocol} to C{port} of C{host}, any free port if it
+        is C{0}.
+        """
+        host = host or self.host
+        if port == 0:
+            while (host, self.nextPort) in self.ports:
+                self.nextPort += 1
+            port = self.nextPort
+        bound = self.ports.setdefault((host, port), list())
+        if bound and not (listenMultiple and bound[0].listenMultiple):
+            raise error.CannotListenError(host, port, "address in use")
+        listeningPort = SimulatedPort(self, protocol, host, port,
+                                      listenMultiple)
+        bound.append(listeningPort)
+        protocol.makeConnection(listeningPort)
+        return listeningPort
+
+    def unbind(self, listeningPort):
+        key = (listeningPort.host, listeningPort.port)
+        bound = self.ports.get(key, [])
+        if listeningPort in bound:
+            bound.remove(listeningPort)
+        if not bound:
+            self.ports.pop(key, None)
+
+    def listenUDP(self, port, protocol, interface='', maxPacketSize=8192):
+        return self.bind(interface, port, protocol)
+
+    def listenMulticast(self, port, protocol, interface='',
+                        maxPacketSize=8192, listenMultiple=False):
+        return self.bind(interface, port, protocol, listenMultiple)
+
+    def resolve(self, name, timeout=None):
+        return defer.succeed(self.hosts.get(name, name))
+
+    def callWhenRunning(self, f, *args, **kwargs):
+        return self.callLater(0, f, *args, **kwargs)
+
+    def send(self, data, source, destination):
+        self.datagrams += 1
+        self.callLater(self.latency, self._deliver, data, source, destination)
+
+    def _deliver(self, data, source, (host, port)):
+        if host == SSDP_MCAST:
+            receivers = [listeningPort
+                         for (boundHost, boundPort), bound
+                         in self.ports.items() if boundPort == port
+                         for listeningPort in bound
+                         if host in listeningPort.groups]
+        else:
+            receivers = list(self.ports.get((host, port), []))
+        for listeningPort in receivers:
+            if listeningPort.listening:
+                listeningPort.protocol.datagramReceived(data, source)
+
+    def run(self, until):
+        """
+        Run the timers due until the clock reads C{until}.
+        """
+        while self.calls and self.calls[0].getTime() <= until:
+            self.advance(max(0, self.calls[0].getTime() - self.seconds()))
+        self.advance(max(0, until - self.seconds()))
+
+
+class SimulatedResponder(SSDPResponder):
+    """
+    SSDP responder that stays quiet while its gateway is down.
+    """
+
+    def __init__(self, simulation, location):
+        SSDPResponder.__init__(self, simulation.gateway, location)
+        self.simulation = simulation
+
+    def datagramReceived(self, data, address):
+        if self.simulation.up:
+            self.simulation.searches += 1
+            SSDPResponder.datagramReceived(self, data, address)
+
+
+class SimulatedGateway:
+    """
+    A L{FakeGateway} on the simulated network.  Its HTTP server is
+    reached through L{getPage}, which answers after C{latency}
+    seconds.
+
+    The gateway announces itself every C{announceInterval} seconds.
+    When rebooted it says goodbye, loses its mapping table, answers
+    nothing for the downtime and then announces itself with a new
+    BOOTID.
+
+    @ivar up: whether the gateway answers.
+    @ivar searches: the number of search requests answered.
+    @ivar requests: the number of HTTP requests received.
+    @ivar inFlight: the number of requests not yet answered.
+    @ivar peakInFlight: the largest C{inFlight} seen.
+    @ivar expected: the number of mappings the clients keep, or
+        C{None}.  When set, the time it takes after a boot until the
+        table holds that many mappings again is collected in
+        C{restoreTimes}.
+    """
+
+    def __init__(self, reactor, gateway=None, host='192.168.1.1',
+                 port=5000, latency=0.005, announceInterval=300):
+        self.reactor = reactor
+        self.gateway = gateway if gateway is not None else FakeGateway()
+        self.control = ControlResource(self.gateway)
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.up = True
+        self.bootID = 1
+        self.reboots = 0
+        self.searches = 0
+        self.requests = 0
+        self.inFlight = 0
+        self.peakInFlight = 0
+        self.expected = None
+        self.bootedAt = None
+        self.restoreTimes = list()
+        self.location = 'http://%s:%d/description.xml' % (host, port)
+        self.ssdpPort = reactor.bind(host, SSDP_PORT, SimulatedResponder(
+            self, self.location), listenMultiple=True)
+        self.ssdpPort.joinGroup(SSDP_MCAST)
+        self.announcer = task.LoopingCall(self.announce, 'ssdp:alive')
+        self.announcer.clock = reactor
+        self.announcer.start(announceInterval)
+
+    def stop(self):
+        if self.announcer.running:
+            self.announcer.stop()
+        self.ssdpPort.stopListening()
+
+    def announce(self, kind):
+        if not self.up:
+            return
+        lines = ['NOTIFY * HTTP/1.1',
+                 'HOST: %s:%d' % (SSDP_MCAST, SSDP_PORT),
+                 'NT: upnp:rootdevice', 'NTS: ' + kind,
+                 'USN: %s::upnp:rootdevice' % (self.gateway.udn,)]
+        if kind == 'ssdp:alive':
+            lines.extend(['CACHE-CONTROL: max-age=1800',
+                          'LOCATION: ' + self.location,
+                          'BOOTID.UPNP.ORG: %d' % (self.bootID,)])
+        self.ssdpPort.write('\r\n'.join(lines) + '\r\n\r\n',
+                            (SSDP_MCAST, SSDP_PORT))
+
+    def reboot(self, downtime):
+        """
+        Reboot, and come back up after C{downtime} seconds.
+        """
+        self.announce('ssdp:byebye')
+        self.up = False
+        self.reboots += 1
+        del self.gateway.mappings[:]
+        self.reactor.callLater(downtime, self.boot)
+
+    def boot(self):
+        self.up = True
+        self.bootID += 1
+        self.bootedAt = self.reactor.seconds()
+        self.announce('ssdp:alive')
+
+    def getPage(self, url, contextFactory=None, timeout=None, reactor=None,
+                postdata=None, method='GET', headers=None, **kwargs):
+        """
+        Answer a request like L{natmap.soap.getPage}.  Requests sent
+        while the gateway is down, or that are in flight when it goes
+        down, are never answered.
+        """
+        parsed = urlparse.urlparse(url)
+        if (parsed.hostname, parsed.port) != (self.host, self.port):
+            return defer.fail(error.ConnectionRefusedError())
+        self.requests += 1
+        self.inFlight += 1
+        self.peakInFlight = max(self.peakInFlight, self.inFlight)
+        bootID = self.bootID
+
+        def cancel(d):
+            if call.active():
+                call.cancel()
+                self.inFlight -= 1
+        d = defer.Deferred(cancel)
+        def answer():
+            self.inFlight -= 1
+            if not self.up or self.bootID != bootID:
+                return
+            try:
+                d.callback(self.answer(parsed.path, postdata))
+            except Exception:
+                d.errback()
+        call = self.reactor.callLater(self.latency, answer)
+        return timeoutDeferred(d, timeout, self.reactor)
+
+    def answer(self, path, postdata):
+        if path == '/description.xml':
+            return DESCRIPTION % {
+                'base': 'http://%s:%d/' % (self.host, self.port),
+                'deviceType': DEVICE_TYPE, 'serviceType': SERVICE_TYPE,
+                'udn': self.gateway.udn}
+        if path != '/control':
+            raise weberror.Error('404', 'Not Found', '')
+        actionElement = fromstring(postdata).find(ENV['Body'])[0]
+        action = actionElement.tag.split('}', 1)[-1]
+        arguments = dict((child.tag, child.text) for child in actionElement)
+        try:
+            result = self.gateway.dispatch(action, arguments)
+        except UPnPError, e:
+            raise weberror.Error('500', 'Internal Server Error',
+                                 self.control.buildFault(e))
+        self._checkRestored()
+        return self.control.buildResponse(action, result)
+
+    def _checkRestored(self):
+        if (self.bootedAt is not None and self.expected is not None
+                and len(self.gateway.mappings) >= self.expected):
+            self.restoreTimes.append(self.reactor.seconds() - self.bootedAt)
+            self.bootedAt = None
+
+
+class SimulatedFactory:
+    """
+    Instance factory that discovers the simulated gateway with a
+    multicast search.
+
+    @ivar discoveries: the number of discoveries started.
+    """
+
+    def __init__(self, reactor, simulation, timeout=5):
+        self.reactor = reactor
+        self.simulation = simulation
+        self.timeout = timeout
+        self.discoveries = 0
+
+    def buildInstance(self):
+        self.discoveries += 1
+        return upnp.discoverMapper(
+            timeout=self.timeout, unicast=False,
+            pageGetter=self.simulation.getPage, reactor=self.reactor)
+
+
+def summarize(samples):
+    return {'count': len(samples), 'p50': percentile(samples, 0.5),
+            'max': max(samples) if samples else None}
+
+
+def gatewayReport(simulation):
+    return {'reboots': simulation.reboots,
+            'searches': simulation.searches,
+            'requests': simulation.requests,
+            'peakInFlight': simulation.peakInFlight,
+            'soapCalls': dict(simulation.gateway.calls),
+            'mappings': len(simulation.gateway.mappings),
+            'restoreSeconds': summarize(simulation.restoreTimes)}
+
+
+def runReconcile(mappings=1000, hours=24, interval=60, rebootEvery=7200,
+                 downtime=60, latency=0.005):
+    """
+    Keep C{mappings} registered mappings in place for C{hours} of
+    simulated time, while the gateway reboots every C{rebootEvery}
+    seconds.
+
+    @return: a dictionary describing the scenario and its results.
+    """
+    reactor = SimulatedReactor()
+    simulation = SimulatedGateway(reactor, latency=latency)
+    simulation.expected = mappings
+    factory = SimulatedFactory(reactor, simulation)
+    mapperReactor = MapperReactor(factory, reactor=reactor)
+    started = time.time()
+
+    registered = list()
+    for n in range(mappings):
+        registered.append(mapperReactor.registerMapping(
+            IPv4Address('TCP', reactor.host, 10000 + n)))
+    mapperReactor.startReconciling(interval)
+    mapperReactor.startWatching()
+    end = int(hours * 3600)
+    for at in range(rebootEvery, end, rebootEvery):
+        reactor.callLater(at, simulation.reboot, downtime)
+    reactor.run(end)
+    mapperReactor.stopReconciling()
+    mapperReactor.stopWatching()
+    simulation.stop()
+
+    results = gatewayReport(simulation)
+    results.update({'discoveries': factory.discoveries,
+                    'registered': len([d for d in registered if d.called]),
+                    'datagrams': reactor.datagrams,
+                    'wallSeconds': time.time() - started})
+    return {'scenario': 'reconcile', 'mappings': mappings, 'hours': hours,
+            'interval': interval, 'rebootEvery': rebootEvery,
+            'downtime': downtime, 'latency': latency, 'results': results}
+
+
+def runDiscoveryTimeout(attempts=10, timeout=5, latency=0.005):
+    """
+    Discover a gateway that is up, then one that is down, C{attempts}
+    times each.
+
+    @return: a dictionary describing the scenario and its results.
+    """
+    reactor = SimulatedReactor()
+    simulation = SimulatedGateway(reactor, latency=latency)
+    results = {}
+    for up in (True, False):
+        simulation.up = up
+        samples = list()
+        failures = [0]
+        def eb(reason):
+            reason.trap(error.TimeoutError)
+            failures[0] += 1
+        def done(result, before):
+            samples.append(reactor.seconds() - before)
+        for n in range(attempts):
+            d = SimulatedFactory(reactor, simulation, timeout).buildInstance()
+            d.addErrback(eb).addCallback(done, reactor.seconds())
+            while not d.called:
+                reactor.run(reactor.seconds() + 1)
+        results['up' if up else 'down'] = {
+            'seconds': summarize(samples), 'failures': failures[0]}
+    simulation.stop()
+    results['datagrams'] = reactor.datagrams
+    return {'scenario': 'discoveryTimeout', 'attempts': attempts,
+            'timeout': timeout, 'latency': latency, 'results': results}
+
+
+def runRediscoveryStorm(clients=100, downtime=30, latency=0.005,
+                        settle=600):
+    """
+    Let C{clients} processes, each keeping one mapping, watch the
+    gateway while it reboots.
+
+    @return: a dictionary describing the scenario and its results.
+    """
+    reactor = SimulatedReactor()
+    simulation = SimulatedGateway(reactor, latency=latency)
+    simulation.expected = clients
+    factories = list()
+    mapperReactors = list()
+    for n in range(clients):
+        factory = SimulatedFactory(reactor, simulation)
+        mapperReactor = MapperReactor(factory, reactor=reactor)
+        mapperReactor.registerMapping(
+            IPv4Address('TCP', reactor.host, 20000 + n))
+        mapperReactor.startWatching()
+        factories.append(factory)
+        mapperReactors.append(mapperReactor)
+    reactor.run(settle)
+
+    before = (sum(f.discoveries for f in factories), simulation.searches,
+              simulation.requests, reactor.datagrams)
+    simulation.peakInFlight = 0
+    started = time.time()
+    simulation.reboot(downtime)
+    reactor.run(reactor.seconds() + downtime + settle)
+    for mapperReactor in mapperReactors:
+        mapperReactor.stopWatching()
+    simulation.stop()
+
+    results = gatewayReport(simulation)
+    results.update({
+        'discoveries': sum(f.discoveries for f in factories) - before[0],
+        'searches': simulation.searches - before[1],
+        'requests': simulation.requests - before[2],
+        'datagrams': reactor.datagrams - before[3],
+        'wallSeconds': time.time() - started})
+    return {'scenario': 'rediscoveryStorm', 'clients': clients,
+            'downtime': downtime, 'latency': latency, 'results': results}
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['mappings', None, 1000, "Mappings kept by the reconciler.", int],
+        ['hours', None, 24, "Simulated hours of reconciliation.", float],
+        ['interval', None, 60, "Seconds between checks.", float],
+        ['reboot-every', None, 7200, "Seconds between reboots.", int],
+        ['downtime', None, 60, "Seconds a reboot takes.", float],
+        ['clients', None, 100, "Clients of the rediscovery storm.", int],
+        ['attempts', None, 10, "Discoveries of the timeout scenario.",
+         int],
+        ['latency', None, 0.005, "Router latency in seconds.", float],
+        ['output', 'o', None, "File to write the JSON results to."],
+        ]
+
+
+def runSimulations(config):
+    """
+    Run all scenarios described by C{config}.
+
+    @return: the JSON document.
+    """
+    scenarios = [
+        runReconcile(config['mappings'], config['hours'],
+                     config['interval'], config['reboot-every'],
+                     config['downtime'], config['latency']),
+        runDiscoveryTimeout(config['attempts'], latency=config['latency']),
+        runRediscoveryStorm(config['clients'], config['downtime'],
+                            config['latency'])]
+    return {'simulation': 'natmap', 'time': time.time(),
+            'scenarios': scenarios}
+
+
+def main(argv):
+    config = Options()
+    config.parseOptions(argv)
+    output = json.dumps(runSimulations(config), indent=2, sort_keys=True)
+    if config['output'] is None:
+        sys.stdout.write(output + '\n')
+    else:
+        f = open(config['output'], 'w')
+        try:
+            f.write(output + '\n')
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import defer, error
+from natmap import upnp, batch
+from natmap.test.test_upnp import TestProxy
+
+from StringIO import StringIO
+import json
+
+
+class ParseTestCase(unittest.TestCase):
+
+    def test_parseOperations(self):
+        """
+        Verify that arguments are applied to the operation before
+        them.
+        """
+        self.assertEquals(
+            batch.parseOperations(['list', 'map', '10.0.0.2:80',
+                                   '10.0.0.2:53/udp', 'external-ip']),
+            [('list', None), ('map', '10.0.0.2:80'),
+             ('map', '10.0.0.2:53/udp'), ('external-ip', None)])
+
+    def test_badOperations(self):
+        for words in (['frobnicate'], ['map'], ['map', 'list'],
+                      ['unmap', 'nonsense']):
+            self.assertRaises(ValueError, batch.parseOperations, words)
+
+    def test_parseAddress(self):
+        address = batch.parseAddress('10.0.0.2:53/udp')
+        self.assertEquals((address.type, address.host, address.port),
+                          ('UDP', '10.0.0.2', 53))
+
+    def test_readOperations(self):
+        f = StringIO('# maintenance\nmap 10.0.0.2:80  # web\nlist\n')
+        self.assertEquals(batch.readOperations(f),
+                          ['map', '10.0.0.2:80', 'list'])
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.mapper = upnp.UPnPMapper(self.proxy)
+        self.batch = batch.Batch(self.mapper)
+
+    def test_mapUnmap(self):
+        """
+        Verify that a batch walks the table once and reports every
+        operation.
+        """
+        operations = batch.parseOperations(
+            ['map', '10.0.0.2:80', '10.0.0.3:80', 'list',
+             'unmap', '10.0.0.2:80', '10.0.0.4:80', 'external-ip'])
+        def cb(results):
+            self.assertEquals(
+                self.proxy.calls.count('GetGenericPortMappingEntry'), 1)
+            self.assertEquals(len(results), 6)
+            for result in results:
+                self.assertTrue(result['seconds'] >= 0)
+            self.assertEquals(len(results[2]['result']), 2)
+            self.assertEquals(results[2]['result'][0]['owner'], 'natmap')
+            self.assertNotIn('error', results[3])
+            self.assertIn('NoSuchMappingError', results[4]['error'])
+            self.assertEquals(results[5]['result'], '1.1.1.1')
+            self.assertEquals(len(self.proxy.mappings), 1)
+        return self.batch.run(operations).addCallback(cb)
+
+    def test_unmapOwner(self):
+        """
+        Verify that the mappings of an owner are deleted and others
+        are kept.
+        """
+        other = upnp.UPnPMapper(self.proxy, owner='other')
+        def cbMapped(result):
+            return self.batch.run([('unmap-owner', 'natmap')])
+        def cb(results):
+            self.assertEquals(results[0]['result'], 1)
+            self.assertEquals(len(self.proxy.mappings), 1)
+        d = other.map(batch.parseAddress('10.0.0.5:80'))
+        d.addCallback(lambda result: self.mapper.map(
+            batch.parseAddress('10.0.0.6:80')))
+        return d.addCallback(cbMapped).addCallback(cb)
+
+
+class MainTestCase(unittest.TestCase):
+
+    def test_discoveryFailed(self):
+        """
+        Verify that a failed discovery is written as a JSON error and
+        ends with a non-zero exit status.
+        """
+        self.patch(upnp, 'discoverMapper', lambda **kwargs: defer.fail(
+            error.TimeoutError()))
+        output = StringIO()
+        self.patch(batch.sys, 'stdout', output)
+        d = self.assertFailure(batch.main(None, 'list'), SystemExit)
+        def cb(e):
+            self.assertEquals(e.code, 1)
+            document = json.loads(output.getvalue())
+            self.assertIn('TimeoutError', document['error'])
+            self.assertNotIn('operations', document)
+        return d.addCallback(cb)
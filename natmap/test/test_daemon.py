@@ -0,0 +1,188 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import address, defer, error, reactor
+from natmap import upnp, daemon
+from natmap.mapper import MapperReactor, MapperInstanceFactory
+from natmap.test.test_upnp import TestProxy
+from natmap.test.test_reconcile import MapperFactory
+from natmap.test.test_feed import RecordingObserver
+
+
+class ServerFactory(daemon.MapperServerFactory):
+    """
+    Server factory that tells when a connection has been lost.
+    """
+
+    def __init__(self, mapperReactor):
+        daemon.MapperServerFactory.__init__(self, mapperReactor)
+        self.lost = defer.Deferred()
+        self.protocols = list()
+
+    def buildProtocol(self, addr):
+        p = daemon.MapperServerFactory.buildProtocol(self, addr)
+        self.protocols.append(p)
+        connectionLost = p.connectionLost
+        def lost(reason):
+            connectionLost(reason)
+            self.lost.callback(None)
+        p.connectionLost = lost
+        return p
+
+
+class DaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.mapperReactor = MapperReactor(
+            MapperFactory(upnp.UPnPMapper(self.proxy)))
+        self.factory = ServerFactory(self.mapperReactor)
+        self.path = self.mktemp()
+        self.port = reactor.listenUNIX(self.path, self.factory)
+        self.address = address.IPv4Address('TCP', '192.168.1.1', 1322)
+        return daemon.discoverMapper(self.path).addCallback(
+            self._cbConnected)
+
+    def _cbConnected(self, mapper):
+        self.mapper = mapper
+
+    def tearDown(self):
+        transport = self.mapper.connection.transport
+        if transport is not None:
+            transport.loseConnection()
+        return defer.gatherResults([self.factory.lost,
+                                    self.port.stopListening()])
+
+    def test_discoverExternalHost(self):
+        """
+        Verify that the external IP address is answered by the daemon.
+        """
+        def cb(externalHost):
+            self.assertEquals(externalHost, '1.1.1.1')
+        return self.mapper.discoverExternalHost().addCallback(cb)
+
+    def test_mapUnmap(self):
+        """
+        Verify that mappings are made and removed by the daemon.
+        """
+        def cbMapped(externalAddress):
+            self.assertEquals(externalAddress.type, 'TCP')
+            self.assertEquals(externalAddress.host, '1.1.1.1')
+            self.assertEquals(len(self.proxy.mappings), 1)
+            return self.mapper.unmap(self.address)
+        def cbUnmapped(result):
+            self.assertEquals(self.proxy.mappings, [])
+        d = self.mapper.map(self.address)
+        return d.addCallback(cbMapped).addCallback(cbUnmapped)
+
+    def test_unmapMissing(self):
+        """
+        Verify that unmapping an unknown address fails with
+        L{NoSuchMappingError}.
+        """
+        return self.assertFailure(self.mapper.unmap(self.address),
+                                  daemon.NoSuchMappingError)
+
+    def test_connectionLost(self):
+        """
+        Verify that the mappings of a client are removed when its
+        connection is lost.
+        """
+        def cbMapped(externalAddress):
+            self.mapper.connection.transport.loseConnection()
+            return self.factory.lost
+        def cbLost(result):
+            self.assertEquals(self.proxy.mappings, [])
+        d = self.mapper.map(self.address)
+        return d.addCallback(cbMapped).addCallback(cbLost)
+
+    def test_fallback(self):
+        """
+        Verify that the next discoverer is used when no daemon is
+        running.
+        """
+        mapper = upnp.UPnPMapper(self.proxy)
+        factory = MapperInstanceFactory((
+            lambda: daemon.discoverMapper(self.mktemp()),
+            lambda: defer.succeed(mapper)))
+        def cb(result):
+            self.assertIdentical(result, mapper)
+        return factory.buildInstance().addCallback(cb)
+
+
+class RestoringObserver(RecordingObserver):
+    """
+    Recording observer that tells when a mapping has been restored.
+    """
+
+    def __init__(self):
+        RecordingObserver.__init__(self)
+        self.restored = defer.Deferred()
+
+    def mappingRestored(self, internalAddress, externalAddress):
+        RecordingObserver.mappingRestored(self, internalAddress,
+                                          externalAddress)
+        self.restored.callback(externalAddress)
+
+
+class DaemonLostTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.factory = ServerFactory(MapperReactor(
+            MapperFactory(upnp.UPnPMapper(self.proxy))))
+        self.path = self.mktemp()
+        self.port = reactor.listenUNIX(self.path, self.factory)
+        self.fallbackProxy = TestProxy()
+        self.fallback = upnp.UPnPMapper(self.fallbackProxy)
+        self.mapperReactor = MapperReactor(MapperInstanceFactory((
+            lambda: daemon.discoverMapper(self.path),
+            lambda: defer.succeed(self.fallback))))
+        self.observer = RestoringObserver()
+        self.mapperReactor.addObserver(self.observer)
+        self.address = address.IPv4Address('TCP', '192.168.1.1', 1322)
+
+    def test_daemonLost(self):
+        """
+        Verify that when the daemon goes away the mapper is discovered
+        anew, and the mappings made through the daemon are made again
+        through the new mapper.
+        """
+        def cbMapped(externalAddress):
+            self.assertEquals(len(self.proxy.mappings), 1)
+            d = self.port.stopListening()
+            self.factory.protocols[0].transport.loseConnection()
+            return defer.gatherResults([d, self.factory.lost,
+                                        self.observer.restored])
+        def cbRestored(result):
+            self.assertIdentical(self.mapperReactor.singleton.instance,
+                                 self.fallback)
+            self.assertEquals(len(self.fallbackProxy.mappings), 1)
+            self.assertEquals(
+                self.fallbackProxy.mappings[0]['NewInternalPort'], 1322)
+            self.assertEquals([event[0] for event in self.observer.events],
+                              ['added', 'lost', 'restored'])
+        d = self.mapperReactor.mapAddress(self.address)
+        return d.addCallback(cbMapped).addCallback(cbRestored)
@@ -0,0 +1,104 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import address, defer
+from natmap import direct, upnp
+from natmap.test.test_upnp import TestProxy
+
+
+class IsPublicAddressTestCase(unittest.TestCase):
+
+    def test_public(self):
+        for host in ('8.8.8.8', '1.1.1.1', '172.32.0.1', '100.128.0.1'):
+            self.assertTrue(direct.isPublicAddress(host), host)
+
+    def test_notPublic(self):
+        for host in ('10.1.2.3', '172.16.0.1', '172.31.255.255',
+                     '192.168.1.1', '127.0.0.1', '169.254.1.1',
+                     '100.64.0.1', '0.0.0.0', '239.255.255.250',
+                     'not an address'):
+            self.assertFalse(direct.isPublicAddress(host), host)
+
+
+class DirectMapperTestCase(unittest.TestCase):
+
+    def test_map(self):
+        """
+        Verify that addresses are mapped to themselves.
+        """
+        mapper = direct.DirectMapper('8.8.8.8')
+        internal = address.IPv4Address('UDP', '8.8.8.8', 5060)
+        def cb(external):
+            self.assertEquals((external.type, external.host, external.port),
+                              ('UDP', '8.8.8.8', 5060))
+            return mapper.unmap(internal)
+        return mapper.map(internal).addCallback(cb)
+
+    def test_discoverPublic(self):
+        """
+        Verify that a direct mapper is used on a host with a public
+        address.
+        """
+        self.patch(direct, 'discoverInternalHost',
+                   lambda reactor: defer.succeed('8.8.8.8'))
+        def cb(mapper):
+            self.assertIsInstance(mapper, direct.DirectMapper)
+            return mapper.discoverExternalHost()
+        d = direct.discoverMapper().addCallback(cb)
+        return d.addCallback(self.assertEquals, '8.8.8.8')
+
+    def test_discoverPrivate(self):
+        """
+        Verify that discovery fails on a host with a private address.
+        """
+        self.patch(direct, 'discoverInternalHost',
+                   lambda reactor: defer.succeed('192.168.1.10'))
+        return self.assertFailure(direct.discoverMapper(),
+                                  direct.NotPublicError)
+
+    def test_noTranslation(self):
+        """
+        Verify that a device that answers our own address as its
+        external address is bypassed.
+        """
+        proxy = TestProxy()
+        proxy.external = '192.168.1.10'
+        self.patch(direct, 'discoverInternalHost',
+                   lambda reactor: defer.succeed('192.168.1.10'))
+        def cb(mapper):
+            self.assertIsInstance(mapper, direct.DirectMapper)
+            self.assertEquals(mapper.host, '192.168.1.10')
+        d = direct.checkTranslation(upnp.UPnPMapper(proxy))
+        return d.addCallback(cb)
+
+    def test_translation(self):
+        """
+        Verify that a device that translates addresses is kept.
+        """
+        mapper = upnp.UPnPMapper(TestProxy())
+        self.patch(direct, 'discoverInternalHost',
+                   lambda reactor: defer.succeed('192.168.1.10'))
+        d = direct.checkTranslation(mapper)
+        return d.addCallback(self.assertIdentical, mapper)
@@ -0,0 +1,216 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import address, error
+from natmap import upnp, soap, metrics
+from natmap.mapper import MapperReactor
+from natmap.test.fakeigd import FakeGateway, FakeGatewayService
+from natmap.test import benchmark
+from natmap.test.test_reconcile import MapperFactory
+
+
+class EndToEndTestCase(unittest.TestCase):
+    """
+    Tests that run discovery and mapping over the network against a
+    fake gateway on the loopback interface.
+    """
+
+    def setUp(self):
+        self.gateway = FakeGateway(tableSize=5)
+        self.service = FakeGatewayService(self.gateway, ssdpPort=0)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+    def discover(self, **options):
+        return upnp.discoverMapper(
+            timeout=5, searchAddress=self.service.searchAddress(), **options)
+
+    def test_discover(self):
+        """
+        Verify that the gateway is found and its external address
+        fetched.
+        """
+        def cbDiscovered(mapper):
+            return mapper.discoverExternalHost()
+        d = self.discover().addCallback(cbDiscovered)
+        return d.addCallback(self.assertEquals, '1.1.1.1')
+
+    def test_unicastSearch(self):
+        """
+        Verify that the default gateway is searched by unicast next to
+        the multicast search.
+        """
+        self.patch(upnp, 'defaultGateway', lambda: '127.0.0.1')
+        self.patch(upnp, 'SSDP_PORT', self.service.searchAddress()[1])
+        def cbDiscovered(mapper):
+            return mapper.discoverExternalHost()
+        d = upnp.discoverMapper(timeout=5).addCallback(cbDiscovered)
+        return d.addCallback(self.assertEquals, '1.1.1.1')
+
+    def test_discoverTimeout(self):
+        """
+        Verify that discovery gives up when nothing answers.
+        """
+        d = upnp.discoverMapper(timeout=0.1, searchAddress=('127.0.0.1', 9))
+        return self.assertFailure(d, error.TimeoutError)
+
+    def test_mapUnmap(self):
+        """
+        Verify that an address can be mapped and unmapped.
+        """
+        internal = address.IPv4Address('TCP', '192.168.1.1', 1322)
+
+        def cbDiscovered(mapper):
+            return mapper.map(internal).addCallback(cbMapped, mapper)
+
+        def cbMapped(external, mapper):
+            self.assertEquals(external.host, '1.1.1.1')
+            self.assertEquals(len(self.gateway.mappings), 6)
+            return mapper.unmap(internal)
+
+        def cbUnmapped(result):
+            self.assertEquals(len(self.gateway.mappings), 5)
+
+        return self.discover().addCallback(cbDiscovered).addCallback(
+            cbUnmapped)
+
+    def test_windowedWalk(self):
+        """
+        Verify that a windowed walk over the network returns the whole
+        table in order.
+        """
+        def cbDiscovered(mapper):
+            return mapper.getMappings()
+
+        def cbMappings(mappings):
+            self.assertEquals([m.externalPort for m in mappings],
+                              range(10000, 10005))
+
+        d = self.discover(fetchWindow=3)
+        return d.addCallback(cbDiscovered).addCallback(cbMappings)
+
+    def test_fault(self):
+        """
+        Verify that a fault answered by the gateway is raised as a
+        L{soap.SOAPFault}.
+        """
+        def cbDiscovered(mapper):
+            self.gateway.faultRate = 1
+            return self.assertFailure(mapper.discoverExternalHost(),
+                                      soap.SOAPFault)
+        return self.discover().addCallback(cbDiscovered)
+
+    def test_drop(self):
+        """
+        Verify that a dropped connection while walking the table is
+        not taken for the end of the table.
+        """
+        def cbDiscovered(mapper):
+            self.gateway.dropRate = 1
+            mapper.proxy.retries = 0
+            return self.assertFailure(mapper.getMappings(),
+                                      error.ConnectionDone,
+                                      error.ConnectionLost)
+        return self.discover().addCallback(cbDiscovered)
+
+    def test_metrics(self):
+        """
+        Verify that discovery phases and remote calls are reported to
+        metrics observers.
+        """
+        collector = metrics.collect()
+        self.addCleanup(metrics.removeObserver, collector)
+
+        def cbDiscovered(mapper):
+            self.gateway.faultRate = 1
+            return mapper.discoverExternalHost().addErrback(
+                ebExternalHost, mapper)
+
+        def ebExternalHost(reason, mapper):
+            reason.trap(soap.SOAPFault)
+            snapshot = collector.snapshot()
+            self.assertEquals(sorted(snapshot['discovery'].keys()),
+                              ['description', 'search', 'total'])
+            stats = snapshot['gateways'][mapper.proxy.url]
+            self.assertEquals(stats['GetExternalIPAddress']['calls'], 1)
+            self.assertEquals(stats['GetExternalIPAddress']['faults'], 1)
+
+        return self.discover().addCallback(cbDiscovered)
+
+    def test_callTimeout(self):
+        """
+        Verify that a request the gateway never answers times out and
+        is retried.
+        """
+        def cbDiscovered(mapper):
+            self.gateway.latency = 60
+            mapper.proxy.timeout = 0.05
+            mapper.proxy.backoff = 0.01
+            return self.assertFailure(mapper.discoverExternalHost(),
+                                      error.TimeoutError)
+
+        def cbFailed(result):
+            self.assertEquals(self.gateway.calls['GetExternalIPAddress'], 3)
+        d = self.discover(proxyOptions={'retries': 2})
+        return d.addCallback(cbDiscovered).addCallback(cbFailed)
+
+    def test_operationDeadline(self):
+        """
+        Verify that an operation of L{MapperReactor} is bounded by its
+        deadline when the gateway hangs.
+        """
+        def cbDiscovered(mapper):
+            self.gateway.latency = 60
+            mapperReactor = MapperReactor(MapperFactory(mapper), timeout=0.1)
+            return self.assertFailure(
+                mapperReactor.mapAddress(
+                    address.IPv4Address('TCP', '192.168.1.1', 1322)),
+                error.TimeoutError)
+        return self.discover().addCallback(cbDiscovered)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_runScenario(self):
+        """
+        Verify that a small benchmark scenario runs and reports every
+        operation.
+        """
+        def cb(scenario):
+            results = scenario['results']
+            self.assertEquals(sorted(results.keys()),
+                              ['discoverExternalHost', 'discoverMapper',
+                               'mapListeningPort', 'unmapListeningPort'])
+            for result in results.itervalues():
+                self.assertEquals((result['count'], result['errors']),
+                                  (2, 0))
+        return benchmark.runScenario(3, 0, 1, 2).addCallback(cb)
+
+    def test_import(self):
+        """
+        Verify that importing natmap loads none of the backends.
+        """
+        result = benchmark.measureImport(runs=1)
+        self.assertEquals(result['heavy'], [])
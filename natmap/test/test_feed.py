@@ -0,0 +1,103 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from natmap.feed import MappingFeed
+
+
+class RecordingObserver:
+    """
+    Mapping observer that records the events it is told about.
+    """
+
+    def __init__(self):
+        self.events = list()
+
+    def mappingAdded(self, internalAddress, externalAddress):
+        self.events.append(('added', internalAddress.port,
+                            externalAddress.host, externalAddress.port))
+
+    def mappingLost(self, internalAddress, externalAddress):
+        self.events.append(('lost', internalAddress.port,
+                            externalAddress.host, externalAddress.port))
+
+    def mappingRestored(self, internalAddress, externalAddress):
+        self.events.append(('restored', internalAddress.port,
+                            externalAddress.host, externalAddress.port))
+
+    def externalAddressChanged(self, previousHost, externalHost):
+        self.events.append(('changed', previousHost, externalHost))
+
+
+class ExternalHostObserver:
+
+    def __init__(self):
+        self.changes = list()
+
+    def externalAddressChanged(self, previousHost, externalHost):
+        self.changes.append((previousHost, externalHost))
+
+
+class MappingFeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.feed = MappingFeed()
+
+    def test_externalHostChanged(self):
+        """
+        Verify that observers are told only when the external address
+        differs from the one seen before.
+        """
+        observer = ExternalHostObserver()
+        self.feed.addObserver(observer)
+        for host in ('1.1.1.1', '1.1.1.1', '2.2.2.2', '2.2.2.2'):
+            self.feed.externalHostSeen(host)
+        self.assertEquals(observer.changes, [('1.1.1.1', '2.2.2.2')])
+
+    def test_failingObserver(self):
+        """
+        Verify that an observer that fails is logged, and does not
+        keep the others from being told.
+        """
+        class FailingObserver:
+            def externalAddressChanged(self, previousHost, externalHost):
+                raise RuntimeError("failed")
+        observer = ExternalHostObserver()
+        self.feed.addObserver(FailingObserver())
+        self.feed.addObserver(observer)
+        self.feed.externalHostSeen('1.1.1.1')
+        self.feed.externalHostSeen('2.2.2.2')
+        self.assertEquals(observer.changes, [('1.1.1.1', '2.2.2.2')])
+        self.assertEquals(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_removeObserver(self):
+        """
+        Verify that a removed observer is no longer told.
+        """
+        observer = ExternalHostObserver()
+        self.feed.addObserver(observer)
+        self.feed.removeObserver(observer)
+        self.feed.externalHostSeen('1.1.1.1')
+        self.feed.externalHostSeen('2.2.2.2')
+        self.assertEquals(observer.changes, [])
@@ -0,0 +1,53 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+
+import natmap
+
+
+class CompatibilityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        natmap.__dict__.pop('mapperReactor', None)
+        self.addCleanup(natmap.__dict__.pop, 'mapperReactor', None)
+
+    def test_mapperReactor(self):
+        """
+        Verify that the deprecated C{natmap.mapperReactor} is the
+        mapper reactor of the package, and warns.
+        """
+        self.assertIdentical(natmap.mapperReactor, natmap.getMapperReactor())
+        warnings = self.flushWarnings([self.test_mapperReactor])
+        self.assertEquals(len(warnings), 1)
+        self.assertIdentical(warnings[0]['category'], DeprecationWarning)
+
+    def test_mapperInstanceFactory(self):
+        """
+        Verify that C{MapperInstanceFactory} is still provided by the
+        package.
+        """
+        from natmap.mapper import MapperInstanceFactory
+        self.assertIdentical(natmap.MapperInstanceFactory,
+                             MapperInstanceFactory)
@@ -0,0 +1,95 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from natmap import internal
+
+
+ROUTES = """\
+Iface	Destination	Gateway 	Flags	RefCnt	Use	Metric	Mask		MTU	Window	IRTT
+eth0	0000A8C0	00000000	0001	0	0	0	00FFFFFF	0	0	0
+eth0	00000000	0101A8C0	0003	0	0	0	00000000	0	0	0
+"""
+
+MULTIHOMED_ROUTES = ROUTES + """\
+eth1	0000000A	00000000	0001	0	0	0	000000FF	0	0	0
+eth1	00000000	0100000A	0003	0	0	100	00000000	0	0	0
+"""
+
+
+class DefaultGatewayTestCase(unittest.TestCase):
+
+    def writeRoutes(self, data):
+        path = self.mktemp()
+        f = open(path, 'w')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_defaultGateway(self):
+        """
+        Verify that the gateway of the default route is found.
+        """
+        path = self.writeRoutes(ROUTES)
+        self.assertEquals(internal.defaultGateway(path), '192.168.1.1')
+
+    def test_noDefaultRoute(self):
+        """
+        Verify that C{None} is returned without a default route.
+        """
+        path = self.writeRoutes(ROUTES.splitlines(True)[0]
+                                + ROUTES.splitlines(True)[1])
+        self.assertIdentical(internal.defaultGateway(path), None)
+
+    def test_noRoutingTable(self):
+        """
+        Verify that C{None} is returned if the routing table cannot be
+        read.
+        """
+        self.assertIdentical(internal.defaultGateway(self.mktemp()), None)
+
+    def test_defaultRoutes(self):
+        """
+        Verify that every interface with a default route is found.
+        """
+        path = self.writeRoutes(MULTIHOMED_ROUTES)
+        self.assertEquals(internal.defaultRoutes(path),
+                          [('eth0', '192.168.1.1'), ('eth1', '10.0.0.1')])
+        self.assertEquals(internal.defaultGateway(path), '192.168.1.1')
+
+    def test_discoverUplinks(self):
+        """
+        Verify that the uplinks are found with the addresses of their
+        interfaces, and that interfaces without one are left out.
+        """
+        path = self.writeRoutes(MULTIHOMED_ROUTES)
+        self.patch(internal, 'interfaceAddress',
+                   {'eth0': '192.168.1.10', 'eth1': '10.0.0.10'}.get)
+        self.assertEquals(internal.discoverUplinks(path),
+                          [('eth0', '192.168.1.10', '192.168.1.1'),
+                           ('eth1', '10.0.0.10', '10.0.0.1')])
+        self.patch(internal, 'interfaceAddress',
+                   {'eth1': '10.0.0.10'}.get)
+        self.assertEquals(internal.discoverUplinks(path),
+                          [('eth1', '10.0.0.10', '10.0.0.1')])
@@ -0,0 +1,317 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from natmap import direct, mapper, upnp
+from natmap.mapper import MapperReactor
+from natmap.test.test_upnp import TestProxy
+from natmap.test.test_notify import CountingFactory
+from natmap.test.benchmark import FakeListeningPort
+from natmap.test.test_feed import RecordingObserver
+
+
+class DirectFactory:
+
+    def buildInstance(self):
+        return direct.DirectMapper('8.8.8.8')
+
+
+class FailingFactory:
+
+    def buildInstance(self):
+        raise RuntimeError("no mapper available")
+
+
+class DiscoverGatewayMapperTestCase(unittest.TestCase):
+
+    def test_defaultJournal(self):
+        """
+        Verify that the UPnP mapper is given the default journal, so
+        that its mappings can be swept.
+        """
+        from natmap import sweep
+        def discoverMapper(reactor, journal):
+            return defer.succeed(upnp.UPnPMapper(TestProxy(),
+                                                 journal=journal))
+        self.patch(upnp, 'discoverMapper', discoverMapper)
+        self.patch(mapper, 'checkTranslation',
+                   lambda m, reactor, lookupInternalHost: m)
+        self.patch(sweep, '_defaultJournal', sweep.Journal(self.mktemp()))
+        def cb(result):
+            self.assertIdentical(result.journal, sweep.getDefaultJournal())
+        return mapper.discoverGatewayMapper().addCallback(cb)
+
+
+class PrewarmTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.internalLookups = list()
+        def discoverInternalHost(reactor):
+            self.internalLookups.append(True)
+            return defer.succeed('192.168.1.10')
+        self.patch(mapper, 'discoverInternalHost', discoverInternalHost)
+        self.proxy = TestProxy()
+        self.factory = CountingFactory(self.proxy)
+        self.mapperReactor = MapperReactor(self.factory)
+
+    def test_prewarm(self):
+        """
+        Verify that after prewarming, mapping a port neither discovers
+        the mapper nor the internal address again.
+        """
+        def cbPrewarmed(result):
+            self.assertEquals(self.factory.built, 1)
+            self.assertEquals(self.mapperReactor.internalHost,
+                              '192.168.1.10')
+            self.assertEquals(self.mapperReactor.externalHost, '1.1.1.1')
+            return self.mapperReactor.mapListeningPort(
+                FakeListeningPort('0.0.0.0', 1322))
+        def cbMapped(externalAddress):
+            self.assertEquals(self.factory.built, 1)
+            self.assertEquals(len(self.internalLookups), 1)
+            self.assertEquals(self.proxy.mappings[0]['NewInternalClient'],
+                              '192.168.1.10')
+        d = self.mapperReactor.prewarm()
+        return d.addCallback(cbPrewarmed).addCallback(cbMapped)
+
+    def test_discoveryLookup(self):
+        """
+        Verify that discovering the mapper while prewarming shares
+        the lookup of the internal address with the reactor, instead
+        of looking it up again.
+        """
+        lookups = list()
+        def discoverInternalHost(reactor):
+            lookups.append(defer.Deferred())
+            return lookups[-1]
+        self.patch(mapper, 'discoverInternalHost', discoverInternalHost)
+        self.patch(direct, 'discoverInternalHost', discoverInternalHost)
+        def discoverGatewayMapper(lookupInternalHost=None):
+            return direct.checkTranslation(
+                upnp.UPnPMapper(self.proxy),
+                lookupInternalHost=lookupInternalHost)
+        mapperReactor = MapperReactor(mapper.MapperInstanceFactory(
+            (direct.discoverMapper, discoverGatewayMapper)))
+        d = mapperReactor.prewarm()
+        self.assertEquals(len(lookups), 1)
+        lookups[0].callback('192.168.1.10')
+        def cb(result):
+            self.assertEquals(len(lookups), 1)
+            self.assertIsInstance(mapperReactor.singleton.instance,
+                                  upnp.UPnPMapper)
+        return d.addCallback(cb)
+
+    def test_prewarmFailure(self):
+        """
+        Verify that prewarming does not fail when no mapper is found,
+        and that the mapper is looked for again later.
+        """
+        self.mapperReactor = MapperReactor(FailingFactory())
+        def cb(result):
+            self.assertIdentical(result, None)
+            self.assertIdentical(self.mapperReactor.singleton.instance, None)
+        return self.mapperReactor.prewarm().addCallback(cb)
+
+
+UPLINKS = [('eth0', '192.168.1.10', '192.168.1.1'),
+           ('eth1', '10.0.0.10', '10.0.0.1')]
+
+
+class UplinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.factory = CountingFactory(self.proxy)
+        self.proxies = {}
+        for address, external in (('192.168.1.10', '2.2.2.2'),
+                                  ('10.0.0.10', '3.3.3.3')):
+            self.proxies[address] = TestProxy()
+            self.proxies[address].external = external
+        self.uplinkFactories = {}
+        def uplinkFactory(address, gateway, reactor):
+            factory = CountingFactory(self.proxies[address])
+            self.uplinkFactories[address] = factory
+            return factory
+        self.mapperReactor = MapperReactor(
+            self.factory, uplinks=UPLINKS, uplinkFactory=uplinkFactory)
+
+    def test_route(self):
+        """
+        Verify that a port bound to the address of an uplink is mapped
+        through the mapper of that uplink.
+        """
+        def cb(externalAddress):
+            self.assertEquals(externalAddress.host, '3.3.3.3')
+            self.assertEquals(len(self.proxies['10.0.0.10'].mappings), 1)
+            self.assertEquals(self.proxies['192.168.1.10'].mappings, [])
+            self.assertEquals(self.factory.built, 0)
+        return self.mapperReactor.mapListeningPort(
+            FakeListeningPort('10.0.0.10', 1322)).addCallback(cb)
+
+    def test_rebooted(self):
+        """
+        Verify that the mappers of the uplinks are discovered anew
+        after a reboot.
+        """
+        port = FakeListeningPort('10.0.0.10', 1322)
+        def cbMapped(externalAddress):
+            factory = self.uplinkFactories['10.0.0.10']
+            self.mapperReactor.gatewayRebooted()
+            return self.mapperReactor.mapListeningPort(port).addCallback(
+                cbMappedAgain, factory)
+        def cbMappedAgain(externalAddress, factory):
+            self.assertEquals(factory.built, 2)
+        return self.mapperReactor.mapListeningPort(port).addCallback(
+            cbMapped)
+
+    def test_otherAddress(self):
+        """
+        Verify that a port bound to an address of no uplink is mapped
+        through the mapper of the factory.
+        """
+        def cb(externalAddress):
+            self.assertEquals(externalAddress.host, '1.1.1.1')
+            self.assertEquals(self.factory.built, 1)
+        return self.mapperReactor.mapListeningPort(
+            FakeListeningPort('172.16.0.10', 1322)).addCallback(cb)
+
+    def test_singleUplink(self):
+        """
+        Verify that on a host with a single uplink the mapper of the
+        factory is used.
+        """
+        self.mapperReactor.uplinks = UPLINKS[:1]
+        def cb(externalAddress):
+            self.assertEquals(externalAddress.host, '1.1.1.1')
+            self.assertEquals(self.mapperReactor.uplinkMappers, {})
+        return self.mapperReactor.mapListeningPort(
+            FakeListeningPort('192.168.1.10', 1322)).addCallback(cb)
+
+    def test_allUplinks(self):
+        """
+        Verify that a wildcard port is mapped, and unmapped, on every
+        uplink at once.
+        """
+        port = FakeListeningPort('0.0.0.0', 1322)
+        def cbMapped(externalAddresses):
+            self.assertEquals(
+                dict((host, address.host) for host, address
+                     in externalAddresses.items()),
+                {'192.168.1.10': '2.2.2.2', '10.0.0.10': '3.3.3.3'})
+            for proxy in self.proxies.values():
+                self.assertEquals(len(proxy.mappings), 1)
+            return self.mapperReactor.unmapListeningPortOnAllUplinks(port)
+        def cbUnmapped(result):
+            for proxy in self.proxies.values():
+                self.assertEquals(proxy.mappings, [])
+        d = self.mapperReactor.mapListeningPortOnAllUplinks(port)
+        return d.addCallback(cbMapped).addCallback(cbUnmapped)
+
+
+class ObserverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.mapperReactor = MapperReactor(CountingFactory(self.proxy))
+        self.observer = RecordingObserver()
+        self.mapperReactor.addObserver(self.observer)
+        self.port = FakeListeningPort('192.168.1.10', 1322)
+
+    def test_mapped(self):
+        """
+        Verify that a mapped port is reported as added, and as lost
+        and restored when the mapping device reboots, but not once
+        unmapped.
+        """
+        def cbMapped(externalAddress):
+            self.assertEquals(self.observer.events, [
+                ('added', 1322, '1.1.1.1', externalAddress.port)])
+            self.mapperReactor.gatewayRebooted()
+            self.assertEquals(self.observer.events[1:], [
+                ('lost', 1322, '1.1.1.1', externalAddress.port),
+                ('restored', 1322, '1.1.1.1', externalAddress.port)])
+            return self.mapperReactor.unmapListeningPort(self.port)
+        def cbUnmapped(result):
+            del self.observer.events[:]
+            self.mapperReactor.gatewayRebooted()
+            self.assertEquals(self.observer.events, [])
+        d = self.mapperReactor.mapListeningPort(self.port)
+        d.addCallback(cbMapped)
+        return d.addCallback(cbUnmapped)
+
+    def test_externalAddressChanged(self):
+        """
+        Verify that a change of the external address is reported.
+        """
+        def cb(externalHost):
+            self.proxy.external = '2.2.2.2'
+            self.mapperReactor.externalHost = None
+            return self.mapperReactor.discoverExternalHost()
+        def cbChanged(externalHost):
+            self.assertEquals(self.observer.events,
+                              [('changed', '1.1.1.1', '2.2.2.2')])
+        d = self.mapperReactor.discoverExternalHost()
+        return d.addCallback(cb).addCallback(cbChanged)
+
+
+class UnmapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.mapperReactor = MapperReactor(CountingFactory(self.proxy))
+        self.port = FakeListeningPort('192.168.1.10', 1322)
+
+    def test_unmapKnownPort(self):
+        """
+        Verify that a port mapped through the reactor is unmapped by
+        its external port, without walking the table.
+        """
+        def cbMapped(externalAddress):
+            del self.proxy.calls[:]
+            return self.mapperReactor.unmapListeningPort(self.port)
+        def cbUnmapped(result):
+            self.assertEquals(self.proxy.calls, ['DeletePortMapping'])
+            self.assertEquals(self.proxy.mappings, [])
+        d = self.mapperReactor.mapListeningPort(self.port)
+        return d.addCallback(cbMapped).addCallback(cbUnmapped)
+
+
+class DirectMapperReactorTestCase(unittest.TestCase):
+
+    def test_registerMapping(self):
+        """
+        Verify that mappings can be registered, and the device
+        rebooted, on a host with a public address.
+        """
+        mapperReactor = MapperReactor(DirectFactory())
+        internal = IPv4Address('TCP', '8.8.8.8', 1322)
+        def cbRegistered(externalAddress):
+            self.assertEquals((externalAddress.host, externalAddress.port),
+                              ('8.8.8.8', 1322))
+            mapperReactor.gatewayRebooted()
+            return mapperReactor.reconciler.reconcile()
+        d = mapperReactor.registerMapping(internal)
+        return d.addCallback(cbRegistered)
@@ -0,0 +1,68 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.python import failure
+from natmap import metrics, soap
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        """
+        Verify that percentiles are reported as bucket bounds.
+        """
+        histogram = metrics.Histogram()
+        for latency in [0.0005] * 90 + [0.3] * 10:
+            histogram.add(latency)
+        self.assertEquals(histogram.percentile(0.5), 0.001)
+        self.assertEquals(histogram.percentile(0.99), 0.5)
+
+    def test_overflow(self):
+        """
+        Verify that samples slower than the last bucket are reported
+        with the largest latency seen.
+        """
+        histogram = metrics.Histogram()
+        histogram.add(12.0)
+        self.assertEquals(histogram.percentile(0.99), 12.0)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_snapshot(self):
+        """
+        Verify that calls are counted per gateway and action, and
+        faults told apart from other errors.
+        """
+        collector = metrics.Metrics()
+        collector.callCompleted('http://gw/', 'AddPortMapping', 0.01, None)
+        collector.callCompleted('http://gw/', 'AddPortMapping', 0.01,
+                                failure.Failure(soap.SOAPFault('', None)))
+        collector.callCompleted('http://gw/', 'AddPortMapping', 0.01,
+                                failure.Failure(RuntimeError()))
+        stats = collector.snapshot()['gateways']['http://gw/']
+        self.assertEquals((stats['AddPortMapping']['calls'],
+                           stats['AddPortMapping']['faults'],
+                           stats['AddPortMapping']['errors']), (3, 1, 1))
@@ -0,0 +1,193 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import address
+from natmap import upnp, notify
+from natmap.mapper import MapperReactor
+from natmap.test.test_upnp import TestProxy
+from natmap.test.test_feed import RecordingObserver
+from natmap.test.benchmark import FakeListeningPort
+
+
+UDN = 'uuid:11111111-2222-3333-4444-555555555555'
+
+
+def alive(bootID=None, host='192.168.1.1', udn=UDN):
+    lines = ['NOTIFY * HTTP/1.1',
+             'HOST: 239.255.255.250:1900',
+             'CACHE-CONTROL: max-age=120',
+             'LOCATION: http://%s:5000/rootDesc.xml' % (host,),
+             'NT: upnp:rootdevice',
+             'NTS: ssdp:alive',
+             'USN: %s::upnp:rootdevice' % (udn,)]
+    if bootID is not None:
+        lines.append('BOOTID.UPNP.ORG: %d' % (bootID,))
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+def byebye(udn=UDN):
+    return ('NOTIFY * HTTP/1.1\r\n'
+            'HOST: 239.255.255.250:1900\r\n'
+            'NT: upnp:rootdevice\r\n'
+            'NTS: ssdp:byebye\r\n'
+            'USN: %s::upnp:rootdevice\r\n\r\n' % (udn,))
+
+
+class NotifyListenerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reboots = list()
+        self.listener = notify.NotifyListener(
+            lambda: self.reboots.append(True), '192.168.1.1')
+
+    def receive(self, data):
+        self.listener.datagramReceived(data, ('192.168.1.1', 1900))
+
+    def test_alive(self):
+        """
+        Verify that repeated announcements are not taken as reboots.
+        """
+        self.receive(alive(1))
+        self.receive(alive(1))
+        self.assertEquals(self.reboots, [])
+
+    def test_bootID(self):
+        """
+        Verify that a new BOOTID is taken as a reboot.
+        """
+        self.receive(alive(1))
+        self.receive(alive(2))
+        self.receive(alive(2))
+        self.assertEquals(self.reboots, [True])
+
+    def test_byebye(self):
+        """
+        Verify that a device that comes back after saying goodbye has
+        rebooted.
+        """
+        self.receive(alive())
+        self.receive(byebye())
+        self.assertEquals(self.reboots, [])
+        self.receive(alive())
+        self.assertEquals(self.reboots, [True])
+
+    def test_otherDevice(self):
+        """
+        Verify that the notifications of other devices are ignored.
+        """
+        udn = 'uuid:other'
+        self.receive(alive(1, host='192.168.1.7', udn=udn))
+        self.receive(byebye(udn))
+        self.receive(alive(2, host='192.168.1.7', udn=udn))
+        self.assertEquals(self.reboots, [])
+
+    def test_garbage(self):
+        """
+        Verify that datagrams that are not notifications are ignored.
+        """
+        self.receive('M-SEARCH * HTTP/1.1\r\n\r\n')
+        self.receive('NOTIFY * HTTP/1.1\r\nbad header\r\n\r\n')
+        self.assertEquals(self.reboots, [])
+
+
+class CountingFactory:
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.built = 0
+
+    def buildInstance(self):
+        self.built += 1
+        return upnp.UPnPMapper(self.proxy)
+
+
+class RebootTestCase(unittest.TestCase):
+
+    def test_restore(self):
+        """
+        Verify that on a reboot the mapper is discovered anew and the
+        registered mappings restored.
+        """
+        proxy = TestProxy()
+        factory = CountingFactory(proxy)
+        mapperReactor = MapperReactor(factory)
+        mapperReactor.listener = notify.NotifyListener(
+            mapperReactor.gatewayRebooted, '192.168.1.1')
+        internal = address.IPv4Address('TCP', '192.168.1.10', 1322)
+
+        def cbRegistered(externalAddress):
+            del proxy.mappings[:]
+            mapperReactor.listener.datagramReceived(alive(1), None)
+            mapperReactor.listener.datagramReceived(alive(2), None)
+            self.assertEquals(factory.built, 2)
+            self.assertEquals(len(proxy.mappings), 1)
+            self.assertEquals(proxy.mappings[0]['NewExternalPort'],
+                              externalAddress.port)
+        d = mapperReactor.registerMapping(internal)
+        return d.addCallback(cbRegistered)
+
+    def test_nothingToRestore(self):
+        """
+        Verify that a reboot does not discover the mapper or walk the
+        table when there are no mappings to restore.
+        """
+        proxy = TestProxy()
+        factory = CountingFactory(proxy)
+        mapperReactor = MapperReactor(factory)
+        mapperReactor.listener = notify.NotifyListener(
+            mapperReactor.gatewayRebooted, '192.168.1.1')
+        mapperReactor.listener.datagramReceived(alive(1), None)
+        mapperReactor.listener.datagramReceived(alive(2), None)
+        self.assertEquals(factory.built, 0)
+        self.assertEquals(proxy.calls, [])
+
+    def test_restoreMapped(self):
+        """
+        Verify that on a reboot a port mapped with C{mapListeningPort}
+        is mapped again, and reported as restored.
+        """
+        proxy = TestProxy()
+        factory = CountingFactory(proxy)
+        mapperReactor = MapperReactor(factory)
+        mapperReactor.listener = notify.NotifyListener(
+            mapperReactor.gatewayRebooted, '192.168.1.1')
+        observer = RecordingObserver()
+        mapperReactor.addObserver(observer)
+        port = FakeListeningPort('192.168.1.10', 1322)
+
+        def cbMapped(externalAddress):
+            del proxy.mappings[:]
+            del observer.events[:]
+            mapperReactor.listener.datagramReceived(alive(1), None)
+            mapperReactor.listener.datagramReceived(alive(2), None)
+            self.assertEquals(factory.built, 2)
+            self.assertEquals(len(proxy.mappings), 1)
+            self.assertEquals(proxy.mappings[0]['NewInternalPort'], 1322)
+            self.assertEquals(observer.events, [
+                ('lost', 1322, '1.1.1.1', externalAddress.port),
+                ('restored', 1322, '1.1.1.1', externalAddress.port)])
+            return mapperReactor.unmapListeningPort(port)
+        d = mapperReactor.mapListeningPort(port)
+        return d.addCallback(cbMapped)
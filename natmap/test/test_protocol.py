@@ -0,0 +1,117 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from natmap import protocol
+from natmap.xmlbuilder import Namespace
+
+
+DESCRIPTION = """<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <device>
+    <serviceList>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:Layer3Forwarding:1</serviceType>
+        <controlURL>/l3f</controlURL>
+      </service>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:WANIPConnection:1</serviceType>
+        <controlURL>/ctl/IPConn</controlURL>
+      </service>
+    </serviceList>
+  </device>
+</root>
+"""
+
+
+class ProtocolTestCase(unittest.TestCase):
+    """
+    The protocol functions work on plain strings, without a reactor.
+    """
+
+    def test_parseSearchResponse(self):
+        code, headers, body = protocol.parseSearchResponse(
+            'HTTP/1.1 200 OK\r\nLOCATION: http://10.0.0.1/desc.xml\r\n'
+            'ST: upnp:rootdevice\r\n\r\n')
+        self.assertEquals(code, '200')
+        self.assertEquals(headers['location'], 'http://10.0.0.1/desc.xml')
+
+    def test_parseSearchResponseMalformed(self):
+        self.assertRaises(protocol.BadResponseError,
+                          protocol.parseSearchResponse, 'garbage')
+        self.assertRaises(protocol.BadResponseError,
+                          protocol.parseSearchResponse,
+                          'HTTP/1.1 404 Not Found\r\n\r\n')
+
+    def test_searchRequest(self):
+        request = protocol.searchRequest()
+        self.assertIn('Host:239.255.255.250:1900\r\n', request)
+        self.assertIn('MX:3\r\n', request)
+        self.assertTrue(request.endswith('\r\n\r\n'))
+
+    def test_unicastSearchRequest(self):
+        request = protocol.searchRequest('192.168.1.1', 1900)
+        self.assertIn('Host:192.168.1.1:1900\r\n', request)
+        self.assertNotIn('MX:', request)
+
+    def test_parseDescription(self):
+        controlURL, serviceType = protocol.parseDescription(
+            DESCRIPTION, 'http://10.0.0.1:5000/desc.xml')
+        self.assertEquals(controlURL, 'http://10.0.0.1:5000/ctl/IPConn')
+        self.assertEquals(serviceType,
+                          'urn:schemas-upnp-org:service:WANIPConnection:1')
+
+    def test_parseDescriptionNoWANService(self):
+        self.assertRaises(protocol.BadResponseError,
+                          protocol.parseDescription,
+                          '<root xmlns="urn:schemas-upnp-org:device-1-0"/>',
+                          'http://10.0.0.1/')
+
+    def test_requestRoundTrip(self):
+        namespace = Namespace('urn:schemas-upnp-org:service:'
+                              'WANIPConnection:1', 'u')
+        postdata, headers = protocol.buildRequest(
+            namespace, 'GetExternalIPAddress', {'NewFoo': 1})
+        self.assertEquals(headers['SOAPAction'], '%s#%s' % (
+            namespace.uri, 'GetExternalIPAddress'))
+        self.assertEquals(protocol.parseResponse(postdata), {'NewFoo': '1'})
+
+    def test_parseFaultGarbage(self):
+        fault = protocol.parseFault('not xml')
+        self.assertIsInstance(fault, protocol.SOAPFault)
+
+    def test_mappingFromEntry(self):
+        mapping = protocol.mappingFromEntry({
+            'NewProtocol': 'TCP', 'NewInternalClient': '10.0.0.2',
+            'NewInternalPort': '80', 'NewExternalPort': '8080'})
+        self.assertEquals((mapping.type, mapping.internalHost,
+                           mapping.internalPort, mapping.externalPort),
+                          ('TCP', '10.0.0.2', 80, 8080))
+        self.assertIdentical(mapping.description, None)
+
+    def test_pickExternalPort(self):
+        port = protocol.pickExternalPort('TCP', 80, set())
+        self.assertTrue(1025 <= port <= 65535)
+        used = set(('TCP', p) for p in range(1025, 65536))
+        self.assertEquals(protocol.pickExternalPort('TCP', 80, used), 80)
@@ -0,0 +1,240 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import address, defer, task
+from natmap import direct, upnp, reconcile, soap, util
+from natmap.feed import MappingFeed
+from natmap.test.test_upnp import TestProxy
+from natmap.test.test_feed import RecordingObserver
+
+
+class MapperFactory:
+
+    def __init__(self, mapper):
+        self.mapper = mapper
+
+    def buildInstance(self):
+        return self.mapper
+
+
+class ReconcilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.mapper = upnp.UPnPMapper(self.proxy)
+        self.reconciler = reconcile.Reconciler(
+            util.DeferredSingleton(MapperFactory(self.mapper)))
+        self.address = address.IPv4Address('TCP', '192.168.1.1', 1322)
+
+    def test_register(self):
+        """
+        Verify that registering an address maps it.
+        """
+        d = self.reconciler.register(self.address)
+        def cb(externalAddress):
+            self.assertEquals(externalAddress.host, '1.1.1.1')
+            self.assertEquals(len(self.proxy.mappings), 1)
+            self.assertEquals(self.proxy.mappings[0]['NewExternalPort'],
+                              externalAddress.port)
+        return d.addCallback(cb)
+
+    def test_quietCheck(self):
+        """
+        Verify that a check of an unchanged device does not walk the
+        table or write anything.
+        """
+        def cbRegistered(result):
+            del self.proxy.calls[:]
+            return self.reconciler.check()
+        def cbChecked(result):
+            self.assertEquals(self.proxy.calls,
+                              ['GetGenericPortMappingEntry',
+                               'GetGenericPortMappingEntry',
+                               'GetExternalIPAddress'])
+        d = self.reconciler.register(self.address)
+        return d.addCallback(cbRegistered).addCallback(cbChecked)
+
+    def test_restore(self):
+        """
+        Verify that a lost mapping is restored on the same external
+        port.
+        """
+        def cbRegistered(externalAddress):
+            del self.proxy.mappings[:]
+            return self.reconciler.check().addCallback(
+                cbChecked, externalAddress)
+        def cbChecked(result, externalAddress):
+            self.assertEquals(len(self.proxy.mappings), 1)
+            self.assertEquals(self.proxy.mappings[0]['NewExternalPort'],
+                              externalAddress.port)
+        d = self.reconciler.register(self.address)
+        return d.addCallback(cbRegistered)
+
+    def test_unregister(self):
+        """
+        Verify that unregistering an address deletes its mapping.
+        """
+        def cbRegistered(result):
+            return self.reconciler.unregister(self.address)
+        def cbUnregistered(result):
+            self.assertEquals(self.proxy.mappings, [])
+            self.assertEquals(self.reconciler.unwanted, {})
+        d = self.reconciler.register(self.address)
+        return d.addCallback(cbRegistered).addCallback(cbUnregistered)
+
+    def test_periodic(self):
+        """
+        Verify that the device is checked every interval once
+        started.
+        """
+        clock = task.Clock()
+        self.reconciler.interval = 10
+        self.reconciler.start(clock)
+        self.addCleanup(self.reconciler.stop)
+        self.reconciler.register(self.address)
+        del self.proxy.mappings[:]
+        clock.advance(10)
+        self.assertEquals(len(self.proxy.mappings), 1)
+
+
+class ReconcilerFeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.observer = RecordingObserver()
+        feed = MappingFeed()
+        feed.addObserver(self.observer)
+        self.reconciler = reconcile.Reconciler(util.DeferredSingleton(
+            MapperFactory(upnp.UPnPMapper(self.proxy))), feed=feed)
+        self.address = address.IPv4Address('TCP', '192.168.1.1', 1322)
+
+    def test_events(self):
+        """
+        Verify that a registered mapping is reported as added, and as
+        lost and restored when it disappears from the device, and that
+        a new external address is reported.
+        """
+        def cbRegistered(externalAddress):
+            self.port = externalAddress.port
+            del self.proxy.mappings[:]
+            self.proxy.external = '2.2.2.2'
+            return self.reconciler.check()
+        def cbChecked(result):
+            self.assertEquals(self.observer.events, [
+                ('added', 1322, '1.1.1.1', self.port),
+                ('changed', '1.1.1.1', '2.2.2.2'),
+                ('lost', 1322, '1.1.1.1', self.port),
+                ('restored', 1322, '2.2.2.2', self.port)])
+        d = self.reconciler.register(self.address)
+        return d.addCallback(cbRegistered).addCallback(cbChecked)
+
+    def test_lostOnce(self):
+        """
+        Verify that a mapping that cannot be restored is reported as
+        lost only once.
+        """
+        def cbRegistered(externalAddress):
+            del self.proxy.mappings[:]
+            self.proxy.AddPortMapping = lambda **mapping: defer.fail(
+                soap.SOAPFault(None, None))
+            return self.reconciler.check().addCallback(
+                lambda result: self.reconciler.check())
+        def cbChecked(result):
+            self.assertEquals([event[0] for event in self.observer.events],
+                              ['added', 'lost'])
+            self.flushLoggedErrors(soap.SOAPFault)
+        d = self.reconciler.register(self.address)
+        return d.addCallback(cbRegistered).addCallback(cbChecked)
+
+
+class CountingDirectMapper(direct.DirectMapper):
+
+    def __init__(self, host):
+        direct.DirectMapper.__init__(self, host)
+        self.mapped = list()
+        self.unmapped = list()
+
+    def map(self, address, trace=None):
+        self.mapped.append(address)
+        return direct.DirectMapper.map(self, address)
+
+    def unmap(self, address):
+        self.unmapped.append(address)
+        return direct.DirectMapper.unmap(self, address)
+
+
+class WithoutTableTestCase(unittest.TestCase):
+    """
+    Reconcile through a mapper that keeps no mapping table.
+    """
+
+    def setUp(self):
+        self.mapper = CountingDirectMapper('8.8.8.8')
+        self.singleton = util.DeferredSingleton(MapperFactory(self.mapper))
+        self.reconciler = reconcile.Reconciler(self.singleton)
+        self.address = address.IPv4Address('TCP', '8.8.8.8', 1322)
+
+    def test_register(self):
+        """
+        Verify that a registered address is mapped once, and that
+        neither reconciling nor checking again maps it anew.
+        """
+        def cbRegistered(externalAddress):
+            self.assertEquals((externalAddress.host, externalAddress.port),
+                              ('8.8.8.8', 1322))
+            return self.reconciler.reconcile()
+        def cbReconciled(result):
+            return self.reconciler.check()
+        def cbChecked(result):
+            self.assertEquals(self.mapper.mapped, [self.address])
+        d = self.reconciler.register(self.address)
+        d.addCallback(cbRegistered).addCallback(cbReconciled)
+        return d.addCallback(cbChecked)
+
+    def test_replaced(self):
+        """
+        Verify that the mappings are made again through a new mapper.
+        """
+        def cbRegistered(externalAddress):
+            self.mapper = CountingDirectMapper('8.8.8.8')
+            self.singleton.factory = MapperFactory(self.mapper)
+            self.singleton.reset()
+            return self.reconciler.check()
+        def cbChecked(result):
+            self.assertEquals(self.mapper.mapped, [self.address])
+        d = self.reconciler.register(self.address)
+        return d.addCallback(cbRegistered).addCallback(cbChecked)
+
+    def test_unregister(self):
+        """
+        Verify that an unregistered address is unmapped.
+        """
+        def cbRegistered(externalAddress):
+            return self.reconciler.unregister(self.address)
+        def cbUnregistered(result):
+            self.assertEquals(self.mapper.unmapped, [self.address])
+            self.assertEquals(self.reconciler.unwanted, {})
+        d = self.reconciler.register(self.address)
+        return d.addCallback(cbRegistered).addCallback(cbUnregistered)
@@ -0,0 +1,169 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import address, defer, task
+from twisted.web import error as weberror
+from natmap import record, soap
+from natmap.test.fakeigd import FakeGateway, FakeGatewayService
+
+
+class RecordReplayTestCase(unittest.TestCase):
+    """
+    Record the traffic with the fake gateway, then replay it without
+    the gateway.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.internal = address.IPv4Address('TCP', '192.168.1.10', 1322)
+        self.gateway = FakeGateway(tableSize=3, latency=0.01)
+        self.service = FakeGatewayService(self.gateway, ssdpPort=0)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+    @defer.inlineCallbacks
+    def exercise(self, mapper):
+        """
+        Run a few operations against C{mapper} and return their
+        results.
+        """
+        results = list()
+        mappings = yield mapper.getMappings()
+        results.append(len(mappings))
+        external = yield mapper.map(self.internal)
+        results.append(external.host)
+        results.append((yield mapper.discoverExternalHost()))
+        yield mapper.unmap(self.internal)
+        self.gateway.faultRate = 1
+        try:
+            yield mapper.discoverExternalHost()
+        except soap.SOAPFault:
+            results.append('fault')
+        self.gateway.faultRate = 0
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        """
+        Verify that a replay gives the results of the recording
+        without talking to the gateway.
+        """
+        recorder = record.Recorder(self.path)
+        mapper = yield recorder.discoverMapper(
+            searchAddress=self.service.searchAddress(),
+            proxyOptions={'retries': 0})
+        recorded = yield self.exercise(mapper)
+        recorder.close()
+        self.assertEquals(recorded, [3, '1.1.1.1', '1.1.1.1', 'fault'])
+        yield self.service.stopService()
+
+        replayer = record.Replayer(self.path, scale=0)
+        mapper = yield replayer.discoverMapper(proxyOptions={'retries': 0})
+        replayed = yield self.exercise(mapper)
+        self.assertEquals(replayed, recorded)
+
+    @defer.inlineCallbacks
+    def test_scale(self):
+        """
+        Verify that replayed answers are delayed by the scaled
+        recorded latency.
+        """
+        recorder = record.Recorder(self.path)
+        mapper = yield recorder.discoverMapper(
+            searchAddress=self.service.searchAddress())
+        yield mapper.discoverExternalHost()
+        recorder.close()
+
+        clock = task.Clock()
+        replayer = record.Replayer(self.path, scale=2, clock=clock)
+        latency = replayer.exchanges[-1]['latency']
+        d = replayer.getPage(mapper.proxy.url,
+                             postdata=replayer.exchanges[-1]['postdata'])
+        clock.advance(latency * 2 * 0.9)
+        self.assertFalse(d.called)
+        clock.advance(latency * 2 * 0.2)
+        self.assertTrue(d.called)
+        yield d
+
+
+class ExchangeTestCase(unittest.TestCase):
+    """
+    Record single exchanges made with a fake page getter.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.recorder = record.Recorder(self.path)
+
+    def replay(self):
+        self.recorder.close()
+        return record.Replayer(self.path, scale=0)
+
+    def test_binaryBody(self):
+        """
+        Verify that a body that is not valid UTF-8 is recorded and
+        replayed unchanged.
+        """
+        body = '\xff\xfe<s:Envelope/>\x80'
+        getPage = self.recorder.wrap(lambda url, **kwargs:
+                                     defer.succeed(body))
+        d = getPage('http://192.168.1.1:5000/ctl', postdata='\xe9')
+        def cbRecorded(data):
+            self.assertEquals(data, body)
+            return self.replay().getPage('http://192.168.1.1:5000/ctl',
+                                         postdata='\xe9')
+        def cbReplayed(data):
+            self.assertEquals(data, body)
+        return d.addCallback(cbRecorded).addCallback(cbReplayed)
+
+    def test_httpErrorWithoutBody(self):
+        """
+        Verify that an HTTP error without a body is replayed as the
+        same error.
+        """
+        getPage = self.recorder.wrap(lambda url, **kwargs: defer.fail(
+            weberror.Error('500', 'Internal Server Error', None)))
+        d = self.assertFailure(getPage('http://192.168.1.1:5000/ctl'),
+                               weberror.Error)
+        def cbRecorded(reason):
+            return self.assertFailure(self.replay().getPage(
+                'http://192.168.1.1:5000/ctl'), weberror.Error)
+        def cbReplayed(reason):
+            self.assertEquals(reason.status, '500')
+            self.assertIdentical(reason.response, None)
+        return d.addCallback(cbRecorded).addCallback(cbReplayed)
+
+    def test_writeFailure(self):
+        """
+        Verify that a failure to write the recording is logged and
+        does not fail the exchange.
+        """
+        self.recorder.close()
+        getPage = self.recorder.wrap(lambda url, **kwargs:
+                                     defer.succeed('body'))
+        def cb(data):
+            self.assertEquals(data, 'body')
+            self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+        return getPage('http://192.168.1.1:5000/ctl').addCallback(cb)
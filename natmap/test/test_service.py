@@ -0,0 +1,162 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.application import internet, service
+from twisted.internet import address, defer, error, protocol
+from twisted.python import log
+from natmap.inatmap import NoSuchMappingError
+from natmap.service import MappedService
+
+
+class FakeMapperReactor:
+    """
+    Stand-in for a L{MapperReactor} whose operations are answered by
+    the test.
+    """
+
+    def __init__(self):
+        self.maps = list()
+        self.unmaps = list()
+
+    def mapListeningPort(self, port):
+        d = defer.Deferred()
+        self.maps.append((port, d))
+        return d
+
+    def unmapListeningPort(self, port):
+        d = defer.Deferred()
+        self.unmaps.append((port, d))
+        return d
+
+    def answerMaps(self):
+        maps, self.maps = self.maps, list()
+        for port, d in maps:
+            d.callback(address.IPv4Address('TCP', '1.1.1.1',
+                                           port.getHost().port))
+
+
+class MappedServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mapperReactor = FakeMapperReactor()
+        self.service = MappedService(self.mapperReactor, concurrency=2,
+                                     stopTimeout=5)
+        self.servers = list()
+        for i in range(3):
+            server = internet.TCPServer(0, protocol.ServerFactory(),
+                                        interface='127.0.0.1')
+            server.setServiceParent(self.service)
+            self.servers.append(server)
+
+    def tearDown(self):
+        if self.service.running:
+            d = self.service.stopService()
+            for port, unmapped in self.mapperReactor.unmaps:
+                unmapped.callback(None)
+            return d
+
+    def test_mapped(self):
+        """
+        Verify that all ports are mapped, at most C{concurrency} at a
+        time, and that L{whenMapped} waits for all of them.
+        """
+        self.service.startService()
+        self.assertEquals(len(self.mapperReactor.maps), 2)
+        mapped = self.service.whenMapped()
+        self.mapperReactor.answerMaps()
+        self.assertEquals(len(self.mapperReactor.maps), 1)
+        self.assertFalse(mapped.called)
+        self.mapperReactor.answerMaps()
+        def cb(externalAddresses):
+            self.assertEquals(sorted(externalAddresses), sorted(self.servers))
+            for server, external in externalAddresses.items():
+                self.assertEquals(external.port,
+                                  server._port.getHost().port)
+        return mapped.addCallback(cb)
+
+    def test_stop(self):
+        """
+        Verify that the ports are unmapped together on stop.
+        """
+        self.service.startService()
+        self.mapperReactor.answerMaps()
+        self.mapperReactor.answerMaps()
+        d = self.service.stopService()
+        self.assertEquals(len(self.mapperReactor.unmaps), 3)
+        self.assertFalse(d.called)
+        for port, unmapped in self.mapperReactor.unmaps:
+            unmapped.callback(None)
+        def cb(result):
+            self.assertFalse(self.service.running)
+            self.assertEquals(self.service.externalAddresses, {})
+        return d.addCallback(cb)
+
+    def test_stopDeadline(self):
+        """
+        Verify that stopping does not wait for unmapping beyond the
+        deadline.
+        """
+        self.service.startService()
+        self.mapperReactor.answerMaps()
+        self.mapperReactor.answerMaps()
+        self.service.stopTimeout = 0.01
+        d = self.service.stopService()
+        def cb(result):
+            self.assertFalse(self.service.running)
+            self.assertEquals(
+                len(self.flushLoggedErrors(error.TimeoutError)), 1)
+        return d.addCallback(cb)
+
+    def test_stopWhileMapping(self):
+        """
+        Verify that mappings still being made are given up on stop,
+        and unmapped in case the device has added them already.  Not
+        finding them is no error.
+        """
+        self.service.startService()
+        mapped = self.service.whenMapped()
+        d = self.service.stopService()
+        self.assertEquals(len(self.mapperReactor.unmaps), 2)
+        (port, first), (port, second) = self.mapperReactor.unmaps
+        first.callback(None)
+        second.errback(NoSuchMappingError())
+        def cb(result):
+            self.assertEquals(mapped.result, {})
+            self.assertEquals(self.service.pending, {})
+        return d.addCallback(cb)
+
+    def test_noListeningPort(self):
+        """
+        Verify that a child without a listening port is logged and
+        left out.
+        """
+        messages = list()
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+        service.Service().setServiceParent(self.service)
+        self.service.startService()
+        self.assertEquals(len(self.mapperReactor.maps), 2)
+        self.assertTrue([m for m in messages
+                         if 'no listening port' in ' '.join(m['message'])])
@@ -0,0 +1,92 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+
+from natmap.mapper import MapperReactor
+from natmap.test import simulation
+
+
+class SimulationTestCase(unittest.TestCase):
+    """
+    Run small versions of the scenarios of the simulation.
+    """
+
+    def test_reconcile(self):
+        """
+        Verify that the registered mappings survive every reboot.
+        """
+        results = simulation.runReconcile(
+            mappings=10, hours=3, rebootEvery=3600)['results']
+        self.assertEquals(results['registered'], 10)
+        self.assertEquals(results['reboots'], 2)
+        self.assertEquals(results['mappings'], 10)
+        self.assertEquals(results['restoreSeconds']['count'], 2)
+
+    def test_discoveryTimeout(self):
+        """
+        Verify that discovery of a gateway that is down fails after
+        the timeout, in simulated time.
+        """
+        results = simulation.runDiscoveryTimeout(
+            attempts=2, timeout=5)['results']
+        self.assertEquals(results['up']['failures'], 0)
+        self.assertEquals(results['down']['failures'], 2)
+        self.assertEquals(results['down']['seconds']['max'], 5)
+
+    def test_rediscoveryStorm(self):
+        """
+        Verify that every client rediscovers the gateway once after
+        a reboot and restores its mapping.
+        """
+        results = simulation.runRediscoveryStorm(clients=5)['results']
+        self.assertEquals(results['discoveries'], 5)
+        self.assertEquals(results['mappings'], 5)
+
+    def test_externalHostCache(self):
+        """
+        Verify that the external address is cached for C{cacheTime}
+        seconds of the clock of the reactor.
+        """
+        reactor = simulation.SimulatedReactor()
+        gateway = simulation.SimulatedGateway(reactor)
+        self.addCleanup(gateway.stop)
+        mapperReactor = MapperReactor(
+            simulation.SimulatedFactory(reactor, gateway), cacheTime=300,
+            reactor=reactor)
+        def lookup():
+            results = list()
+            mapperReactor.discoverExternalHost().addCallback(results.append)
+            reactor.run(reactor.seconds() + 1)
+            return results
+        self.assertEquals(lookup(), ['1.1.1.1'])
+        calls = gateway.gateway.calls['GetExternalIPAddress']
+        reactor.run(200)
+        lookup()
+        self.assertEquals(gateway.gateway.calls['GetExternalIPAddress'],
+                          calls)
+        reactor.run(400)
+        lookup()
+        self.assertEquals(gateway.gateway.calls['GetExternalIPAddress'],
+                          calls + 1)
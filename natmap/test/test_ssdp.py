@@ -0,0 +1,157 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, reactor, task
+
+from natmap import internal, ssdp, upnp
+from natmap.test.fakeigd import (
+    FakeGateway, FakeGatewayService, DESCRIPTION, DEVICE_TYPE, SERVICE_TYPE)
+from natmap.test.simulation import SimulatedReactor, SimulatedGateway
+
+import gc
+import os
+
+
+class SearchPortTestCase(unittest.TestCase):
+    """
+    Discover the simulated gateway and check that the search port is
+    shared and closed.
+    """
+
+    def setUp(self):
+        self.reactor = SimulatedReactor()
+        self.gateway = SimulatedGateway(self.reactor)
+        self.addCleanup(self.gateway.stop)
+
+    def discover(self, timeout=5):
+        return upnp.discoverMapper(timeout, unicast=False,
+                                   pageGetter=self.gateway.getPage,
+                                   reactor=self.reactor)
+
+    def clientPorts(self):
+        return [port for (host, port) in self.reactor.ports
+                if host == self.reactor.host]
+
+    def test_shared(self):
+        """
+        Verify that searches running at the same time share one port,
+        which is closed when the last is done.
+        """
+        results = list()
+        for i in range(10):
+            self.discover().addCallback(results.append)
+        self.assertEquals(len(self.clientPorts()), 1)
+        searchPort = ssdp._searchPorts[(self.reactor, '')]
+        self.assertEquals(len(searchPort.searches), 10)
+        self.reactor.run(1)
+        self.assertEquals(len(results), 10)
+        self.assertEquals(self.clientPorts(), [])
+        self.assertEquals(ssdp._searchPorts, {})
+
+    def test_timeout(self):
+        """
+        Verify that the port is closed when the search times out.
+        """
+        self.gateway.up = False
+        d = self.discover()
+        self.reactor.run(5)
+        self.assertEquals(self.clientPorts(), [])
+        return self.assertFailure(d, error.TimeoutError)
+
+    def test_cancel(self):
+        """
+        Verify that the port is closed when the search is cancelled.
+        """
+        self.gateway.up = False
+        d = self.discover()
+        d.cancel()
+        self.assertEquals(self.clientPorts(), [])
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_internalHost(self):
+        """
+        Verify that the internal address is discovered through the
+        looped back multicast datagram, and that the port is closed.
+        """
+        results = list()
+        internal.localNetworkMulticastDiscover(self.reactor).addCallback(
+            results.append)
+        self.reactor.run(1)
+        self.assertEquals(results, [self.reactor.host])
+        self.assertEquals(self.clientPorts(), [])
+
+
+class LeakTestCase(unittest.TestCase):
+    """
+    Run thousands of discoveries over real sockets and check that
+    neither descriptors nor objects pile up.
+    """
+
+    def setUp(self):
+        if not os.path.isdir('/proc/self/fd'):
+            raise unittest.SkipTest("descriptors cannot be counted")
+        self.gateway = FakeGateway()
+        self.service = FakeGatewayService(self.gateway, ssdpPort=0)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+    def getPage(self, url, **kwargs):
+        return defer.succeed(DESCRIPTION % {
+            'base': 'http://127.0.0.1:5000/', 'deviceType': DEVICE_TYPE,
+            'serviceType': SERVICE_TYPE, 'udn': self.gateway.udn})
+
+    def discoverMany(self, count, concurrency=50):
+        semaphore = defer.DeferredSemaphore(concurrency)
+        def discover(n):
+            return upnp.discoverMapper(
+                searchAddress=self.service.searchAddress(),
+                pageGetter=self.getPage)
+        d = defer.DeferredList(
+            [semaphore.run(discover, n) for n in range(count)],
+            fireOnOneErrback=True)
+        return d.addCallback(lambda results: None)
+
+    def settle(self):
+        """
+        Collect garbage once the current call stack, which may hold
+        the results of the last discoveries, has unwound.
+        """
+        return task.deferLater(reactor, 0, gc.collect)
+
+    @defer.inlineCallbacks
+    def test_flat(self):
+        """
+        Verify that the number of open descriptors and live objects
+        is the same after 2000 discoveries as after 100.
+        """
+        yield self.discoverMany(100)
+        yield self.settle()
+        descriptors = len(os.listdir('/proc/self/fd'))
+        objects = len(gc.get_objects())
+        yield self.discoverMany(2000)
+        yield self.settle()
+        self.assertEquals(len(os.listdir('/proc/self/fd')), descriptors)
+        self.assertApproximates(len(gc.get_objects()), objects, 500)
+        self.assertEquals(ssdp._searchPorts, {})
@@ -0,0 +1,151 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, reactor, task
+from twisted.internet.protocol import DatagramProtocol
+from natmap import stun
+from natmap.mapper import MapperReactor
+from natmap.test.test_reconcile import MapperFactory
+
+import socket
+import struct
+
+
+def bindingResponse(transactionID, host, port, xor=True):
+    """
+    Build a successful answer to the binding request C{transactionID}.
+    """
+    address = struct.unpack('!L', socket.inet_aton(host))[0]
+    if xor:
+        attributeType = stun.XOR_MAPPED_ADDRESS
+        port ^= stun.MAGIC_COOKIE >> 16
+        address ^= stun.MAGIC_COOKIE
+    else:
+        attributeType = stun.MAPPED_ADDRESS
+    attribute = struct.pack('!HHxBHL', attributeType, 8, 0x01, port, address)
+    return struct.pack('!HHL', stun.BINDING_SUCCESS, len(attribute),
+                       stun.MAGIC_COOKIE) + transactionID + attribute
+
+
+class StunServer(DatagramProtocol):
+    """
+    Stand-in STUN server that answers binding requests with the
+    address they came from.
+
+    @ivar drop: the number of requests to ignore before answering.
+    """
+
+    def __init__(self, drop=0):
+        self.drop = drop
+        self.requests = 0
+
+    def datagramReceived(self, data, address):
+        self.requests += 1
+        if self.drop:
+            self.drop -= 1
+            return
+        self.transport.write(bindingResponse(data[8:20], *address), address)
+
+
+class ParseTestCase(unittest.TestCase):
+
+    transactionID = 'a' * 12
+
+    def test_xorMappedAddress(self):
+        data = bindingResponse(self.transactionID, '1.2.3.4', 4711)
+        self.assertEquals(stun.parseBindingResponse(data, self.transactionID),
+                          ('1.2.3.4', 4711))
+
+    def test_mappedAddress(self):
+        data = bindingResponse(self.transactionID, '1.2.3.4', 4711,
+                               xor=False)
+        self.assertEquals(stun.parseBindingResponse(data, self.transactionID),
+                          ('1.2.3.4', 4711))
+
+    def test_otherTransaction(self):
+        data = bindingResponse('b' * 12, '1.2.3.4', 4711)
+        self.assertRaises(stun.StunError, stun.parseBindingResponse,
+                          data, self.transactionID)
+
+    def test_short(self):
+        self.assertRaises(stun.StunError, stun.parseBindingResponse,
+                          'short', self.transactionID)
+
+
+class BindingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StunServer()
+        self.port = reactor.listenUDP(0, self.server, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.servers = [('127.0.0.1', self.port.getHost().port)]
+
+    def test_discoverExternalHost(self):
+        """
+        Verify that the external address is learned from the server.
+        """
+        d = stun.discoverExternalHost(self.servers)
+        return d.addCallback(self.assertEquals, '127.0.0.1')
+
+    def test_retransmit(self):
+        """
+        Verify that the request is sent again when it is lost.
+        """
+        self.server.drop = 1
+        protocol = stun.BindingProtocol(self.servers, rto=0.01)
+        def cb((host, port)):
+            self.assertEquals(host, '127.0.0.1')
+            self.assertEquals(self.server.requests, 2)
+        return protocol.query().addCallback(cb)
+
+    def test_timeout(self):
+        """
+        Verify that the query gives up when nothing answers.
+        """
+        self.server.drop = 1000
+        clock = task.Clock()
+        d = stun.BindingProtocol(self.servers, timeout=3,
+                                 clock=clock).query()
+        clock.advance(3)
+        return self.assertFailure(d, error.TimeoutError)
+
+    def test_race(self):
+        """
+        Verify that the STUN answer is used when the mapping device
+        does not answer, and that it is remembered.
+        """
+        class SilentMapper:
+            def discoverExternalHost(self):
+                return defer.Deferred()
+        mapperReactor = MapperReactor(MapperFactory(SilentMapper()),
+                                      stunServers=self.servers)
+        def cbFirst(externalHost):
+            self.assertEquals(externalHost, '127.0.0.1')
+            return mapperReactor.discoverExternalHost()
+        def cbSecond(externalHost):
+            self.assertEquals(externalHost, '127.0.0.1')
+            self.assertEquals(self.server.requests, 1)
+        d = mapperReactor.discoverExternalHost()
+        return d.addCallback(cbFirst).addCallback(cbSecond)
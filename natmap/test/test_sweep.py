@@ -0,0 +1,179 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import address, task
+from natmap import upnp, sweep
+from natmap.test.test_upnp import TestProxy
+
+import fcntl
+import os
+
+
+class SweepTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = TestProxy()
+        self.journal = sweep.Journal(self.mktemp())
+        self.mapper = upnp.UPnPMapper(self.proxy, journal=self.journal)
+        self.deadPid = self.findDeadPid()
+
+    def findDeadPid(self):
+        for pid in xrange(2 ** 22 - 1, 1, -1):
+            if not sweep.isAlive(pid):
+                return pid
+
+    def addMapping(self, instance, internalPort, externalPort, owner='natmap'):
+        self.proxy.mappings.append(
+            {'NewProtocol': 'TCP', 'NewInternalClient': '192.168.1.1',
+             'NewInternalPort': str(internalPort),
+             'NewExternalPort': str(externalPort),
+             'NewPortMappingDescription': upnp.formatDescription(
+                 '192.168.1.1', internalPort, 'TCP', owner, instance)})
+        self.journal.record(instance, upnp.Mapping(
+            'TCP', '192.168.1.1', internalPort, externalPort))
+
+    def test_tagged(self):
+        """
+        Verify that mappings are tagged with owner and instance and
+        recorded in the journal.
+        """
+        d = self.mapper.map(address.IPv4Address('TCP', '192.168.1.1', 1322))
+        def cb(externalAddress):
+            description = self.proxy.mappings[0]['NewPortMappingDescription']
+            self.assertEquals(upnp.parseOwner(description),
+                              ('natmap', os.getpid()))
+            self.assertEquals(sweep.Journal(self.journal.path).records,
+                              {('TCP', externalAddress.port):
+                                   (os.getpid(), '192.168.1.1', 1322)})
+        return d.addCallback(cb)
+
+    def test_sweep(self):
+        """
+        Verify that only mappings of dead instances are swept.
+        """
+        self.addMapping(self.deadPid, 1000, 2000)
+        self.addMapping(os.getpid(), 1001, 2001)
+        self.addMapping(self.deadPid, 1002, 2002, owner='other')
+        d = sweep.sweepStaleMappings(self.mapper, self.journal)
+        def cb(deleted):
+            self.assertEquals(deleted, 1)
+            self.assertEquals([m['NewExternalPort']
+                               for m in self.proxy.mappings],
+                              ['2001', '2002'])
+            self.assertEquals(sorted(self.journal.records.keys()),
+                              [('TCP', 2001)])
+        return d.addCallback(cb)
+
+    def test_takeOver(self):
+        """
+        Verify that a mapping left by a dead instance and reused is
+        tagged and recorded as made by the current instance, and so
+        not swept.
+        """
+        self.addMapping(self.deadPid, 1322, 2000)
+        d = self.mapper.map(address.IPv4Address('TCP', '192.168.1.1', 1322))
+        def cbMapped(externalAddress):
+            self.assertEquals(externalAddress.port, 2000)
+            description = self.proxy.mappings[-1]['NewPortMappingDescription']
+            self.assertEquals(upnp.parseOwner(description),
+                              ('natmap', os.getpid()))
+            self.assertEquals(sweep.Journal(self.journal.path).records,
+                              {('TCP', 2000):
+                                   (os.getpid(), '192.168.1.1', 1322)})
+            return sweep.sweepStaleMappings(self.mapper, self.journal)
+        def cbSwept(deleted):
+            self.assertEquals(deleted, 0)
+        return d.addCallback(cbMapped).addCallback(cbSwept)
+
+    def test_currentInstance(self):
+        """
+        Verify that the mappings of the instance of the mapper are not
+        swept, even if it is not the process ID.
+        """
+        self.mapper.instance = self.deadPid
+        self.addMapping(self.deadPid, 1000, 2000)
+        d = sweep.sweepStaleMappings(self.mapper, self.journal)
+        def cb(deleted):
+            self.assertEquals(deleted, 0)
+            self.assertEquals(len(self.proxy.mappings), 1)
+        return d.addCallback(cb)
+
+    def test_sharedJournal(self):
+        """
+        Verify that the records written through another L{Journal} on
+        the same file are kept.
+        """
+        other = sweep.Journal(self.journal.path)
+        self.journal.record(1, upnp.Mapping('TCP', '192.168.1.1', 1000, 2000))
+        other.record(2, upnp.Mapping('TCP', '192.168.1.2', 1001, 2001))
+        self.journal.forget(upnp.Mapping('TCP', '192.168.1.3', 1002, 2002))
+        self.assertEquals(sweep.Journal(self.journal.path).records, {
+            ('TCP', 2000): (1, '192.168.1.1', 1000),
+            ('TCP', 2001): (2, '192.168.1.2', 1001)})
+
+    def test_appended(self):
+        """
+        Verify that changes are appended to the journal, and that a
+        sweep compacts it.
+        """
+        mapping = upnp.Mapping('TCP', '192.168.1.1', 1000, 2000)
+        self.journal.record(os.getpid(), mapping)
+        self.journal.forget(mapping)
+        self.assertEquals(len(open(self.journal.path).readlines()), 2)
+        self.assertEquals(sweep.Journal(self.journal.path).records, {})
+        d = sweep.sweepStaleMappings(self.mapper, self.journal)
+        def cb(deleted):
+            self.assertEquals(open(self.journal.path).read(), '')
+        return d.addCallback(cb)
+
+    def test_lockHeld(self):
+        """
+        Verify that a change waits, without blocking, while another
+        process holds the lock of the journal.
+        """
+        clock = task.Clock()
+        journal = sweep.Journal(self.journal.path, clock=clock)
+        lock = open(journal.path + '.lock', 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        d = journal.record(1, upnp.Mapping('TCP', '192.168.1.1', 1000, 2000))
+        clock.advance(journal.retryDelay)
+        self.assertFalse(d.called)
+        lock.close()
+        clock.advance(journal.retryDelay)
+        self.assertTrue(d.called)
+        self.assertEquals(sweep.Journal(journal.path).records,
+                          {('TCP', 2000): (1, '192.168.1.1', 1000)})
+
+    def test_nothingDead(self):
+        """
+        Verify that the table is not walked when no instance in the
+        journal is dead.
+        """
+        self.addMapping(os.getpid(), 1001, 2001)
+        d = sweep.sweepStaleMappings(self.mapper, self.journal)
+        def cb(deleted):
+            self.assertEquals(deleted, 0)
+            self.assertEquals(self.proxy.calls, [])
+        return d.addCallback(cb)
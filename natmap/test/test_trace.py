@@ -0,0 +1,89 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import address, defer
+from natmap import upnp, trace
+from natmap.mapper import MapperReactor
+from natmap.test.test_upnp import TestProxy
+from natmap.test.test_reconcile import MapperFactory
+
+
+class ListeningPort:
+
+    def getHost(self):
+        return address.IPv4Address('TCP', '192.168.1.1', 1322)
+
+
+class TraceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.spans = list()
+        trace.setTracer(self.spans.append)
+        self.addCleanup(trace.setTracer, None)
+        self.proxy = TestProxy()
+        self.mapperReactor = MapperReactor(
+            MapperFactory(upnp.UPnPMapper(self.proxy)))
+
+    def test_disabled(self):
+        """
+        Verify that no trace is created without a tracer.
+        """
+        trace.setTracer(None)
+        self.assertIdentical(trace.start('mapListeningPort'), trace.NULL)
+
+    def test_mapListeningPort(self):
+        """
+        Verify that every phase of mapping a listening port is
+        reported under one correlation ID.
+        """
+        def cb(externalAddress):
+            self.assertEquals([span.name for span in self.spans],
+                              ['ensureInternalAddress', 'getMapper',
+                               'getMappings', 'allocateExternalPort',
+                               'AddPortMapping', 'GetExternalIPAddress',
+                               'mapListeningPort'])
+            self.assertEquals(len(set(span.traceID for span in self.spans)),
+                              1)
+            for span in self.spans:
+                self.assertEquals(span.operation, 'mapListeningPort')
+                self.assertIdentical(span.error, None)
+        d = self.mapperReactor.mapListeningPort(ListeningPort())
+        return d.addCallback(cb)
+
+    def test_error(self):
+        """
+        Verify that a failing phase is reported with its failure.
+        """
+        def AddPortMapping(**kw):
+            return defer.fail(RuntimeError("boom"))
+        self.proxy.AddPortMapping = AddPortMapping
+
+        def eb(reason):
+            reason.trap(RuntimeError)
+            failed = [span.name for span in self.spans
+                      if span.error is not None]
+            self.assertEquals(failed, ['AddPortMapping', 'mapListeningPort'])
+        d = self.mapperReactor.mapListeningPort(ListeningPort())
+        return d.addCallbacks(self.fail, eb)
@@ -35,6 +35,7 @@ class TestProxy:
     def __init__(self):
         self.mappings = list()
         self.external = '1.1.1.1'
+        self.calls = list()
 
     def GetExternalIPAddress(self):
         return defer.succeed(
@@ -45,6 +46,7 @@ class TestProxy:
         """
         Direct all calls to a local method.
         """
+        self.calls.append(methodName)
         return getattr(self, methodName)(**kw)
 
     def GetGenericPortMappingEntry(self, NewPortMappingIndex):
@@ -59,7 +61,7 @@ class TestProxy:
     def DeletePortMapping(self, NewRemoteHost='', NewExternalPort='',
                           NewProtocol=''):
         for i, mapping in enumerate(self.mappings):
-            if (mapping['NewExternalPort'] == str(NewExternalPort)
+            if (str(mapping['NewExternalPort']) == str(NewExternalPort)
                 and mapping['NewProtocol'] == NewProtocol):
                 del self.mappings[i]
                 return defer.succeed(None)
@@ -101,6 +103,36 @@ class MapperTestCase(unittest.TestCase):
         d = self.mapper.map(address.IPv4Address('TCP', '192.168.1.1', 1322))
         return d.addCallbacks(self.cbMapAddress, self.ebMapAddress)
 
+    def test_mapAddressReuse(self):
+        """
+        Verify that mapping an address that is already mapped reuses
+        the existing mapping instead of adding a new one.
+        """
+        self.proxy.mappings.append(
+            {'NewProtocol': 'TCP', 'NewInternalPort': '1322',
+             'NewExternalPort': '43123', 'NewInternalClient': '192.168.1.1'})
+        d = self.mapper.map(address.IPv4Address('TCP', '192.168.1.1', 1322))
+        def cb(externalAddress):
+            self.assertEquals(externalAddress.port, 43123)
+            self.assertEquals(len(self.proxy.mappings), 1)
+        return d.addCallback(cb)
+
+    def test_mapAddressRefresh(self):
+        """
+        Verify that an existing mapping is written again when
+        C{refreshExisting} is set.
+        """
+        self.mapper.refreshExisting = True
+        self.proxy.mappings.append(
+            {'NewProtocol': 'TCP', 'NewInternalPort': '1322',
+             'NewExternalPort': '43123', 'NewInternalClient': '192.168.1.1'})
+        d = self.mapper.map(address.IPv4Address('TCP', '192.168.1.1', 1322))
+        def cb(externalAddress):
+            self.assertEquals(externalAddress.port, 43123)
+            self.assertEquals(self.proxy.mappings[-1]['NewExternalPort'],
+                              43123)
+        return d.addCallback(cb)
+
     def cbUnmapAddress(self, result):
         pass
 
@@ -117,3 +149,157 @@ class MapperTestCase(unittest.TestCase):
              'NewInternalClient':'192.168.1.1'})
         d = self.mapper.unmap(address.IPv4Address('TCP', '192.168.1.1', 1232))
         return d.addCallbacks(self.cbUnmapAddress, self.ebUnmapAddress)
+
+
+class RenumberingTestProxy(TestProxy):
+    """
+    A L{TestProxy} that deletes the first mapping while the table is
+    walked, as a concurrent unmap would, so that the mappings after it
+    move down by one.
+    """
+
+    renumbered = False
+
+    def GetGenericPortMappingEntry(self, NewPortMappingIndex):
+        if NewPortMappingIndex == 1 and not self.renumbered:
+            self.renumbered = True
+            del self.mappings[0]
+        return TestProxy.GetGenericPortMappingEntry(
+            self, NewPortMappingIndex)
+
+
+class UnmapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = RenumberingTestProxy()
+        self.mapper = upnp.UPnPMapper(self.proxy)
+        for port in (1000, 1322):
+            self.proxy.mappings.append(
+                {'NewProtocol': 'TCP', 'NewInternalPort': str(port),
+                 'NewExternalPort': str(port + 40000),
+                 'NewInternalClient': '192.168.1.1'})
+        self.address = address.IPv4Address('TCP', '192.168.1.1', 1322)
+
+    def test_renumbered(self):
+        """
+        Verify that a mapping missed because the table was renumbered
+        while it was walked is found by walking it again.
+        """
+        def cb(result):
+            self.assertEquals(self.proxy.mappings, [])
+        return self.mapper.unmap(self.address).addCallback(cb)
+
+    def test_missing(self):
+        """
+        Verify that unmapping an address that has no mapping fails
+        with L{NoSuchMappingError} after the table is walked twice.
+        """
+        self.address.port = 1323
+        d = self.assertFailure(self.mapper.unmap(self.address),
+                               upnp.NoSuchMappingError)
+        def cb(reason):
+            self.assertEquals(
+                self.proxy.calls.count('GetGenericPortMappingEntry'), 4)
+        return d.addCallback(cb)
+
+    def test_unmapFrom(self):
+        """
+        Verify that a mapping whose external port is known is deleted
+        without walking the table.
+        """
+        def cb(result):
+            self.assertEquals(self.proxy.calls, ['DeletePortMapping'])
+            self.assertEquals(len(self.proxy.mappings), 1)
+            self.assertEquals(self.proxy.mappings[0]['NewInternalPort'],
+                              '1000')
+        return self.mapper.unmapFrom(self.address, 41322).addCallback(cb)
+
+
+class DelayedTestProxy(TestProxy):
+    """
+    A L{TestProxy} that holds back the answers to
+    C{GetGenericPortMappingEntry} until L{flush} is called.
+    """
+
+    def __init__(self):
+        TestProxy.__init__(self)
+        self.pending = list()
+        self.maxPending = 0
+
+    def GetGenericPortMappingEntry(self, NewPortMappingIndex):
+        d = defer.Deferred()
+        self.pending.append((d, NewPortMappingIndex))
+        self.maxPending = max(self.maxPending, len(self.pending))
+        return d
+
+    def flush(self):
+        """
+        Answer all outstanding requests, the last one first.
+        """
+        while self.pending:
+            d, index = self.pending.pop()
+            TestProxy.GetGenericPortMappingEntry(self, index).chainDeferred(d)
+
+
+class WindowedFetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = DelayedTestProxy()
+        for port in range(2000, 2010):
+            self.proxy.mappings.append(
+                {'NewProtocol': 'TCP', 'NewInternalPort': str(port),
+                 'NewExternalPort': str(port + 1000),
+                 'NewInternalClient': '192.168.1.1'})
+        self.mapper = upnp.UPnPMapper(self.proxy, fetchWindow=4)
+
+    def test_ordered(self):
+        """
+        Verify that entries fetched out of order are returned in
+        index order.
+        """
+        result = list()
+        self.mapper.getMappings().addCallback(result.extend)
+        while self.proxy.pending:
+            self.proxy.flush()
+        self.assertEquals([m.internalPort for m in result], range(2000, 2010))
+
+    def test_window(self):
+        """
+        Verify that no more than the window of requests is
+        outstanding at any time.
+        """
+        self.mapper.getMappings()
+        while self.proxy.pending:
+            self.assertTrue(len(self.proxy.pending) <= 4)
+            self.proxy.flush()
+        self.assertEquals(self.proxy.maxPending, 4)
+
+    def test_iterMappingsStops(self):
+        """
+        Verify that no more entries are requested once the visitor
+        asks to stop.
+        """
+        self.mapper.fetchWindow = 1
+        visited = list()
+        def visit(mapping):
+            visited.append(mapping)
+            return mapping.internalPort == 2002
+        result = list()
+        self.mapper.iterMappings(visit).addCallback(result.append)
+        while self.proxy.pending:
+            self.proxy.flush()
+        self.assertEquals(len(visited), 3)
+        self.assertEquals(result[0].externalPort, 3002)
+
+    def test_findMappingMissing(self):
+        """
+        Verify that L{upnp.UPnPMapper.findMapping} gives C{None} when
+        the table holds no matching entry.
+        """
+        result = list()
+        self.mapper.findMapping(
+            address.IPv4Address('UDP', '192.168.1.1', 2000)
+            ).addCallback(result.append)
+        while self.proxy.pending:
+            self.proxy.flush()
+        self.assertEquals(result, [None])
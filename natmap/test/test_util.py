@@ -0,0 +1,227 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+from natmap import util
+
+
+class NeverFactory:
+    """
+    Instance factory whose instance never arrives.
+    """
+
+    def buildInstance(self):
+        return defer.Deferred()
+
+
+class DeferredSingletonTestCase(unittest.TestCase):
+
+    def test_cancelWaiter(self):
+        """
+        Verify that a cancelled waiter is forgotten.
+        """
+        singleton = util.DeferredSingleton(NeverFactory())
+        d = singleton.get()
+        d.cancel()
+        self.assertEquals(singleton.waiters, [])
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancelledBuild(self):
+        """
+        Verify that a waiter that comes after the only waiter was
+        cancelled waits for the instance being built, instead of
+        building another.
+        """
+        builds = list()
+        class Factory:
+            def buildInstance(self):
+                builds.append(defer.Deferred())
+                return builds[-1]
+        singleton = util.DeferredSingleton(Factory())
+        d = singleton.get()
+        d.cancel()
+        self.assertFailure(d, defer.CancelledError)
+        results = list()
+        singleton.get().addCallback(results.append)
+        self.assertEquals(len(builds), 1)
+        builds[0].callback('instance')
+        self.assertEquals(results, ['instance'])
+
+    def test_reset(self):
+        """
+        Verify that a new instance is built after a reset.
+        """
+        built = list()
+        class Factory:
+            def buildInstance(self):
+                built.append(object())
+                return built[-1]
+        singleton = util.DeferredSingleton(Factory())
+        singleton.get()
+        singleton.reset()
+        def cb(instance):
+            self.assertEquals(len(built), 2)
+            self.assertIdentical(instance, built[1])
+        return singleton.get().addCallback(cb)
+
+
+class TimeoutTestCase(unittest.TestCase):
+
+    def test_timeout(self):
+        """
+        Verify that a deferred that does not fire in time is
+        cancelled and fails with L{error.TimeoutError}.
+        """
+        clock = task.Clock()
+        cancelled = list()
+        d = util.timeoutDeferred(defer.Deferred(cancelled.append), 5, clock)
+        clock.advance(5)
+        self.assertEquals(len(cancelled), 1)
+        return self.assertFailure(d, error.TimeoutError)
+
+    def test_inTime(self):
+        """
+        Verify that the timeout is cancelled when the deferred fires
+        in time.
+        """
+        clock = task.Clock()
+        d = util.timeoutDeferred(defer.Deferred(), 5, clock)
+        d.callback('result')
+        self.assertEquals(clock.getDelayedCalls(), [])
+        return d.addCallback(self.assertEquals, 'result')
+
+
+class RetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.attempts = list()
+
+    def attempt(self):
+        d = defer.Deferred()
+        self.attempts.append(d)
+        return d
+
+    def test_retry(self):
+        """
+        Verify that a retryable failure is retried after a backoff.
+        """
+        d = util.retry(self.attempt, 2, 1, lambda reason: True, self.clock)
+        self.attempts[0].errback(RuntimeError())
+        self.assertEquals(len(self.attempts), 1)
+        self.clock.advance(1.5)
+        self.assertEquals(len(self.attempts), 2)
+        self.attempts[1].callback('result')
+        return d.addCallback(self.assertEquals, 'result')
+
+    def test_giveUp(self):
+        """
+        Verify that the last failure is passed on once the retries
+        are used up.
+        """
+        d = util.retry(self.attempt, 1, 1, lambda reason: True, self.clock)
+        self.attempts[0].errback(RuntimeError())
+        self.clock.advance(1.5)
+        self.attempts[1].errback(ValueError())
+        return self.assertFailure(d, ValueError)
+
+    def test_notRetryable(self):
+        """
+        Verify that a failure that is not retryable is passed on
+        right away.
+        """
+        d = util.retry(self.attempt, 2, 1, lambda reason: False, self.clock)
+        self.attempts[0].errback(RuntimeError())
+        return self.assertFailure(d, RuntimeError)
+
+    def test_cancel(self):
+        """
+        Verify that cancelling stops the outstanding attempt and any
+        further retries.
+        """
+        d = util.retry(self.attempt, 2, 1, lambda reason: True, self.clock)
+        d.cancel()
+        self.clock.advance(10)
+        self.assertEquals(len(self.attempts), 1)
+        return self.assertFailure(d, defer.CancelledError)
+
+
+class HedgeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.attempts = list()
+
+    def attempt(self):
+        d = defer.Deferred()
+        self.attempts.append(d)
+        return d
+
+    def test_hedge(self):
+        """
+        Verify that a second attempt is made after the delay and that
+        the loser is cancelled.
+        """
+        d = util.hedge(self.attempt, 1, self.clock)
+        self.clock.advance(1)
+        self.assertEquals(len(self.attempts), 2)
+        self.attempts[1].callback('second')
+        self.assertFailure(self.attempts[0], defer.CancelledError)
+        return d.addCallback(self.assertEquals, 'second')
+
+    def test_fast(self):
+        """
+        Verify that no second attempt is made when the first one
+        answers in time.
+        """
+        d = util.hedge(self.attempt, 1, self.clock)
+        self.attempts[0].callback('first')
+        self.clock.advance(1)
+        self.assertEquals(len(self.attempts), 1)
+        return d.addCallback(self.assertEquals, 'first')
+
+
+class RaceTestCase(unittest.TestCase):
+
+    def test_firstSuccess(self):
+        """
+        Verify that the first success wins and the others are
+        cancelled.
+        """
+        cancelled = list()
+        slow = defer.Deferred(cancelled.append)
+        fast = defer.Deferred()
+        d = util.race([slow, fast])
+        fast.callback('fast')
+        self.assertEquals(cancelled, [slow])
+        return d.addCallback(self.assertEquals, 'fast')
+
+    def test_allFail(self):
+        """
+        Verify that the failure of the first deferred is passed on
+        when all fail.
+        """
+        d = util.race([defer.fail(ValueError()), defer.fail(KeyError())])
+        return self.assertFailure(d, ValueError)
@@ -0,0 +1,170 @@
+# This file is part of Nat Map.
+# Copyright (c) 2009 Johan Rydberg <johan.rydberg@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+# Opt-in tracing of the phases of an operation.  A trace follows an
+# operation through its Deferred chain and reports a span for every
+# phase to the hook installed with setTracer.  When no hook is
+# installed, start returns NULL, whose methods do nothing.
+
+from twisted.python import log
+
+import itertools
+import os
+import time
+
+
+tracer = None
+
+_ids = itertools.count(1)
+
+
+def setTracer(hook):
+    """
+    Install C{hook} to receive finished L{Span} objects, or remove
+    the hook if C{hook} is C{None}.
+    """
+    global tracer
+    tracer = hook
+
+
+class Span(object):
+    """
+    A finished phase of a traced operation.
+
+    @ivar traceID: the correlation ID shared by all spans of one
+        operation.
+    @ivar operation: the name of the traced operation, such as
+        C{'mapListeningPort'}.
+    @ivar name: the name of the phase.
+    @ivar started: the time the phase started.
+    @ivar duration: the duration of the phase, in seconds.
+    @ivar error: C{None} if the phase succeeded, otherwise the
+        L{Failure} it failed with.
+    """
+    __slots__ = ('traceID', 'operation', 'name', 'started', 'duration',
+                 'error')
+
+    def __init__(self, traceID, operation, name, started, duration,
+                 error=None):
+        self.traceID = traceID
+        self.operation = operation
+        self.name = name
+        self.started = started
+        self.duration = duration
+        self.error = error
+
+
+class Trace:
+    """
+    Trace of one operation.
+
+    @ivar traceID: the correlation ID of the operation.
+    """
+
+    def __init__(self, operation, hook):
+        self.traceID = '%x-%x' % (os.getpid(), _ids.next())
+        self.operation = operation
+        self.hook = hook
+        self.started = time.time()
+
+    def emit(self, name, started, error=None):
+        try:
+            self.hook(Span(self.traceID, self.operation, name, started,
+                           time.time() - started, error))
+        except:
+            log.err(None, "tracer failed")
+
+    def span(self, name, deferred):
+        """
+        Report a span named C{name} when C{deferred} fires.
+
+        @return: C{deferred}
+        """
+        started = time.time()
+
+        def cb(result):
+            self.emit(name, started)
+            return result
+
+        def eb(reason):
+            self.emit(name, started, reason)
+            return reason
+        return deferred.addCallbacks(cb, eb)
+
+    def finish(self, deferred):
+        """
+        Report a span for the whole operation, from the creation of
+        the trace until C{deferred} fires.
+
+        @return: C{deferred}
+        """
+        def cb(result):
+            self.emit(self.operation, self.started)
+            return result
+
+        def eb(reason):
+            self.emit(self.operation, self.started, reason)
+            return reason
+        return deferred.addCallbacks(cb, eb)
+
+    def call(self, name, f, *args, **kw):
+        """
+        Call C{f} and report a span named C{name} for the call.
+
+        @return: the result of C{f}.
+        """
+        started = time.time()
+        result = f(*args, **kw)
+        self.emit(name, started)
+        return result
+
+
+class _NullTrace:
+    """
+    Trace used when tracing is disabled.
+    """
+    traceID = None
+
+    def span(self, name, deferred):
+        return deferred
+
+    def finish(self, deferred):
+        return deferred
+
+    def call(self, name, f, *args, **kw):
+        return f(*args, **kw)
+
+
+NULL = _NullTrace()
+
+
+def start(operation):
+    """
+    Start tracing C{operation}.
+
+    @return: a L{Trace}, or L{NULL} if no tracer is installed.
+    """
+    if tracer is None:
+        return NULL
+    return Trace(operation, tracer)
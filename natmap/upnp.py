@@ -26,100 +26,254 @@
 
 from zope.interface import implements
 
-from xml.etree.ElementTree import fromstring
-
-from twisted.internet.protocol import DatagramProtocol
 from twisted.internet.address import IPv4Address
 from twisted.plugin import IPlugin
 from twisted.internet import reactor, defer, error
 from twisted.web import client
+from twisted.python import failure, log
 
 from natmap.inatmap import IMapper, NoSuchMappingError
-from natmap.soap import Proxy, SOAPFault, getPage
+from natmap.protocol import (
+    SSDP_MCAST, SSDP_PORT, BadResponseError, SOAPFault,
+    Mapping, formatDescription, parseOwner, mappingFromEntry,
+    addPortMappingArguments, parseSearchResponse, parseDescription,
+    searchRequest)
+from natmap import protocol
+from natmap.soap import Proxy, getPage
 from natmap.xmlbuilder import Namespace
-from natmap.internal import discoverInternalHost
-
-import random
-import socket
-import urlparse
-import itertools
-
+from natmap.internal import discoverInternalHost, defaultGateway
+from natmap.ssdp import acquireSearchPort
+from natmap import metrics
+from natmap.trace import NULL
 
-# UPNP multicast address, port and request string
-_UPNP_MCAST = '239.255.255.250'
-_UPNP_PORT = 1900
-_UPNP_SEARCH_REQUEST = """M-SEARCH * HTTP/1.1\r
-Host:%s:%s\r
-ST:urn:schemas-upnp-org:device:InternetGatewayDevice:1\r
-Man:"ssdp:discover"\r
-MX:3\r
-\r
-""" % (_UPNP_MCAST, _UPNP_PORT)
+import os
+import time
 
 
-def iterrandrange(n, start, stop):
-    return (random.randint(start, stop) for i in range(n))
-
-
-class BadResponseError(Exception):
-    pass
+class _WindowedFetch:
+    """
+    Walk the generic port mapping table with a bounded number of
+    outstanding requests.
+
+    Indices are requested ahead of the results that have arrived, at
+    most C{window} at a time.  The first index that is answered with a
+    L{SOAPFault} marks the end of the table.  The resulting mappings
+    are put back in index order and handed to C{visitor} one at a
+    time.  If the visitor returns a true value the walk stops and no
+    further requests are issued.
+    """
 
+    def __init__(self, fetchEntry, window, visitor):
+        self.fetchEntry = fetchEntry
+        self.window = max(1, window)
+        self.visitor = visitor
+        self.deferred = defer.Deferred(self._cancel)
+        self.pending = {}
+        self.results = {}
+        self.delivered = 0
+        self.nextIndex = 0
+        self.endIndex = None
+        self.outstanding = 0
+        self.filling = False
+
+    def start(self):
+        """
+        Start walking the table.
 
+        @return: a deferred called with the mapping that stopped the
+            walk, or C{None} if the end of the table was reached.
+        """
+        deferred = self.deferred
+        self._fill()
+        return deferred
 
+    def _cancel(self, deferred):
+        """
+        Stop walking the table and cancel the outstanding requests.
+        """
+        self.deferred = None
+        for pending in self.pending.values():
+            pending.cancel()
 
-class Mapping:
-    """
-    Object representing a mapping between an internal address and an
-    external address.
-
-    @ivar internalHost: A string containing the internal IP address.
-    @ivar internalPort: An integer representing the internal port
-        number.
-    @ivar externalPort: An integer representing the external port
-        number.
-    @ivar type: A string representing the type of transport, either
-        'TCP' or 'UDP'
-    """
+    def _finish(self, result):
+        deferred, self.deferred = self.deferred, None
+        if deferred is not None:
+            deferred.callback(result)
 
-    def __init__(self, type, internalHost, internalPort,
-                 externalPort):
-        self.type = type
-        self.internalHost = internalHost
-        self.internalPort = internalPort
-        self.externalPort = externalPort
+    def _fill(self):
+        """
+        Issue requests until the window is full or the end of the
+        table is known.
+        """
+        if self.filling:
+            return
+        self.filling = True
+        try:
+            while (self.deferred is not None
+                   and self.outstanding < self.window
+                   and (self.endIndex is None
+                        or self.nextIndex < self.endIndex)):
+                index = self.nextIndex
+                self.nextIndex += 1
+                self.outstanding += 1
+                d = self.fetchEntry(index)
+                if not d.called:
+                    self.pending[index] = d
+                d.addCallbacks(self._cbEntry, self._ebEntry,
+                               callbackArgs=(index,), errbackArgs=(index,))
+        finally:
+            self.filling = False
+
+        if self.outstanding == 0:
+            self._finish(None)
+
+    def _flush(self):
+        """
+        Hand entries that are next in order over to the visitor.
+        """
+        while self.deferred is not None and self.delivered in self.results:
+            mapping = self.results.pop(self.delivered)
+            self.delivered += 1
+            try:
+                stop = self.visitor(mapping)
+            except:
+                deferred, self.deferred = self.deferred, None
+                deferred.errback()
+                return
+            if stop:
+                self._finish(mapping)
+
+    def _cbEntry(self, mapping, index):
+        self.pending.pop(index, None)
+        self.outstanding -= 1
+        if self.endIndex is None or index < self.endIndex:
+            self.results[index] = mapping
+            self._flush()
+        self._fill()
+
+    def _ebEntry(self, reason, index):
+        self.pending.pop(index, None)
+        self.outstanding -= 1
+        if reason.check(SOAPFault):
+            if self.endIndex is None or index < self.endIndex:
+                self.endIndex = index
+            for stale in [i for i in self.results if i >= index]:
+                del self.results[stale]
+            self._fill()
+        elif self.deferred is not None:
+            deferred, self.deferred = self.deferred, None
+            deferred.errback(reason)
 
 
 class UPnPMapper(object):
     """
     Implementor of L{IMapper} for the UPnP IGD.
 
-    @ivar serviceURL: the URL where we do requests.
+    @ivar proxy: the SOAP proxy used to talk to the device.
+    @ivar fetchWindow: the number of C{GetGenericPortMappingEntry}
+        requests that may be outstanding at the same time while
+        walking the mapping table.
+    @ivar refreshExisting: if true, L{map} re-adds a mapping that
+        already exists to refresh its lease instead of only reusing
+        it.
+    @ivar owner: the owner that mappings are tagged with in their
+        description.
+    @ivar instance: the instance, by default the process ID, that
+        mappings are tagged with in their description.
+    @ivar journal: a L{natmap.sweep.Journal} where created mappings
+        are recorded, or C{None}.
     """
     implements(IMapper)
 
-    def __init__(self, proxy):
+    def __init__(self, proxy, fetchWindow=1, refreshExisting=False,
+                 owner='natmap', journal=None):
         self.proxy = proxy
+        self.fetchWindow = fetchWindow
+        self.refreshExisting = refreshExisting
+        self.owner = owner
+        self.instance = os.getpid()
+        self.journal = journal
 
-    @defer.inlineCallbacks
-    def getMappings(self):
+    def _getMappingEntry(self, index):
+        """
+        Fetch the entry at C{index} of the generic mapping table.
+
+        @return: a deferred called with a L{Mapping} object.
+        """
+        return self.proxy.callRemote(
+            'GetGenericPortMappingEntry',
+            NewPortMappingIndex=index).addCallback(mappingFromEntry)
+
+    def iterMappings(self, visitor, window=None):
+        """
+        Walk the mappings of the mapping device, calling C{visitor}
+        with each L{Mapping} in table order as soon as it arrives.
+
+        If C{visitor} returns a true value the walk stops there and
+        no further requests are sent to the device.
+
+        IGD:1 devices have no way to list the table in one request,
+        so the entries are requested one index at a time.  Up to
+        C{window} requests (by default L{fetchWindow}) are kept
+        outstanding at once.
+
+        @return: a deferred called with the mapping that stopped the
+            walk, or C{None} if every mapping was visited.
+        """
+        if window is None:
+            window = self.fetchWindow
+        return _WindowedFetch(self._getMappingEntry, window, visitor).start()
+
+    def findMapping(self, internalAddress):
+        """
+        Find the mapping directed at C{internalAddress}.
+
+        @return: a deferred called with the L{Mapping}, or C{None} if
+            there is no such mapping.
+        """
+        def visit(mapping):
+            return mapping.matches(internalAddress)
+        return self.iterMappings(visit)
+
+    def hasMappingCount(self, count):
+        """
+        Check, without walking the table, whether the mapping device
+        holds exactly C{count} mappings.
+
+        @return: a deferred called with a boolean.
+        """
+        def present(mapping):
+            return True
+
+        def absent(reason):
+            reason.trap(SOAPFault)
+            return False
+
+        def probe(index):
+            return self._getMappingEntry(index).addCallbacks(present, absent)
+
+        def cbEnd(found):
+            return not found
+
+        def cbLast(found):
+            if not found:
+                return False
+            return probe(count).addCallback(cbEnd)
+
+        if count == 0:
+            return cbLast(True)
+        return probe(count - 1).addCallback(cbLast)
+
+    def getMappings(self, window=None):
         """
         Return a C{Deferred} called with a sequence of L{Mapping}
         objects that represent all currently known mappings in the
         mapping device.
         """
         mappings = list()
-        for index in itertools.count():
-            try:
-                entry = yield self.proxy.callRemote(
-                    'GetGenericPortMappingEntry', NewPortMappingIndex=index)
-                mapping = Mapping(entry['NewProtocol'],
-                                  entry['NewInternalClient'],
-                                  int(entry['NewInternalPort']),
-                                  int(entry['NewExternalPort']))
-                mappings.append(mapping)
-            except SOAPFault:
-                break
-        defer.returnValue(mappings)
+        def cb(result):
+            return mappings
+        return self.iterMappings(mappings.append, window).addCallback(cb)
 
     def allocateExternalPort(self, type, internalPort):
         """
@@ -128,14 +282,18 @@ class UPnPMapper(object):
         @return: a deferred called with the allocated external port.
         """
         def cb(mappings):
-            external_ports = ((mapping.type, mapping.externalPort)
-                              for mapping in mappings)
-            for port in iterrandrange(20, 1025, 65536):
-                if not (type, port) in external_ports:
-                    return port
-            return internalPort
+            used = set((mapping.type, mapping.externalPort)
+                       for mapping in mappings)
+            return self.pickExternalPort(type, internalPort, used)
         return self.getMappings().addCallback(cb)
 
+    def pickExternalPort(self, type, internalPort, used):
+        """
+        Pick an external port that is not in C{used}, a set of
+        C{(type, externalPort)} tuples.
+        """
+        return protocol.pickExternalPort(type, internalPort, used)
+
     def _buildExternalAddress(self, addressType, externalPort):
         """
         Based on given parameters build a L{IPv4Address} object that
@@ -159,16 +317,15 @@ class UPnPMapper(object):
         if type not in ('UDP', 'TCP'):
             return defer.fail(ValueError("bad protocol"))
 
-        description = "%s:%d (%s)" % (internalHost, internalPort, type)
-        return self.proxy.callRemote(
-            'AddPortMapping', NewRemoteHost=" ",
-            NewExternalPort=externalPort, NewProtocol=type,
-            NewInternalPort=internalPort, NewInternalClient=internalHost,
-            NewEnabled=1, NewPortMappingDescription=description,
-            NewLeaseDuration=0
-            )
+        description = formatDescription(internalHost, internalPort, type,
+                                        self.owner, self.instance)
+        return self.proxy.callRemote('AddPortMapping',
+                                     **addPortMappingArguments(
+                                         internalHost, type, internalPort,
+                                         externalPort, description))
 
-    def _deletePortMapping(self, internalHost, type, internalPort, externalPort):
+    def _deletePortMapping(self, internalHost, type, internalPort,
+                           externalPort):
         """
         Delete an existing port mapping.
         """
@@ -176,46 +333,113 @@ class UPnPMapper(object):
             'DeletePortMapping', NewRemoteHost=" ",
             NewExternalPort=externalPort, NewProtocol=type)
 
-    def map(self, internalAddress):
+    def mapTo(self, internalAddress, externalPort, trace=NULL):
+        """
+        Map internal address to the given external port.
+
+        @return: a deferred called with the external address.
+        """
+        def mapped(result):
+            if self.journal is not None:
+                self.journal.record(self.instance, Mapping(
+                    internalAddress.type, internalAddress.host,
+                    internalAddress.port, externalPort)).addErrback(
+                        log.err, "failed to journal a mapping")
+            return trace.span('GetExternalIPAddress',
+                              self._buildExternalAddress(
+                                  internalAddress.type, externalPort))
+        return trace.span('AddPortMapping', self._addPortMapping(
+            internalAddress.host, internalAddress.type,
+            internalAddress.port, externalPort
+            )).addCallback(mapped)
+
+    def map(self, internalAddress, trace=NULL):
         """
         See L{IMapper.map}.
 
+        If the device already holds a mapping for C{internalAddress}
+        that mapping is reused.  It is added again, with the tag of
+        this instance, if it carries the tag of another instance or if
+        L{refreshExisting} is set.  The table is walked only once; it
+        is used both to find an existing mapping and to allocate a
+        free external port.
+
         @rtype: L{Deferred}
         """
-        def mapped(result, externalPort):
-            return self._buildExternalAddress(
-                internalAddress.type, externalPort
-                )
-
-        def allocated(externalPort):
-            return self._addPortMapping(
-                internalAddress.host, internalAddress.type,
-                internalAddress.port, externalPort
-                ).addCallback(mapped, externalPort)
-
-        return self.allocateExternalPort(internalAddress.type,
-                                         internalAddress.port).addCallback(
-            allocated)
-
-    def cbUnmap(self, mappings, internalAddress):
-        for mapping in mappings:
-            if (mapping.type == internalAddress.type
-                and mapping.internalHost == internalAddress.host
-                and mapping.internalPort == internalAddress.port):
-                return self._deletePortMapping(
-                    internalAddress.host, internalAddress.type,
-                    internalAddress.port, mapping.externalPort
-                    )
-        return defer.fail(NonSuchMappingError())
+        used = set()
+
+        def visit(mapping):
+            used.add((mapping.type, mapping.externalPort))
+            return mapping.matches(internalAddress)
+
+        def cb(mapping):
+            if mapping is None:
+                externalPort = trace.call(
+                    'allocateExternalPort', self.pickExternalPort,
+                    internalAddress.type, internalAddress.port, used)
+                return self.mapTo(internalAddress, externalPort, trace)
+            # An entry tagged by another instance, such as one that
+            # has died, is taken over so that it is not swept as
+            # theirs.
+            owner = parseOwner(mapping.description)
+            if self.refreshExisting or owner not in (
+                    None, (self.owner, self.instance)):
+                return self.mapTo(internalAddress, mapping.externalPort,
+                                  trace)
+            return trace.span('GetExternalIPAddress',
+                              self._buildExternalAddress(
+                                  internalAddress.type, mapping.externalPort))
+
+        return trace.span('getMappings',
+                          self.iterMappings(visit)).addCallback(cb)
+
+    def deleteMapping(self, mapping):
+        """
+        Delete the given L{Mapping} from the mapping device.
+
+        @rtype: L{Deferred}
+        """
+        def deleted(result):
+            if self.journal is not None:
+                self.journal.forget(mapping).addErrback(
+                    log.err, "failed to journal an unmapping")
+            return result
+        return self._deletePortMapping(
+            mapping.internalHost, mapping.type,
+            mapping.internalPort, mapping.externalPort
+            ).addCallback(deleted)
+
+    def cbUnmap(self, mapping, internalAddress, retry=False):
+        if mapping is None:
+            if retry:
+                return self.findMapping(internalAddress).addCallback(
+                    self.cbUnmap, internalAddress)
+            return defer.fail(NoSuchMappingError())
+        return self.deleteMapping(mapping)
 
     def unmap(self, internalAddress):
         """
         See L{IMapper.unmap}
 
+        The mapping is looked up by walking the table, which deletes
+        made by others renumber as it is walked, so a miss is retried
+        once.  Use L{unmapFrom} when the external port is known.
+
         @rtype: L{Deferred}
         """
-        return self.getMappings().addCallback(self.cbUnmap, internalAddress)
+        return self.findMapping(internalAddress).addCallback(
+            self.cbUnmap, internalAddress, True)
 
+    def unmapFrom(self, internalAddress, externalPort):
+        """
+        Remove the mapping of C{internalAddress} from C{externalPort}
+        without walking the table.
+
+        @rtype: L{Deferred}
+        """
+        return self.deleteMapping(Mapping(
+            internalAddress.type, internalAddress.host,
+            internalAddress.port, externalPort))
 
     def discoverExternalHost(self):
         """
@@ -227,87 +451,124 @@ class UPnPMapper(object):
         return self.proxy.callRemote('GetExternalIPAddress').addCallback(cb)
 
 
-class DiscoverProtocol(DatagramProtocol):
+class DiscoverProtocol:
     """
-    Datagram protocol used to discover UPnP capable devices in the
-    network.
+    Protocol used to discover UPnP capable devices in the network.
+    The search is sent from, and answered on, the L{SearchPort} of
+    the interface, which is released as soon as the search is done,
+    has failed or is cancelled.
     """
 
-    def __init__(self):
-        self.deferred = defer.Deferred()
+    def __init__(self, proxyOptions=None, pageGetter=getPage, recorder=None,
+                 reactor=reactor, **options):
+        self.deferred = defer.Deferred(self._cancel)
         self.timeout = None
         self.controlURL = None
-        self.ns = '{urn:schemas-upnp-org:device-1-0}'
-        
-    def search(self, timeout):
+        self.location = None
+        self.searchPort = None
+        self.fetch = None
+        self.started = None
+        self.searchTimeout = None
+        self.proxyOptions = proxyOptions or {}
+        self.pageGetter = pageGetter
+        self.recorder = recorder
+        self.reactor = reactor
+        self.options = options
+
+    def search(self, timeout, searchAddress=None, unicast=True,
+               interface='', gateway=None):
         """
         Search for stuff.
+
+        @param searchAddress: a C{(host, port)} tuple to send the search
+            request to instead of the SSDP multicast group.
+        @param unicast: if true, and no C{searchAddress} is given, the
+            request is also sent straight to the default gateway of
+            the host.  The gateway is usually the mapping device, and
+            a unicast request reaches it even on networks that drop
+            or rate-limit multicast.
+        @param interface: the address of the interface to search on,
+            or C{''} for the one the host routes multicast through.
+        @param gateway: the gateway the unicast request is sent to
+            instead of the default gateway, such as the gateway of
+            C{interface}.
         """
-        for port in iterrandrange(5, 1900, 2500):
-            try:
-                self.listeningPort = reactor.listenMulticast(port, self)
-            except error.CannotListenError:
-                continue
-            break
+        self.searchPort = acquireSearchPort(self, self.reactor, interface)
+        self.started = time.time()
+        self.searchTimeout = timeout
+        if searchAddress is None:
+            self.searchPort.joinGroup()
+            searchAddresses = [(SSDP_MCAST, SSDP_PORT)]
+            gateway = unicast and (gateway or defaultGateway())
+            if gateway:
+                searchAddresses.append((gateway, SSDP_PORT))
         else:
-            raise
+            searchAddresses = [searchAddress]
 
-        self.listeningPort.joinGroup(_UPNP_MCAST, socket.INADDR_ANY)
-        dst = (_UPNP_MCAST, _UPNP_PORT)
-        self.transport.write(_UPNP_SEARCH_REQUEST, dst)
-        self.transport.write(_UPNP_SEARCH_REQUEST, dst)
-        self.transport.write(_UPNP_SEARCH_REQUEST, dst)
+        for i in range(3):
+            for host, port in searchAddresses:
+                self.searchPort.write(searchRequest(host, port),
+                                      (host, port))
         
-        self.timeout = reactor.callLater(5, self.cancel)
+        self.timeout = self.reactor.callLater(timeout, self.cancel)
         return self.deferred
 
     def cbDiscover(self, data):
         """
         Callback from retreiving the service information.
         """
-        WANSERVICES = ['urn:schemas-upnp-org:service:WANIPConnection:1',
-                       'urn:schemas-upnp-org:service:WANPPPConnection:1']
-
-        document = fromstring(data)
-
-        # iterate through all provided services and try to find the
-        # control URL.
-        for serviceElement in document.findall('.//%sservice' % self.ns):
-            serviceType = serviceElement.findtext(self.ns + 'serviceType')
-            if serviceType in WANSERVICES:
-                self.controlURL = serviceElement.findtext(
-                    self.ns + 'controlURL')
-                break
-        self.baseURL = document.findtext(self.ns + 'URLBase')
-
-        if self.controlURL is not None:
-            serviceURL = urlparse.urljoin(self.baseURL, self.controlURL)
-            namespace = Namespace(
-                "urn:schemas-upnp-org:service:WANIPConnection:1", "u"
-                )
-            self.callback(UPnPMapper(Proxy(serviceURL, namespace)))
+        try:
+            self.controlURL, serviceType = parseDescription(
+                data, self.location)
+        except BadResponseError, e:
+            self.errback(e)
+            return
+
+        namespace = Namespace(serviceType, "u")
+        proxyOptions = dict(self.proxyOptions)
+        proxyOptions.setdefault('pageGetter', self.pageGetter)
+        proxyOptions.setdefault('reactor', self.reactor)
+        self.callback(UPnPMapper(Proxy(self.controlURL, namespace,
+                                       **proxyOptions),
+                                 **self.options))
         
     def datagramReceived(self, data, address):
         """
         Process incoming data.
         """
-        if self.controlURL is not None:
+        if self.location is not None:
             return None
 
-        if self.timeout is not None:
-            timeout, self.timeout = self.timeout, None
-            timeout.cancel()
-        
         try:
-            code, headers, data = self.parseResponse(data)
-        except BadResponseError:
+            code, headers, body = self.parseResponse(data)
+        except (BadResponseError, ValueError):
             return
 
         location = headers.get('location', None)
         if location is None:
-            self.errback(DiscoverError())
+            return
+
+        if self.timeout is not None:
+            timeout, self.timeout = self.timeout, None
+            timeout.cancel()
 
-        getPage(location).addCallback(self.cbDiscover).addErrback(self.errback)
+        if self.recorder is not None:
+            self.recorder.recordDatagram(data, time.time() - self.started)
+        self.location = location
+        metrics.discoveryPhaseCompleted('search', self.started)
+
+        started = time.time()
+        def cbDescription(data):
+            metrics.discoveryPhaseCompleted('description', started)
+            return data
+        def ebDescription(reason):
+            metrics.discoveryPhaseCompleted('description', started, reason)
+            return reason
+        self.close()
+        self.fetch = d = self.pageGetter(location, timeout=self.searchTimeout,
+                                         reactor=self.reactor)
+        d.addCallbacks(cbDescription, ebDescription)
+        d.addCallback(self.cbDiscover).addErrback(self.errback)
         
     def parseResponse(self, data):
         """
@@ -316,38 +577,27 @@ class DiscoverProtocol(DatagramProtocol):
         Return a tuple of response code, dictionary of headers and the
         response content body.
         """
-        firstline = True
-        headers = {}
+        return parseSearchResponse(data)
 
-        while data:
-            line, data = data.split('\r\n', 1)
-            if firstline:
-                
-                version, code, status = line.split(' ', 2)
-                if version != 'HTTP/1.1' and version != 'HTTP/1.0':
-                    raise BadResponseError("bad http version")
-
-                if code != '200':
-                    raise BadResponseError("bad response code")
-
-                firstline = False
-            elif not line:
-                break
-            else:
-                key, value = line.split(':', 1)
-                headers[key.lower()] = value
-
-        if firstline is True:
-            raise BadResponeError("no response line")
-
-        return code, headers, data
+    def close(self):
+        """
+        Stop listening for responses.
+        """
+        searchPort, self.searchPort = self.searchPort, None
+        if searchPort is not None:
+            searchPort.release(self)
+        if self.timeout is not None:
+            timeout, self.timeout = self.timeout, None
+            timeout.cancel()
 
     def callback(self, result):
         """
         Call deferred callback with result.
         """
+        self.close()
         deferred, self.deferred = self.deferred, None
         if deferred is not None:
+            metrics.discoveryPhaseCompleted('total', self.started)
             deferred.callback(result)
         return result
             
@@ -355,22 +605,57 @@ class DiscoverProtocol(DatagramProtocol):
         """
         Call deferred errback with reason.
         """
+        if not isinstance(reason, failure.Failure):
+            reason = failure.Failure(reason)
+        self.close()
         deferred, self.deferred = self.deferred, None
         if deferred is not None:
+            if self.location is None:
+                metrics.discoveryPhaseCompleted('search', self.started,
+                                                reason)
+            metrics.discoveryPhaseCompleted('total', self.started, reason)
             deferred.errback(reason)
         return reason
 
     def cancel(self):
+        self.timeout = None
         self.errback(error.TimeoutError())
+
+    def _cancel(self, deferred):
+        self.deferred = None
+        self.close()
+        fetch, self.fetch = self.fetch, None
+        if fetch is not None:
+            fetch.cancel()
         
 
-def discoverMapper(timeout=5):
+def discoverMapper(timeout=5, searchAddress=None, proxyOptions=None,
+                   unicast=True, pageGetter=getPage, recorder=None,
+                   reactor=reactor, interface='', gateway=None, **options):
     """
     Discover UPnP mapper.
 
+    @param searchAddress: see L{DiscoverProtocol.search}.
+    @param unicast: see L{DiscoverProtocol.search}.
+    @param interface: see L{DiscoverProtocol.search}.
+    @param gateway: see L{DiscoverProtocol.search}.
+    @param pageGetter: the function used to fetch the device
+        description and, unless C{proxyOptions} says otherwise, to
+        send requests to the device; see L{natmap.record}.
+    @param recorder: a L{natmap.record.Recorder} that the answer to
+        the search is recorded to, or C{None}.
+    @param reactor: the reactor used for the search, and by the
+        proxy unless C{proxyOptions} says otherwise.
+    @param proxyOptions: a dictionary of keyword arguments passed on
+        to L{Proxy}, such as C{timeout}, C{retries} and C{hedgeDelay}.
+    @param options: keyword arguments passed on to L{UPnPMapper},
+        such as C{fetchWindow}, C{owner} and C{journal}.
     @return: a deferred called with a IMapper provider.
     """
-    return DiscoverProtocol().search(timeout)
+    discovery = DiscoverProtocol(proxyOptions, pageGetter, recorder,
+                                 reactor, **options)
+    return discovery.search(timeout, searchAddress, unicast, interface,
+                            gateway)
 
 
     
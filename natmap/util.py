@@ -23,9 +23,11 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 
-from twisted.internet import defer
+from twisted.internet import defer, error, reactor
 from twisted.python import failure
 
+import random
+
 
 class InstanceFactory:
     """
@@ -42,17 +44,23 @@ class DeferredSingleton:
 
     The creation of the instance is made by a provided factory, and is
     deferred to when the instance is fetched for the first time.
+
+    @ivar building: true while the factory is building the instance.
+        Only one instance is built at a time, even if every waiter
+        has been cancelled in the meantime.
     """
 
     def __init__(self, factory):
         self.factory = factory
         self.instance = None
         self.waiters = list()
+        self.building = False
 
     def _ebFactory(self, reason):
         """
         Callback for handling errors from the factory.
         """
+        self.building = False
         waiters = list(self.waiters)
         del self.waiters[:]
 
@@ -63,6 +71,7 @@ class DeferredSingleton:
         """
         Callback for handling result from factory.
         """
+        self.building = False
         self.instance = instance
             
         waiters = list(self.waiters)
@@ -73,6 +82,13 @@ class DeferredSingleton:
 
         return instance
 
+    def _cancelWaiter(self, deferred):
+        """
+        Forget about a waiter that has been cancelled.
+        """
+        if deferred in self.waiters:
+            self.waiters.remove(deferred)
+
     def get(self):
         """
         Get instance.
@@ -81,13 +97,186 @@ class DeferredSingleton:
         @rtype: L{Deferred}
         """
         if self.instance is None:
-            deferred = defer.Deferred()
+            deferred = defer.Deferred(self._cancelWaiter)
+            self.waiters.append(deferred)
 
-            if not len(self.waiters):
+            # The factory may finish right away, so the waiter has to
+            # be in place before it is invoked.
+            if not self.building:
+                self.building = True
                 d = defer.maybeDeferred(self.factory.buildInstance)
                 d.addCallback(self._cbFactory).addErrback(self._ebFactory)
 
-            self.waiters.append(deferred)
             return deferred
 
         return defer.succeed(self.instance)
+
+    def reset(self):
+        """
+        Forget the instance, so that the next L{get} builds a new one.
+        An instance that is being built is not affected.
+        """
+        self.instance = None
+
+
+def timeoutDeferred(deferred, timeout, clock=reactor):
+    """
+    Cancel C{deferred} if it has not fired within C{timeout} seconds,
+    in which case it fails with L{error.TimeoutError}.
+
+    @param timeout: seconds, or C{None} for no timeout.
+    @return: C{deferred}
+    """
+    if timeout is None:
+        return deferred
+    expired = list()
+
+    def expire():
+        expired.append(True)
+        deferred.cancel()
+
+    def done(result):
+        if call.active():
+            call.cancel()
+        if (expired and isinstance(result, failure.Failure)
+                and result.check(defer.CancelledError)):
+            return failure.Failure(error.TimeoutError(
+                "no result within %s seconds" % (timeout,)))
+        return result
+
+    call = clock.callLater(timeout, expire)
+    return deferred.addBoth(done)
+
+
+def retry(attempt, retries, backoff, retryable, clock=reactor):
+    """
+    Call C{attempt} until the L{Deferred} it returns succeeds, at most
+    C{retries} more times.  A failure is only retried if
+    C{retryable(reason)} is true.  Before retry C{n} the call waits
+    C{backoff * 2 ** n} seconds, jittered by up to 50% either way.
+
+    Cancelling the returned deferred cancels the outstanding attempt
+    or the wait before the next one.
+
+    @return: a deferred called with the result of the first attempt
+        to succeed.
+    """
+    current = [None]
+    cancelled = list()
+
+    def cancel(result):
+        cancelled.append(True)
+        pending, current[0] = current[0], None
+        if pending is not None:
+            pending.cancel()
+
+    result = defer.Deferred(cancel)
+
+    def run(n):
+        current[0] = attempt()
+        current[0].addCallbacks(succeeded, failed, errbackArgs=(n,))
+
+    def succeeded(value):
+        current[0] = None
+        if not result.called:
+            result.callback(value)
+
+    def failed(reason, n):
+        current[0] = None
+        if result.called or cancelled:
+            return
+        if n < retries and retryable(reason):
+            delay = backoff * (2 ** n) * random.uniform(0.5, 1.5)
+            current[0] = clock.callLater(delay, run, n + 1)
+        else:
+            result.errback(reason)
+
+    run(0)
+    return result
+
+
+def hedge(attempt, delay, clock=reactor):
+    """
+    Call C{attempt}, and call it once more if the first attempt has
+    not finished within C{delay} seconds.  The first attempt to
+    succeed wins and the other is cancelled.  If both fail, the
+    failure of the last one to finish is passed on.
+
+    @return: a deferred called with the result of the winning attempt.
+    """
+    attempts = list()
+
+    def cancel(result):
+        if call.active():
+            call.cancel()
+        for pending in list(attempts):
+            pending.cancel()
+
+    result = defer.Deferred(cancel)
+
+    def start():
+        d = attempt()
+        attempts.append(d)
+        d.addCallbacks(succeeded, failed, callbackArgs=(d,),
+                       errbackArgs=(d,))
+
+    def succeeded(value, d):
+        attempts.remove(d)
+        if call.active():
+            call.cancel()
+        if not result.called:
+            result.callback(value)
+            for pending in list(attempts):
+                pending.cancel()
+
+    def failed(reason, d):
+        attempts.remove(d)
+        if result.called:
+            return
+        if call.active():
+            # Do not wait for the hedge delay when the first attempt
+            # has already failed.
+            call.cancel()
+            start()
+        elif not attempts:
+            result.errback(reason)
+
+    call = clock.callLater(delay, start)
+    start()
+    return result
+
+
+def race(deferreds):
+    """
+    Wait for the first of C{deferreds} to succeed.  The others are
+    cancelled.  If all of them fail, the failure of the first one in
+    the list is passed on.
+
+    @return: a deferred called with the result of the winner.
+    """
+    pending = list(deferreds)
+    failures = [None] * len(pending)
+
+    def cancel(result):
+        for d in list(pending):
+            d.cancel()
+
+    result = defer.Deferred(cancel)
+
+    def succeeded(value, d):
+        pending.remove(d)
+        if not result.called:
+            result.callback(value)
+            for other in list(pending):
+                other.cancel()
+
+    def failed(reason, index, d):
+        pending.remove(d)
+        failures[index] = reason
+        if not pending and not result.called:
+            result.errback(failures[0])
+
+    for index, d in enumerate(deferreds):
+        d.addCallbacks(succeeded, failed, callbackArgs=(d,),
+                       errbackArgs=(index, d))
+    return result
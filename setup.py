@@ -29,5 +29,5 @@ setup(
     version="0.1",
     author="Johan Rydberg",
     author_email="johan.rydberg@gmail.com",
-    packages=['natmap'],
+    packages=['natmap', 'twisted.plugins'],
     )